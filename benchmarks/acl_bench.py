@@ -0,0 +1,133 @@
+import argparse
+import sys
+import os
+import logging
+import re
+import tempfile
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.broker import MQTTBroker
+from src.application.acl import AccessControl, parse_rules, ALLOW, DENY, PUBLISH, USER_PREFIX
+from src.protocol.packet import MQTTPacket, PacketType
+
+def write_rules(path: str, count: int):
+    """``count`` rules: one tenant per user, plus a few shared and pattern rules"""
+    with open(path, 'w') as f:
+        f.write("deny all * tenants/+/admin/#\n")
+        f.write("allow subscribe * public/#\n")
+        f.write("allow publish * devices/%c/#\n")
+        for i in range(count - 3):
+            f.write(f"allow all user:user-{i} tenants/{i}/#\n")
+
+class RegexScan:
+    """Every rule as a regex, scanned in file order for each publish, for comparison"""
+
+    def __init__(self, rules: list, username: str):
+        self.rules = rules
+        self.username = username
+
+    @classmethod
+    def compile(cls, path: str) -> list:
+        with open(path) as f:
+            return [(rule.decision, rule.principal, re.compile(cls.pattern(rule.topic_filter)))
+                    for rule in parse_rules(f) if PUBLISH in rule.actions]
+
+    @staticmethod
+    def pattern(topic_filter: str) -> str:
+        levels = []
+        for level in topic_filter.split('/'):
+            levels.append({'+': '[^/]*', '#': '.*'}.get(level, re.escape(level)))
+        return '^' + '/'.join(levels).replace('/.*', '(/.*)?') + '$'
+
+    def may_publish(self, topic: str) -> bool:
+        allowed = False
+        for decision, principal, regex in self.rules:
+            if principal not in ('*', USER_PREFIX + self.username) or not regex.match(topic):
+                continue
+            if decision == DENY:
+                return False
+            allowed = allowed or decision == ALLOW
+        return allowed
+
+def run(args, path: str, mode: str) -> dict:
+    """Publishes routed through handle_publish_packet by ``--clients`` connections"""
+    broker = MQTTBroker(0, log_level=logging.WARNING, acl_file=path if mode != 'no acl' else None,
+                        queue_size=64)
+    if mode == 'compiled, uncached':
+        broker.acl.cache_size = 0
+    # connections are plain objects, frames only go as far as their outbound queues
+    clients = [object() for _ in range(args.clients)]
+    regexes = RegexScan.compile(path) if mode == 'regex scan' else None
+    for i, client in enumerate(clients):
+        broker.register_client(client)
+        broker.handle_connect(client, MQTTPacket(PacketType.CONNECT, client_id=f'client-{i}',
+                                                 username=f'user-{i}', keep_alive=0))
+        if mode == 'regex scan':
+            broker.client_acl[client] = RegexScan(regexes, f'user-{i}')
+    # one subscriber for every tenant, so allowed publishes are routed
+    subscriber = object()
+    broker.register_client(subscriber)
+    broker.topics.subscribe('tenants/#', subscriber)
+
+    publishes = args.scan_publishes if mode == 'regex scan' else args.publishes
+    packets = [MQTTPacket(PacketType.PUBLISH, topic=f'tenants/{i}/sensor/{j}', payload=b'x' * args.size)
+               for i in range(args.clients) for j in range(args.topics)]
+    order = [(clients[n % args.clients], packets[(n % args.clients) * args.topics + (n // args.clients) % args.topics])
+             for n in range(publishes)]
+    if mode != 'regex scan':
+        # steady state: every connection's tries compiled and its topics cached
+        for i, client in enumerate(clients):
+            for packet in packets[i * args.topics:(i + 1) * args.topics]:
+                broker.handle_publish_packet(client, packet)
+    start = time.perf_counter()
+    for client, packet in order:
+        broker.handle_publish_packet(client, packet)
+    elapsed = time.perf_counter() - start
+    denied = broker.acl.denied[PUBLISH] if broker.acl else 0
+    return {'publishes': publishes, 'us': elapsed / publishes * 1e6, 'denied': denied}
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish overhead of ACL checks with many rules')
+    parser.add_argument('--rules', type=int, default=10000,
+                        help='Rules in the ACL file')
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='Publishing connections, each with its own username')
+    parser.add_argument('--topics', type=int, default=10,
+                        help='Topics each connection publishes to')
+    parser.add_argument('--publishes', type=int, default=200000,
+                        help='Publishes per run')
+    parser.add_argument('--scan-publishes', type=int, default=2000,
+                        help='Publishes of the regex scan run, which is far slower')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Payload size in bytes')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile('w', suffix='.acl', delete=False) as f:
+        path = f.name
+    try:
+        write_rules(path, args.rules)
+        start = time.perf_counter()
+        acl = AccessControl(path)
+        compiled = time.perf_counter() - start
+        start = time.perf_counter()
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 1))
+        acl.reload()
+        reloaded = time.perf_counter() - start
+        print(f"{len(acl):,} rules: compiled in {compiled * 1000:.0f} ms, reloaded in {reloaded * 1000:.0f} ms")
+        print(f"{args.clients:,} clients x {args.topics} topics, {args.size} byte payloads")
+        print(f"{'mode':<20} {'publishes':>10} {'us/publish':>11} {'overhead us':>12} {'publishes/s':>12} {'denied':>7}")
+        baseline = None
+        for mode in ('no acl', 'compiled, cached', 'compiled, uncached', 'regex scan'):
+            result = run(args, path, mode)
+            if baseline is None:
+                baseline = result['us']
+            print(f"{mode:<20} {result['publishes']:>10,} {result['us']:>11.2f} {result['us'] - baseline:>12.2f} "
+                  f"{1e6 / result['us']:>12,.0f} {result['denied']:>7}")
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
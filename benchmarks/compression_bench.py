@@ -0,0 +1,66 @@
+import argparse
+import json
+import random
+import sys
+import os
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.protocol.compression import PayloadCodec, train_dictionary
+
+def sensor_payload(rng: random.Random, size: int) -> bytes:
+    """Telemetry JSON of about ``size`` bytes, repetitive like real sensor reports"""
+    readings = []
+    length = 0
+    while length < size:
+        reading = {
+            'sensor': f'probe-{rng.randrange(64):02d}',
+            'type': rng.choice(['temperature', 'humidity', 'pressure']),
+            'value': round(rng.uniform(0, 100), 2),
+            'unit': 'si',
+            'status': 'ok' if rng.random() < 0.95 else 'degraded',
+            'timestamp': 1700000000 + rng.randrange(86400),
+        }
+        readings.append(reading)
+        length += len(json.dumps(reading)) + 2
+    return json.dumps({'device': f'gateway-{rng.randrange(1000)}', 'readings': readings}).encode()
+
+def measure(codec: PayloadCodec, payloads: list):
+    """Compressed size ratio and microseconds to encode and decode a payload"""
+    start = time.perf_counter()
+    encoded = [codec.encode(payload) for payload in payloads]
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for data in encoded:
+        codec.decode(data)
+    decode_time = time.perf_counter() - start
+    ratio = sum(map(len, encoded)) / sum(map(len, payloads))
+    return ratio, encode_time / len(payloads) * 1e6, decode_time / len(payloads) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description='Payload compression ratio and cost')
+    parser.add_argument('--sizes', default='256,2048,20480',
+                        help='Comma separated payload sizes in bytes')
+    parser.add_argument('--count', type=int, default=500,
+                        help='Payloads per size')
+    parser.add_argument('--level', type=int, default=6,
+                        help='zlib compression level')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    # the dictionary is trained on other payloads than those measured
+    dictionary = train_dictionary(sensor_payload(rng, 2048) for _ in range(200))
+    codecs = [('deflate', PayloadCodec(0, args.level)),
+              ('deflate + dictionary', PayloadCodec(0, args.level, dictionary=dictionary))]
+
+    print(f"{'payload':>8} {'codec':<22} {'size':>7} {'encode us':>10} {'decode us':>10}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        payloads = [sensor_payload(rng, size) for _ in range(args.count)]
+        for name, codec in codecs:
+            ratio, encode_us, decode_us = measure(codec, payloads)
+            print(f"{size:>8} {name:<22} {ratio:>7.1%} {encode_us:>10.1f} {decode_us:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import sys
+import os
+import logging
+import socket
+import struct
+import threading
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.broker import MQTTBroker
+from src.protocol.packet import MQTTPacket, PacketType, PacketReader
+
+# sequence number and publish time at the start of every payload
+STAMP = struct.Struct('!Id')
+
+def connect(host: str, port: int, client_id: str, receive_buffer: int = 0) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if receive_buffer:
+        # a small window makes a slow reader back up the broker's queue
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    sock.connect((host, port))
+    sock.sendall(MQTTPacket(PacketType.CONNECT, client_id=client_id).encode())
+    return sock
+
+class Subscriber(threading.Thread):
+    """Reads ``read_size`` bytes per ``read_delay`` seconds and records message ages"""
+
+    def __init__(self, sock: socket.socket, read_size: int, read_delay: float):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.read_size = read_size
+        self.read_delay = read_delay
+        self.messages = 0
+        self.bytes = 0
+        self.ages = []
+        self.latest = {}
+        self.last_receive = time.monotonic()
+
+    def run(self):
+        reader = PacketReader()
+        while True:
+            try:
+                data = self.sock.recv(self.read_size)
+            except OSError:
+                return
+            if not data:
+                return
+            now = time.perf_counter()
+            self.last_receive = time.monotonic()
+            self.bytes += len(data)
+            for packet in reader.feed(data):
+                if packet.packet_type != PacketType.PUBLISH:
+                    continue
+                sequence, published = STAMP.unpack_from(packet.payload)
+                self.messages += 1
+                self.ages.append(now - published)
+                self.latest[packet.topic] = max(sequence, self.latest.get(packet.topic, 0))
+            if self.read_delay:
+                time.sleep(self.read_delay)
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description='Last-value conflation for slow subscribers')
+    parser.add_argument('--port', type=int, default=18841,
+                        help='Port for the in-process broker')
+    parser.add_argument('--topics', type=int, default=20,
+                        help='Topics published round-robin')
+    parser.add_argument('--rate', type=int, default=2000,
+                        help='Messages published per second over all topics')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='Seconds to publish for')
+    parser.add_argument('--size', type=int, default=256,
+                        help='Payload size in bytes')
+    parser.add_argument('--interval', type=int, default=0,
+                        help='Minimum delivery interval per topic of the conflated subscription, ms')
+    parser.add_argument('--read-size', type=int, default=2048,
+                        help='Bytes a slow subscriber reads at a time')
+    parser.add_argument('--read-delay', type=float, default=0.01,
+                        help='Seconds a slow subscriber sleeps between reads')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='Outbound queue size per client')
+    args = parser.parse_args()
+
+    host = '127.0.0.1'
+    broker = MQTTBroker(args.port, host, log_level=logging.WARNING, queue_size=args.queue_size)
+    threading.Thread(target=broker.start, daemon=True).start()
+    time.sleep(0.5)
+
+    subscribers = {}
+    for name, topic_filter, slow in (('fast', 'bench/#', False),
+                                     ('slow', 'bench/#', True),
+                                     ('slow conflated', f'$conflate/{args.interval}/bench/#', True)):
+        sock = connect(host, args.port, name.replace(' ', '-'), 4096 if slow else 0)
+        sock.sendall(MQTTPacket(PacketType.SUBSCRIBE, packet_id=1, topic=topic_filter).encode())
+        subscriber = Subscriber(sock, args.read_size if slow else 65536, args.read_delay if slow else 0)
+        subscriber.start()
+        subscribers[name] = subscriber
+    time.sleep(0.5)
+    ports = {sub.sock.getsockname(): name for name, sub in subscribers.items()}
+
+    publisher = connect(host, args.port, 'pub')
+    topics = [f'bench/{i}' for i in range(args.topics)]
+    padding = b'x' * max(0, args.size - STAMP.size)
+    total = int(args.rate * args.duration)
+    start = time.perf_counter()
+    for sequence in range(1, total + 1):
+        # paced in bursts of 10 so the sleeps stay coarse
+        if sequence % 10 == 0:
+            delay = start + sequence / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        payload = STAMP.pack(sequence, time.perf_counter()) + padding
+        publisher.sendall(MQTTPacket(PacketType.PUBLISH, topic=topics[sequence % args.topics],
+                                     payload=payload).encode())
+    # the newest message of every topic, which a conflated subscriber must still get
+    final = {topics[s % args.topics]: s for s in range(max(1, total - args.topics + 1), total + 1)}
+    while any(time.monotonic() - sub.last_receive < 1 for sub in subscribers.values()):
+        time.sleep(0.2)
+
+    stats = {ports.get(name): s for name, s in broker.client_stats().items()}
+    print(f"published {total} messages on {args.topics} topics at {args.rate}/s")
+    print(f"{'subscriber':<16} {'received':>9} {'bytes':>10} {'frames':>7} {'dropped':>8} {'conflated':>9} "
+          f"{'age p50 ms':>10} {'age p99 ms':>10} {'final':>6}")
+    for name, sub in subscribers.items():
+        queue = stats.get(name, {})
+        current = sum(sub.latest.get(topic) == sequence for topic, sequence in final.items())
+        print(f"{name:<16} {sub.messages:>9} {sub.bytes:>10} {queue.get('sent', 0):>7} {queue.get('dropped', 0):>8} "
+              f"{queue.get('conflated', 0):>9} {percentile(sub.ages, 0.5) * 1000:>10.1f} "
+              f"{percentile(sub.ages, 0.99) * 1000:>10.1f} {current:>3}/{len(final)}")
+
+    publisher.close()
+    for sub in subscribers.values():
+        sub.sock.close()
+    time.sleep(0.5)
+    broker.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import sys
+import os
+import logging
+import socket
+import threading
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.broker import MQTTBroker
+from src.protocol.packet import MQTTPacket, PacketType
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def count_nodes(trie) -> int:
+    stack, count = [trie._root], 0
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children.values())
+    return count
+
+def subscribe(broker: MQTTBroker, client, filters: list):
+    packet = MQTTPacket(PacketType.SUBSCRIBE, packet_id=1, subscriptions=[(f, 0) for f in filters])
+    broker.handle_subscribe(client, packet)
+
+def run(args, global_lock: bool) -> dict:
+    """Route publishes from many threads while another thread churns subscriptions"""
+    broker = MQTTBroker(0, log_level=logging.WARNING, queue_size=args.queue_size)
+    if global_lock:
+        # the publish path as it was: routing and sends under topics_lock
+        handle_publish = broker.handle_publish
+
+        def locked_publish(packet):
+            with broker.topics_lock:
+                handle_publish(packet)
+        broker.handle_publish = locked_publish
+
+    sockets = []
+    for i in range(args.subscribers):
+        client, peer = socket.socketpair()
+        sockets.append(peer)
+        broker.register_client(client)
+        subscribe(broker, client, [f'site/{i % args.sites}/#', f'site/+/{i}/status'])
+    baseline_nodes = count_nodes(broker.topics)
+
+    # every thread starts together, the first ones would otherwise starve the rest of starting
+    begin = threading.Event()
+    stop = threading.Event()
+    latencies = [[] for _ in range(args.publishers)]
+    counts = [0] * args.publishers
+    churned = [0]
+
+    def publish(index: int):
+        samples = latencies[index]
+        packets = [MQTTPacket(PacketType.PUBLISH, topic=f'site/{(index + i) % args.sites}/{i}/status',
+                              payload=b'x' * args.size) for i in range(args.devices)]
+        count = 0
+        begin.wait()
+        while not stop.is_set():
+            packet = packets[count % len(packets)]
+            start = time.perf_counter()
+            broker.handle_publish(packet)
+            samples.append(time.perf_counter() - start)
+            count += 1
+        counts[index] = count
+
+    def churn():
+        # connects and disconnects that each subscribe to topics nobody else uses
+        begin.wait()
+        while not stop.is_set():
+            client, peer = socket.socketpair()
+            broker.register_client(client)
+            subscribe(broker, client, [f'churn/{churned[0]}/+', f'site/{churned[0] % args.sites}/{churned[0]}/status'])
+            broker.remove_client(client)
+            peer.close()
+            churned[0] += 1
+            time.sleep(args.churn_delay)
+
+    threads = [threading.Thread(target=publish, args=(i,), daemon=True) for i in range(args.publishers)]
+    threads.append(threading.Thread(target=churn, daemon=True))
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    begin.set()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    samples = [latency for thread_samples in latencies for latency in thread_samples]
+    result = {
+        'publishes/s': sum(counts) / elapsed,
+        'p50 us': percentile(samples, 0.5) * 1e6,
+        'p99 us': percentile(samples, 0.99) * 1e6,
+        'churn/s': churned[0] / elapsed,
+        # every churned client is gone, so its trie nodes must be too
+        'leaked nodes': count_nodes(broker.topics) - baseline_nodes,
+    }
+    for client in list(broker.outbound):
+        broker.remove_client(client)
+    for peer in sockets:
+        peer.close()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish routing under contention from many threads')
+    parser.add_argument('--publishers', type=int, default=64,
+                        help='Publishing threads')
+    parser.add_argument('--subscribers', type=int, default=200,
+                        help='Subscribed connections')
+    parser.add_argument('--sites', type=int, default=50,
+                        help='Distinct site/<n>/# filters')
+    parser.add_argument('--devices', type=int, default=100,
+                        help='Topics each publisher cycles through')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Payload size in bytes')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='Outbound queue size per client, nothing drains them')
+    parser.add_argument('--churn-delay', type=float, default=0.001,
+                        help='Seconds between the churning connects')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='Seconds per run')
+    args = parser.parse_args()
+
+    print(f"{args.publishers} publisher threads, {args.subscribers} subscribers")
+    print(f"{'publish path':<16} {'publishes/s':>12} {'p50 us':>8} {'p99 us':>9} {'churn/s':>8} {'leaked nodes':>13}")
+    for name, global_lock in (('global lock', True), ('copy-on-write', False)):
+        result = run(args, global_lock)
+        print(f"{name:<16} {result['publishes/s']:>12.0f} {result['p50 us']:>8.1f} {result['p99 us']:>9.1f} "
+              f"{result['churn/s']:>8.0f} {result['leaked nodes']:>13}")
+
+if __name__ == '__main__':
+    main()
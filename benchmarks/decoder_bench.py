@@ -0,0 +1,46 @@
+import argparse
+import sys
+import os
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.protocol.packet import MQTTPacket, PacketType, PacketReader
+
+PAYLOAD_SIZES = [1, 1024, 60 * 1024]
+
+def build_stream(payload_size: int, count: int) -> bytes:
+    frame = MQTTPacket(PacketType.PUBLISH, topic='bench/topic',
+                       payload=b'x' * payload_size).encode()
+    return frame * count
+
+def run(payload_size: int, count: int, chunk_size: int) -> float:
+    """Feed the stream in ``chunk_size`` reads and return packets per second"""
+    stream = memoryview(build_stream(payload_size, count))
+    reader = PacketReader()
+    decoded = 0
+    start = time.perf_counter()
+    for pos in range(0, len(stream), chunk_size):
+        decoded += len(reader.feed(stream[pos:pos + chunk_size]))
+    elapsed = time.perf_counter() - start
+    assert decoded == count, f"decoded {decoded} of {count} packets"
+    return decoded / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='PacketReader microbenchmark')
+    parser.add_argument('--bytes', type=int, default=32 * 1024 * 1024,
+                        help='Approximate stream size per payload size')
+    parser.add_argument('--chunk-size', type=int, default=4096,
+                        help='Bytes delivered per simulated recv()')
+    args = parser.parse_args()
+
+    print(f"{'payload':>10} {'packets':>10} {'packets/sec':>14} {'MB/sec':>10}")
+    for size in PAYLOAD_SIZES:
+        frame_size = len(build_stream(size, 1))
+        count = max(1000, args.bytes // frame_size)
+        rate = run(size, count, args.chunk_size)
+        print(f"{size:>10} {count:>10} {rate:>14,.0f} {rate * frame_size / 1e6:>10.1f}")
+
+if __name__ == '__main__':
+    main()
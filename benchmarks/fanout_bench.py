@@ -0,0 +1,95 @@
+import argparse
+import sys
+import os
+import logging
+import selectors
+import socket
+import threading
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.broker import MQTTBroker
+from src.protocol.packet import MQTTPacket, PacketType, PacketReader
+
+def connect(host: str, port: int, client_id: str) -> socket.socket:
+    sock = socket.create_connection((host, port))
+    sock.sendall(MQTTPacket(PacketType.CONNECT, client_id=client_id).encode())
+    return sock
+
+def main():
+    parser = argparse.ArgumentParser(description='1 publisher to N subscribers fan-out benchmark')
+    parser.add_argument('--port', type=int, default=18831,
+                        help='Port for the in-process broker')
+    parser.add_argument('--subscribers', type=int, default=500,
+                        help='Number of subscriber connections')
+    parser.add_argument('--count', type=int, default=200,
+                        help='Messages published')
+    parser.add_argument('--size', type=int, default=256,
+                        help='Payload size in bytes')
+    parser.add_argument('--qos', type=int, choices=[0, 1], default=0,
+                        help='Publish QoS (QoS 1 frames are re-headed, payloads still shared)')
+    parser.add_argument('--write-batch', type=int, default=64,
+                        help='Frames coalesced per vectored send')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Run the broker with metrics instrumentation enabled')
+    args = parser.parse_args()
+
+    host = '127.0.0.1'
+    broker = MQTTBroker(args.port, host, log_level=logging.WARNING,
+                        queue_size=args.count + 10, write_batch=args.write_batch, metrics=args.metrics)
+    threading.Thread(target=broker.start, daemon=True).start()
+    time.sleep(0.5)
+
+    selector = selectors.DefaultSelector()
+    for i in range(args.subscribers):
+        sock = connect(host, args.port, f'sub-{i}')
+        sock.sendall(MQTTPacket(PacketType.SUBSCRIBE, packet_id=1, topic='telemetry/fanout').encode())
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, PacketReader())
+    time.sleep(1)
+
+    expected = args.subscribers * args.count
+    received = [0]
+    payload = os.urandom(args.size)
+
+    def drain():
+        while received[0] < expected:
+            events = selector.select(timeout=5)
+            if not events:
+                break
+            for key, _ in events:
+                for packet in key.data.read_from(key.fileobj) or ():
+                    if packet.packet_type == PacketType.PUBLISH:
+                        assert packet.payload == payload
+                        received[0] += 1
+
+    drain_thread = threading.Thread(target=drain)
+    publisher = connect(host, args.port, 'pub')
+    start = time.perf_counter()
+    drain_thread.start()
+    frames = [MQTTPacket(PacketType.PUBLISH, topic='telemetry/fanout', payload=payload,
+                         qos=args.qos, packet_id=(i % 65535) + 1 if args.qos else 0).encode()
+              for i in range(args.count)]
+    for frame in frames:
+        publisher.sendall(frame)
+    drain_thread.join()
+    elapsed = time.perf_counter() - start
+
+    stats = [s for s in broker.client_stats().values() if s['enqueued'] >= args.count]
+    sent = sum(s['sent'] for s in stats)
+    writes = sum(s['writes'] for s in stats)
+    print(f"subscribers         {args.subscribers}")
+    print(f"delivered           {received[0]} / {expected}")
+    print(f"deliveries/sec      {received[0] / elapsed:,.0f}")
+    print(f"frames per send     {sent / max(writes, 1):.1f} ({writes} send calls for {sent} frames)")
+    # closing the clients lets the broker's connection threads exit before stop joins them
+    publisher.close()
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    time.sleep(0.5)
+    broker.stop()
+
+if __name__ == '__main__':
+    main()
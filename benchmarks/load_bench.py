@@ -0,0 +1,263 @@
+import argparse
+import json
+import sys
+import os
+import logging
+import platform
+import resource
+import subprocess
+import threading
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.broker import MQTTBroker
+from src.application.async_broker import AsyncMQTTBroker
+from src.application.client import MQTTClient
+from src.protocol.topic import topic_matches
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# payloads start with the send time in nanoseconds, zero padded
+STAMP = 20
+
+SHAPES = {
+    # every publisher and subscriber share one topic
+    'fan-out': (lambda i: 'bench/load/all', lambda i: 'bench/load/all'),
+    # publishers use their own topic, subscribers take them all
+    'fan-in': (lambda i: f'bench/load/{i}', lambda i: 'bench/load/+'),
+    # subscriber i listens to publisher i (modulo the publisher count)
+    'pairs': (lambda i: f'bench/load/{i}', None),
+}
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def proc_stats(pid: int) -> dict:
+    """CPU seconds and peak RSS of another process and its workers, from /proc"""
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(child) for child in f.read().split()]
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return {}
+    ticks = os.sysconf('SC_CLK_TCK')
+    stats = {
+        'cpu_seconds': (int(fields[11]) + int(fields[12])) / ticks,
+        'max_rss_mb': int(status['VmHWM'].split()[0]) / 1024,
+    }
+    for child in children:
+        child_stats = proc_stats(child)
+        stats['cpu_seconds'] += child_stats.get('cpu_seconds', 0)
+        stats['max_rss_mb'] += child_stats.get('max_rss_mb', 0)
+    return stats
+
+
+def self_stats(start_times) -> dict:
+    times = os.times()
+    return {
+        'cpu_seconds': (times.user - start_times.user) + (times.system - start_times.system),
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def start_broker(args):
+    """Start the broker under test, returns (broker, process)"""
+    if args.broker == 'external':
+        return None, None
+    if args.broker == 'subprocess':
+        command = [sys.executable, os.path.join(ROOT, 'examples', 'broker.py'), '--host', args.host,
+                   '--port', str(args.port), '--engine', args.engine, '--workers', str(args.workers),
+                   '--queue-size', str(args.queue_size), '--log-level', 'WARNING']
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        time.sleep(1.0)
+        return None, process
+    broker_class = AsyncMQTTBroker if args.engine == 'asyncio' else MQTTBroker
+    broker = broker_class(args.port, args.host, log_level=logging.WARNING, queue_size=args.queue_size)
+    threading.Thread(target=broker.start, daemon=True).start()
+    time.sleep(0.5)
+    return broker, None
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def run(args) -> dict:
+    publish_topic, subscribe_topic = SHAPES[args.shape]
+    if subscribe_topic is None:
+        subscribe_topic = lambda i: publish_topic(i % args.publishers)
+
+    latencies = []
+    received = [0]
+    lock = threading.Lock()
+
+    def on_message(topic: str, payload: bytes):
+        latency = time.perf_counter_ns() - int(payload[:STAMP])
+        with lock:
+            latencies.append(latency)
+            received[0] += 1
+
+    subscribers = []
+    for i in range(args.subscribers):
+        client = MQTTClient(args.host, args.port, client_id=f'bench-sub-{i}')
+        if not client.connect() or not client.subscribe(subscribe_topic(i), on_message):
+            raise RuntimeError(f"Subscriber {i} could not subscribe")
+        subscribers.append(client)
+    # deliveries each publisher's messages should produce
+    topics = [subscribe_topic(i) for i in range(args.subscribers)]
+    audience = [sum(topic_matches(t, publish_topic(i)) for t in topics) for i in range(args.publishers)]
+
+    publishers = [MQTTClient(args.host, args.port, client_id=f'bench-pub-{i}', max_inflight=args.window)
+                  for i in range(args.publishers)]
+    for client in publishers:
+        if not client.connect():
+            raise RuntimeError("Publisher could not connect")
+
+    sent = [0] * args.publishers
+    padding = 'x' * max(0, args.size - STAMP)
+    deadline = time.perf_counter() + args.duration
+
+    def publish_loop(index: int):
+        client, topic = publishers[index], publish_topic(index)
+        interval = 1.0 / args.rate if args.rate else 0.0
+        next_send = time.perf_counter()
+        while time.perf_counter() < deadline:
+            if interval:
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send += interval
+            client.publish_async(topic, f'{time.perf_counter_ns():0{STAMP}d}{padding}', qos=args.qos)
+            sent[index] += 1
+
+    start_times = os.times()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=publish_loop, args=(i,)) for i in range(args.publishers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    publish_elapsed = time.perf_counter() - start
+
+    # drain until everything expected arrived or deliveries stall
+    expected = sum(count * size for count, size in zip(sent, audience))
+    last, stalled = -1, time.perf_counter()
+    while received[0] < expected and time.perf_counter() - stalled < args.drain_timeout:
+        if received[0] != last:
+            last, stalled = received[0], time.perf_counter()
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    client_stats = self_stats(start_times)
+
+    for client in publishers + subscribers:
+        client.disconnect()
+
+    latencies.sort()
+    to_ms = 1e-6
+    return {
+        'published': sum(sent),
+        'expected_deliveries': expected,
+        'delivered': received[0],
+        'publish_rate': sum(sent) / publish_elapsed,
+        'delivery_rate': received[0] / elapsed,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50) * to_ms,
+            'p99': percentile(latencies, 0.99) * to_ms,
+            'p999': percentile(latencies, 0.999) * to_ms,
+            'max': (latencies[-1] if latencies else 0) * to_ms,
+        },
+        'clients': client_stats,
+        'elapsed': elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Broker load generator: throughput, latency, CPU and memory')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Broker host')
+    parser.add_argument('--port', type=int, default=18840,
+                        help='Broker port')
+    parser.add_argument('--broker', choices=['inprocess', 'subprocess', 'external'], default='subprocess',
+                        help='Run the broker in this process, in a child process, or use a running one')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='Broker connection engine')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Broker processes (subprocess broker only)')
+    parser.add_argument('--queue-size', type=int, default=100000,
+                        help='Broker outbound queue size per client')
+    parser.add_argument('--shape', choices=sorted(SHAPES), default='fan-out',
+                        help='Topic layout between publishers and subscribers')
+    parser.add_argument('--publishers', type=int, default=4,
+                        help='Publishing clients')
+    parser.add_argument('--subscribers', type=int, default=4,
+                        help='Subscribing clients')
+    parser.add_argument('--size', type=int, default=64,
+                        help=f'Payload size in bytes (at least {STAMP} for the timestamp)')
+    parser.add_argument('--qos', type=int, choices=[0, 1], default=1,
+                        help='Publish QoS')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Messages per second per publisher, 0 publishes as fast as the window allows')
+    parser.add_argument('--window', type=int, default=64,
+                        help='In-flight window per publisher')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='Seconds to publish for')
+    parser.add_argument('--drain-timeout', type=float, default=2.0,
+                        help='Seconds to wait for stalled deliveries after publishing stops')
+    parser.add_argument('--output', default='load_bench.json',
+                        help='JSON results file')
+    args = parser.parse_args()
+
+    broker, process = start_broker(args)
+    # client diagnostics would distort the measurement
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        results = run(args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        if process:
+            results_broker = proc_stats(process.pid)
+            process.terminate()
+            process.wait(timeout=10)
+        elif broker:
+            broker.stop()
+
+    if process:
+        results['broker'] = results_broker
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    latency = results['latency_ms']
+    print(f"published           {results['published']:,} ({results['publish_rate']:,.0f} msgs/sec)")
+    print(f"delivered           {results['delivered']:,} / {results['expected_deliveries']:,} "
+          f"({results['delivery_rate']:,.0f} msgs/sec)")
+    print(f"latency ms          p50 {latency['p50']:.2f}  p99 {latency['p99']:.2f}  "
+          f"p999 {latency['p999']:.2f}  max {latency['max']:.2f}")
+    print(f"clients             cpu {results['clients']['cpu_seconds']:.1f}s  "
+          f"rss {results['clients']['max_rss_mb']:.0f} MB")
+    if 'broker' in results:
+        print(f"broker              cpu {results['broker'].get('cpu_seconds', 0):.1f}s  "
+              f"rss {results['broker'].get('max_rss_mb', 0):.0f} MB")
+    print(f"results written to  {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import sys
+import os
+import time
+import tracemalloc
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.protocol.packet import MQTTPacket, PacketType, PROTOCOL_LEGACY, PROTOCOL_MQTT311, ack_frame, control_frame
+
+def per_call(function, count: int) -> float:
+    """Microseconds per call of ``function``"""
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    return (time.perf_counter() - start) / count * 1e6
+
+def retained(function, count: int):
+    """Bytes and allocated blocks kept alive per object ``function`` returns"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [function() for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    size = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    del kept
+    return size / count, blocks / count
+
+def main():
+    parser = argparse.ArgumentParser(description='Packet encode/decode cost per packet')
+    parser.add_argument('--count', type=int, default=100000,
+                        help='Calls per measurement')
+    parser.add_argument('--size', type=int, default=64,
+                        help='PUBLISH payload size in bytes')
+    args = parser.parse_args()
+
+    publish = MQTTPacket(PacketType.PUBLISH, topic='bench/packet', payload=b'x' * args.size, qos=1, packet_id=1)
+    frames = {
+        'publish': publish.encode(),
+        'puback': ack_frame(PacketType.PUBACK, 1),
+        'pingreq': control_frame(PacketType.PINGREQ),
+    }
+    legacy_publish = publish.encode(PROTOCOL_LEGACY)
+    cases = [
+        (f'decode {name}', lambda frame=frame: MQTTPacket.decode(frame, PROTOCOL_MQTT311))
+        for name, frame in frames.items()
+    ]
+    cases += [
+        ('decode legacy publish', lambda: MQTTPacket.decode(legacy_publish, PROTOCOL_LEGACY)),
+        ('encode publish', publish.encode),
+        ('encode puback', lambda: MQTTPacket(PacketType.PUBACK, packet_id=1).encode()),
+        ('ack_frame puback', lambda: ack_frame(PacketType.PUBACK, 1)),
+        ('encode pingresp', lambda: MQTTPacket(PacketType.PINGRESP).encode()),
+        ('control_frame pingresp', lambda: control_frame(PacketType.PINGRESP)),
+    ]
+    print(f"{'operation':<24} {'us/packet':>10}")
+    for name, function in cases:
+        print(f"{name:<24} {per_call(function, args.count):>10.2f}")
+
+    size, blocks = retained(lambda: MQTTPacket.decode(frames['publish'], PROTOCOL_MQTT311), args.count // 10)
+    print(f"decoded publish keeps {size:.0f} bytes in {blocks:.1f} blocks")
+
+if __name__ == '__main__':
+    main()
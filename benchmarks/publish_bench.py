@@ -0,0 +1,97 @@
+import argparse
+import sys
+import os
+import logging
+import threading
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.broker import MQTTBroker
+from src.application.client import MQTTClient
+from src.application.pool import MQTTClientPool
+
+def run_sequential(client: MQTTClient, topic: str, message: str, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        if not client.publish(topic, message):
+            raise RuntimeError("Publish was not acknowledged")
+    return count / (time.perf_counter() - start)
+
+def run_pipelined(client: MQTTClient, topic: str, message: str, count: int) -> float:
+    start = time.perf_counter()
+    futures = [client.publish_async(topic, message) for _ in range(count)]
+    if not all(future.result(timeout=30) for future in futures):
+        raise RuntimeError("Publish was not acknowledged")
+    return count / (time.perf_counter() - start)
+
+def run_batched(client, topics: list, message: str, count: int, batch: int) -> float:
+    start = time.perf_counter()
+    futures = []
+    for offset in range(0, count, batch):
+        futures.extend(client.publish_many((topics[i % len(topics)], message)
+                                           for i in range(offset, min(count, offset + batch))))
+    if not all(future.result(timeout=30) for future in futures):
+        raise RuntimeError("Publish was not acknowledged")
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Single publisher throughput, sequential vs pipelined')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Broker host, an in-process broker is started unless --external')
+    parser.add_argument('--port', type=int, default=18830,
+                        help='Broker port')
+    parser.add_argument('--external', action='store_true',
+                        help='Use an already running broker')
+    parser.add_argument('--count', type=int, default=20000,
+                        help='Messages per run')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Payload size in bytes')
+    parser.add_argument('--windows', default='64,1024',
+                        help='Comma separated in-flight window sizes')
+    parser.add_argument('--pool-sizes', default='1,4',
+                        help='Comma separated connection pool sizes for the publish_many runs')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='Messages per publish_many call')
+    parser.add_argument('--topics', type=int, default=64,
+                        help='Distinct topics for the publish_many runs')
+    args = parser.parse_args()
+
+    if not args.external:
+        broker = MQTTBroker(args.port, args.host, log_level=logging.WARNING)
+        threading.Thread(target=broker.start, daemon=True).start()
+        time.sleep(0.5)
+
+    message = 'x' * args.size
+    client = MQTTClient(args.host, args.port)
+    if not client.connect():
+        print("Failed to connect to broker")
+        return
+    count = max(1, args.count // 20)
+    print(f"{'mode':<20} {'msgs/sec':>12}")
+    print(f"{'sequential':<20} {run_sequential(client, 'bench/publish', message, count):>12,.0f}")
+    client.disconnect()
+
+    for window in (int(w) for w in args.windows.split(',')):
+        client = MQTTClient(args.host, args.port, max_inflight=window)
+        client.connect()
+        rate = run_pipelined(client, 'bench/publish', message, args.count)
+        print(f"{f'window {window}':<20} {rate:>12,.0f}")
+        client.disconnect()
+
+    topics = [f'bench/publish/{i}' for i in range(args.topics)]
+    window = int(args.windows.split(',')[-1])
+    client = MQTTClient(args.host, args.port, max_inflight=window)
+    client.connect()
+    rate = run_batched(client, topics, message, args.count, args.batch)
+    print(f"{'publish_many':<20} {rate:>12,.0f}")
+    client.disconnect()
+
+    for size in (int(s) for s in args.pool_sizes.split(',')):
+        with MQTTClientPool(args.host, args.port, size=size, max_inflight=window) as pool:
+            rate = run_batched(pool, topics, message, args.count, args.batch)
+        print(f"{f'pool {size}':<20} {rate:>12,.0f}")
+
+if __name__ == '__main__':
+    main()
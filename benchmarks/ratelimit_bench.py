@@ -0,0 +1,136 @@
+import argparse
+import sys
+import os
+import logging
+import socket
+import struct
+import threading
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.broker import MQTTBroker
+from src.application.ratelimit import RateLimits
+from src.protocol.packet import MQTTPacket, PacketType, PacketReader
+
+# publish time at the start of every quiet payload
+STAMP = struct.Struct('!d')
+
+def connect(host: str, port: int, client_id: str) -> socket.socket:
+    sock = socket.create_connection((host, port))
+    sock.sendall(MQTTPacket(PacketType.CONNECT, client_id=client_id).encode())
+    return sock
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def run(args, port: int, rate_limits) -> dict:
+    """Latency of the quiet publishers while one client floods the broker"""
+    host = '127.0.0.1'
+    broker = MQTTBroker(port, host, log_level=logging.WARNING, queue_size=100000, rate_limits=rate_limits)
+    threading.Thread(target=broker.start, daemon=True).start()
+    time.sleep(0.5)
+
+    latencies = []
+    subscriber = connect(host, port, 'latency')
+    subscriber.sendall(MQTTPacket(PacketType.SUBSCRIBE, packet_id=1, topic='quiet/#').encode())
+    # the noise is routed to subscribers too, that is what makes it expensive
+    sinks = [connect(host, port, f'sink-{i}') for i in range(args.sinks)]
+    for sink in sinks:
+        sink.sendall(MQTTPacket(PacketType.SUBSCRIBE, packet_id=1, topic='noisy/#').encode())
+    stop = threading.Event()
+
+    def receive():
+        reader = PacketReader()
+        while not stop.is_set():
+            for packet in reader.read_from(subscriber) or ():
+                if packet.packet_type == PacketType.PUBLISH:
+                    latencies.append(time.perf_counter() - STAMP.unpack_from(packet.payload)[0])
+
+    def drain(sock):
+        while not stop.is_set():
+            try:
+                if not sock.recv(65536):
+                    return
+            except OSError:
+                return
+
+    def flood():
+        sock = connect(host, port, 'noisy')
+        burst = MQTTPacket(PacketType.PUBLISH, topic='noisy/device', payload=b'n' * args.size).encode() * 100
+        while not stop.is_set():
+            try:
+                sock.sendall(burst)
+            except OSError:
+                break
+            # a throttled flood can still be blocked in sendall when the run ends
+            counts['noisy'] = counts.get('noisy', 0) + 100
+        sock.close()
+
+    def quiet(index: int):
+        sock = connect(host, port, f'quiet-{index}')
+        topic = f'quiet/{index}'
+        padding = b'q' * max(0, args.size - STAMP.size)
+        while not stop.is_set():
+            sock.sendall(MQTTPacket(PacketType.PUBLISH, topic=topic,
+                                    payload=STAMP.pack(time.perf_counter()) + padding).encode())
+            time.sleep(1 / args.quiet_rate)
+        sock.close()
+
+    counts = {}
+    threads = [threading.Thread(target=receive, daemon=True)]
+    threads += [threading.Thread(target=drain, args=(sink,), daemon=True) for sink in sinks]
+    threads += [threading.Thread(target=quiet, args=(i,), daemon=True) for i in range(args.quiet)]
+    if not args.no_noise:
+        threads.append(threading.Thread(target=flood, daemon=True))
+    time.sleep(0.2)
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    time.sleep(0.5)
+    result = {
+        'quiet messages': len(latencies),
+        'p50 ms': percentile(latencies, 0.5) * 1000,
+        'p99 ms': percentile(latencies, 0.99) * 1000,
+        'noisy sent': counts.get('noisy', 0),
+        'throttled': sum(rate_limits.throttled.values()) if rate_limits else 0,
+    }
+    subscriber.close()
+    for sink in sinks:
+        sink.close()
+    time.sleep(0.5)
+    broker.stop()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Quiet client latency next to a flooding client, with and without limits')
+    parser.add_argument('--port', type=int, default=18851,
+                        help='Port for the first in-process broker, the next ports are used for the other runs')
+    parser.add_argument('--quiet', type=int, default=10,
+                        help='Well-behaved publishers')
+    parser.add_argument('--quiet-rate', type=float, default=20,
+                        help='Messages per second of each well-behaved publisher')
+    parser.add_argument('--sinks', type=int, default=4,
+                        help='Subscribers of the flooded topic')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Payload size in bytes')
+    parser.add_argument('--limit', type=float, default=1000,
+                        help='Messages per second allowed per connection in the limited run')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='Seconds per run')
+    parser.add_argument('--no-noise', action='store_true',
+                        help='Leave the flooding client out')
+    args = parser.parse_args()
+
+    runs = [('no limits', None), (f'{args.limit:g} msg/s per connection', RateLimits(messages=args.limit))]
+    print(f"{'run':<28} {'quiet msgs':>10} {'p50 ms':>8} {'p99 ms':>8} {'noisy sent':>11} {'throttled':>10}")
+    for i, (name, rate_limits) in enumerate(runs):
+        result = run(args, args.port + i, rate_limits)
+        print(f"{name:<28} {result['quiet messages']:>10} {result['p50 ms']:>8.2f} {result['p99 ms']:>8.2f} "
+              f"{result['noisy sent']:>11} {result['throttled']:>10}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import gc
+import json
+import sys
+import os
+import logging
+import subprocess
+import threading
+import time
+
+# Add parent directory to Python path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from src.application.broker import MQTTBroker
+from src.application.async_broker import AsyncMQTTBroker
+from src.application.capture import CaptureFile, OPENED, FRAME, CLOSED
+from src.protocol.packet import MQTTPacket, PacketType, PacketReader, PROTOCOL_LEGACY, detect_protocol
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def start_broker(args):
+    """Start the broker under test, returns (broker, process)"""
+    if args.broker == 'external':
+        return None, None
+    if args.broker == 'subprocess':
+        command = [sys.executable, os.path.join(ROOT, 'examples', 'broker.py'), '--host', args.host,
+                   '--port', str(args.port), '--engine', args.engine, '--log-level', 'WARNING']
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        time.sleep(1.0)
+        return None, process
+    broker_class = AsyncMQTTBroker if args.engine == 'asyncio' else MQTTBroker
+    broker = broker_class(args.port, args.host, log_level=logging.WARNING)
+    threading.Thread(target=broker.start, daemon=True).start()
+    time.sleep(0.5)
+    return broker, None
+
+def load(captures) -> list:
+    """(time, connection, kind, frame) of every capture, on one timeline in capture order.
+
+    Captures of broker workers are aligned by their wall-clock start, their
+    connection ids are kept apart by the capture index.
+    """
+    first = min(capture.started for capture in captures)
+    records = []
+    for index, capture in enumerate(captures):
+        offset = capture.started - first
+        records.extend((record.time + offset, (index, record.connection), record.kind, record.frame)
+                       for record in capture)
+    # stable, so the frames of one connection keep their order
+    records.sort(key=lambda record: record[0])
+    return records
+
+class Replay:
+    """Sends captured frames on one connection per captured connection"""
+
+    def __init__(self, args, records: list):
+        self.args = args
+        self.records = records
+        self.writers = {}
+        self.protocols = {}
+        self.receivers = []
+        # (topic, payload) -> when the latest publish of it was sent
+        self.published = {}
+        self.lags = []
+        self.latencies = []
+        self.sent = 0
+        self.sent_bytes = 0
+        self.delivered = 0
+        self.open = 0
+        self.peak_open = 0
+        self.failed = 0
+
+    async def run(self) -> float:
+        loop = asyncio.get_running_loop()
+        speed = self.args.speed
+        records, teardown = self.records, []
+        if not speed:
+            # without the captured gaps subscribers would be gone before
+            # the publishes they got are delivered
+            teardown = [record for record in records if self.is_teardown(record)]
+            records = [record for record in records if not self.is_teardown(record)]
+        origin = records[0][0] if records else 0.0
+        start = loop.time()
+        for captured, connection, kind, frame in records:
+            due = start + (captured - origin) / speed if speed else loop.time()
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.step(connection, kind, frame, due)
+        elapsed = loop.time() - start
+        # deliveries still on their way
+        await asyncio.sleep(self.args.drain_timeout)
+        for _, connection, kind, frame in teardown:
+            await self.step(connection, kind, frame, loop.time())
+        for writer in self.writers.values():
+            writer.close()
+        for receiver in self.receivers:
+            receiver.cancel()
+        await asyncio.gather(*self.receivers, return_exceptions=True)
+        return elapsed
+
+    async def step(self, connection, kind: int, frame, due: float):
+        """Replay one record that was due at ``due``"""
+        if kind == OPENED:
+            await self.connect(connection)
+            return
+        writer = self.writers.get(connection)
+        if writer is None:
+            return
+        if kind == CLOSED:
+            del self.writers[connection]
+            self.open -= 1
+            writer.close()
+            return
+        now = asyncio.get_running_loop().time()
+        self.lags.append(now - due)
+        self.send(connection, writer, frame, now)
+        if writer.transport.get_write_buffer_size() > 256 * 1024:
+            await writer.drain()
+
+    async def connect(self, connection):
+        try:
+            reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        except OSError:
+            self.failed += 1
+            return
+        self.writers[connection] = writer
+        self.open += 1
+        self.peak_open = max(self.peak_open, self.open)
+        self.receivers.append(asyncio.create_task(self.receive(reader)))
+
+    def send(self, connection, writer, frame, now: float):
+        protocol = self.protocols.get(connection)
+        if protocol is None:
+            protocol = self.protocols[connection] = detect_protocol(frame[0])
+        if self.is_publish(frame, protocol):
+            try:
+                packet = MQTTPacket.decode(frame, protocol)
+                self.published[packet.topic, bytes(packet.payload or b'')] = now
+            except ValueError:
+                pass
+        writer.write(frame)
+        self.sent += 1
+        self.sent_bytes += len(frame)
+
+    @staticmethod
+    def is_teardown(record) -> bool:
+        """A close, or a DISCONNECT in either wire format"""
+        kind, frame = record[2], record[3]
+        if kind != FRAME:
+            return kind == CLOSED
+        return frame[0] in (0xE0, PacketType.DISCONNECT.value)
+
+    @staticmethod
+    def is_publish(frame, protocol: str) -> bool:
+        if protocol == PROTOCOL_LEGACY:
+            return frame[0] == PacketType.PUBLISH.value
+        return frame[0] >> 4 == 3
+
+    async def receive(self, reader: asyncio.StreamReader):
+        loop = asyncio.get_running_loop()
+        packets = PacketReader()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                now = loop.time()
+                for packet in packets.feed(data):
+                    if packet.packet_type != PacketType.PUBLISH:
+                        continue
+                    self.delivered += 1
+                    sent = self.published.get((packet.topic, bytes(packet.payload or b'')))
+                    if sent is not None:
+                        self.latencies.append(now - sent)
+        except (OSError, ValueError):
+            pass
+
+def run(args) -> dict:
+    captures = [CaptureFile(path) for path in args.captures]
+    records = load(captures)
+    frames = [record for record in records if record[2] == FRAME]
+    connections = len({record[1] for record in records})
+    duration = records[-1][0] - records[0][0] if records else 0.0
+    replay = Replay(args, records)
+    elapsed = asyncio.run(replay.run())
+
+    results = {
+        'capture': {
+            'connections': connections,
+            'frames': len(frames),
+            'bytes': sum(len(record[3]) for record in frames),
+            'seconds': duration,
+            'frame_rate': len(frames) / duration if duration else 0.0,
+        },
+        'replay': {
+            'speed': args.speed or 'max',
+            'seconds': elapsed,
+            'frames': replay.sent,
+            'frame_rate': replay.sent / elapsed if elapsed else 0.0,
+            'mb_per_second': replay.sent_bytes / elapsed / 1e6 if elapsed else 0.0,
+            'peak_connections': replay.peak_open,
+            'failed_connections': replay.failed,
+            # how far the replay fell behind the capture's timeline
+            'lag_ms': {q: percentile(replay.lags, f) * 1000 for q, f in (('p50', 0.5), ('p99', 0.99), ('max', 1.0))},
+            'delivered': replay.delivered,
+            'latency_ms': {q: percentile(replay.latencies, f) * 1000
+                           for q, f in (('p50', 0.5), ('p99', 0.99), ('max', 1.0))},
+        },
+    }
+    # the frames are views into the maps, some are left in asyncio's reference cycles
+    del records, frames, replay
+    gc.collect()
+    for capture in captures:
+        capture.close()
+    return results
+
+def divergence(results: dict, baseline: dict) -> dict:
+    """Relative change of throughput and latency from a previous run"""
+    def change(new: float, old: float) -> float:
+        return (new - old) / old * 100 if old else 0.0
+    now, then = results['replay'], baseline['replay']
+    report = {'frame_rate': change(now['frame_rate'], then['frame_rate'])}
+    for q in ('p50', 'p99'):
+        report[f'lag_{q}'] = change(now['lag_ms'][q], then['lag_ms'][q])
+        report[f'latency_{q}'] = change(now['latency_ms'][q], then['latency_ms'][q])
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured broker traffic and report throughput and latency')
+    parser.add_argument('captures', nargs='+',
+                        help='Capture files written by the broker with --capture, one per worker')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Broker host')
+    parser.add_argument('--port', type=int, default=18870,
+                        help='Broker port')
+    parser.add_argument('--broker', choices=['inprocess', 'subprocess', 'external'], default='subprocess',
+                        help='Run the broker in this process, in a child process, or use a running one')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='Broker connection engine')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed, 2 replays twice as fast as captured, 0 as fast as possible '
+                             'with every disconnect held until the end')
+    parser.add_argument('--drain-timeout', type=float, default=2.0,
+                        help='Seconds to wait for deliveries after the last frame')
+    parser.add_argument('--output',
+                        help='JSON results file')
+    parser.add_argument('--baseline',
+                        help='JSON results of an earlier replay of the same capture to compare with')
+    args = parser.parse_args()
+
+    broker, process = start_broker(args)
+    try:
+        results = run(args)
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=10)
+        elif broker:
+            broker.stop()
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['divergence_percent'] = divergence(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    capture, replay = results['capture'], results['replay']
+    print(f"captured            {capture['frames']:,} frames on {capture['connections']:,} connections "
+          f"in {capture['seconds']:.2f}s ({capture['frame_rate']:,.0f} frames/sec)")
+    speed = f"{replay['speed']}x" if args.speed else replay['speed']
+    print(f"replayed at {speed:<7} {replay['frames']:,} frames in {replay['seconds']:.2f}s "
+          f"({replay['frame_rate']:,.0f} frames/sec, {replay['mb_per_second']:.1f} MB/s), "
+          f"peak {replay['peak_connections']:,} connections, {replay['failed_connections']} failed")
+    print(f"schedule lag ms     p50 {replay['lag_ms']['p50']:.2f}  p99 {replay['lag_ms']['p99']:.2f}  "
+          f"max {replay['lag_ms']['max']:.2f}")
+    print(f"delivered           {replay['delivered']:,}, latency ms p50 {replay['latency_ms']['p50']:.2f}  "
+          f"p99 {replay['latency_ms']['p99']:.2f}  max {replay['latency_ms']['max']:.2f}")
+    if 'divergence_percent' in results:
+        print("vs baseline         " + "  ".join(f"{name} {value:+.1f}%"
+                                                for name, value in results['divergence_percent'].items()))
+
+if __name__ == '__main__':
+    main()
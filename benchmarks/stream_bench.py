@@ -0,0 +1,118 @@
+import argparse
+import sys
+import os
+import logging
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.broker import MQTTBroker
+from src.application.client import MQTTClient
+from src.protocol.packet import MQTTPacket, PacketType, publish_prefix
+
+def drain(sock, expected: int, done: threading.Event):
+    """Count received bytes into one reused buffer until ``expected`` arrived"""
+    buffer = bytearray(256 * 1024)
+    received = 0
+    while received < expected:
+        size = sock.recv_into(buffer)
+        if not size:
+            break
+        received += size
+    done.set()
+
+def run(args, port: int, path: str, streamed: bool) -> dict:
+    """Publish the file once through an in-process broker to raw subscribers"""
+    host = '127.0.0.1'
+    threshold = args.threshold * 1024 if streamed else 0
+    broker = MQTTBroker(port, host, log_level=logging.WARNING, stream_threshold=threshold)
+    threading.Thread(target=broker.start, daemon=True).start()
+    time.sleep(0.5)
+
+    subscribers = []
+    for i in range(args.subscribers):
+        sock = socket.create_connection((host, port))
+        sock.sendall(MQTTPacket(PacketType.CONNECT, client_id=f'sink-{i}').encode())
+        sock.sendall(MQTTPacket(PacketType.SUBSCRIBE, packet_id=1, topic='files/#').encode())
+        # CONNACK and SUBACK
+        sock.recv(9)
+        subscribers.append(sock)
+    publisher = MQTTClient(host, port, client_id='publisher')
+    publisher.connect()
+    time.sleep(0.2)
+
+    size = os.path.getsize(path)
+    expected = len(publish_prefix('files/blob', size)) + size
+    done = [threading.Event() for _ in subscribers]
+    threads = [threading.Thread(target=drain, args=(sock, expected, event), daemon=True)
+               for sock, event in zip(subscribers, done)]
+    for thread in threads:
+        thread.start()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if streamed:
+        acked = publisher.publish_stream('files/blob', path)
+    else:
+        with open(path, 'rb') as f:
+            acked = publisher.publish('files/blob', f.read())
+    published = time.perf_counter() - start
+    for event in done:
+        event.wait(args.timeout)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        'acked': acked,
+        'delivered': sum(event.is_set() for event in done),
+        'publish s': published,
+        'delivery s': elapsed,
+        'MB/s': size * len(subscribers) / elapsed / 1e6,
+        'peak MB': peak / 1e6,
+    }
+    publisher.disconnect()
+    for sock in subscribers:
+        sock.close()
+    time.sleep(0.2)
+    broker.stop()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Large payload publish: read whole and buffered vs streamed with sendfile')
+    parser.add_argument('--port', type=int, default=18861,
+                        help='Port for the first in-process broker, the next port is used for the other run')
+    parser.add_argument('--size', type=int, default=50,
+                        help='Payload size in MB')
+    parser.add_argument('--subscribers', type=int, default=2,
+                        help='Subscribers receiving the payload')
+    parser.add_argument('--threshold', type=int, default=1024,
+                        help='Broker stream threshold in KB for the streamed run')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Seconds to wait for a delivery')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(args.size):
+            f.write(chunk)
+        path = f.name
+    try:
+        print(f"{args.size} MB payload, {args.subscribers} subscribers; peak is memory traced in this process "
+              f"(publisher and broker)")
+        print(f"{'publish':<10} {'acked':>6} {'delivered':>10} {'publish s':>10} {'delivery s':>11} "
+              f"{'MB/s':>8} {'peak MB':>8}")
+        for i, (name, streamed) in enumerate((('buffered', False), ('streamed', True))):
+            result = run(args, args.port + i, path, streamed)
+            print(f"{name:<10} {str(result['acked']):>6} {result['delivered']:>10} {result['publish s']:>10.3f} "
+                  f"{result['delivery s']:>11.3f} {result['MB/s']:>8.1f} {result['peak MB']:>8.1f}")
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
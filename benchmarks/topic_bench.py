@@ -0,0 +1,88 @@
+import argparse
+import sys
+import os
+import random
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.protocol.topic import TopicTrie, topic_matches
+
+def build_filters(count: int, sites: int, devices: int):
+    """Mostly leaf subscriptions plus a share of ``+`` and ``#`` filters"""
+    rng = random.Random(1)
+    metrics = ['temp', 'humidity', 'status', 'battery']
+    filters = []
+    for i in range(count):
+        site = rng.randrange(sites)
+        device = rng.randrange(devices)
+        kind = i % 10
+        if kind == 0:
+            filters.append(f"site/{site}/+/{rng.choice(metrics)}")
+        elif kind == 1:
+            filters.append(f"site/{site}/{device}/#")
+        else:
+            filters.append(f"site/{site}/{device}/{rng.choice(metrics)}")
+    return filters
+
+def build_topics(count: int, sites: int, devices: int):
+    rng = random.Random(2)
+    metrics = ['temp', 'humidity', 'status', 'battery']
+    return [f"site/{rng.randrange(sites)}/{rng.randrange(devices)}/{rng.choice(metrics)}"
+            for _ in range(count)]
+
+def bench(label: str, fn, topics):
+    start = time.perf_counter()
+    matched = 0
+    for topic in topics:
+        matched += len(fn(topic))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {len(topics) / elapsed:>14,.0f} matches/sec"
+          f"  ({matched / len(topics):.1f} subscribers/topic)")
+
+def main():
+    parser = argparse.ArgumentParser(description='TopicTrie routing benchmark')
+    parser.add_argument('--subscriptions', type=int, default=100000,
+                        help='Number of subscriptions')
+    parser.add_argument('--publishes', type=int, default=100000,
+                        help='Number of publish topics to route')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='Match cache size for the cached run')
+    parser.add_argument('--linear', type=int, default=200,
+                        help='Publishes routed by the linear-scan baseline (0 to skip)')
+    args = parser.parse_args()
+
+    sites, devices = 100, 1000
+    filters = build_filters(args.subscriptions, sites, devices)
+    topics = build_topics(args.publishes, sites, devices)
+    # a skewed stream where a small set of hot topics repeats
+    hot = topics[:args.cache_size // 2]
+    hot_topics = [hot[i % len(hot)] for i in range(args.publishes)]
+
+    start = time.perf_counter()
+    uncached = TopicTrie(cache_size=0)
+    cached = TopicTrie(cache_size=args.cache_size)
+    for i, topic_filter in enumerate(filters):
+        uncached.subscribe(topic_filter, i)
+        cached.subscribe(topic_filter, i)
+    print(f"Built 2 tries with {len(uncached)} subscriptions in {time.perf_counter() - start:.2f}s")
+
+    bench("trie, no cache", uncached.match, topics)
+    bench("trie, cache, uniform", cached.match, topics)
+    cached.clear_cache()
+    bench("trie, cache, hot set", cached.match, hot_topics)
+
+    if args.linear:
+        indexed = list(enumerate(filters))
+        bench("linear scan", lambda t: [i for i, f in indexed if topic_matches(f, t)],
+              topics[:args.linear])
+
+    # the trade-off the numbers above show
+    print("A hit saves a trie walk, a miss adds a lookup and an insert. Uniform topics from a large\n"
+          f"space rarely repeat within {args.cache_size:,} entries: the trie stops filling a cache that\n"
+          "was hit less than once per entry, so that run stays near the uncached rate. A hot set\n"
+          "that fits the cache is where it pays off; match_cache_size=0 turns it off.")
+
+if __name__ == '__main__':
+    main()
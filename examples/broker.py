@@ -4,11 +4,18 @@ import os
 import signal
 import threading
 import logging
+from pathlib import Path
 
 # Add parent directory to Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.application.broker import MQTTBroker
+from src.application.async_broker import AsyncMQTTBroker
+from src.application.outbound import OVERFLOW_POLICIES
+from src.application.shared import SHARE_STRATEGIES
+from src.application.ratelimit import RateLimits
+from src.application.acl import ALLOW, DENY
+from src.application.cluster import run_workers
 
 def command_listener(broker):
     """监听命令行输入"""
@@ -23,10 +30,33 @@ def command_listener(broker):
                 broker.stop()
                 break
 
+            elif command == 'clients':
+                for client, stats in broker.client_stats().items():
+                    logger.info(f"  {client}: queue depth {stats['depth']}, "
+                                f"sent {stats['sent']}, dropped {stats['dropped']}, "
+                                f"throttled {stats.get('throttled', 0)}")
+
+            elif command == 'retained':
+                store = broker.retained
+                logger.info(f"  {len(store)} retained topics, {store.size} bytes, {store.evicted} evicted")
+
+            elif command == 'acl':
+                if broker.acl is None:
+                    logger.info("  No ACL file, every client may publish and subscribe to anything")
+                else:
+                    if broker.reload_acl():
+                        logger.info("  ACL file changed, rules reloaded")
+                    denied = broker.acl.denied
+                    logger.info(f"  {len(broker.acl)} rules from {broker.acl.path}, denied "
+                                f"{denied['publish']} publishes and {denied['subscribe']} subscriptions")
+
             elif command == 'help':
                 logger.info("Available commands:")
-                logger.info("  stop  - Stop the broker and exit")
-                logger.info("  help  - Show this help message")
+                logger.info("  stop    - Stop the broker and exit")
+                logger.info("  clients - Show outbound queue stats per client")
+                logger.info("  retained - Show retained message store usage")
+                logger.info("  acl     - Reload the ACL file if it changed and show denial counts")
+                logger.info("  help    - Show this help message")
 
             elif command:
                 logger.warning(f"Unknown command: {command}")
@@ -37,6 +67,17 @@ def command_listener(broker):
             broker.stop()
             break
 
+def topic_rate(spec: str):
+    """PREFIX=MESSAGES[,BYTES] of --topic-rate"""
+    prefix, sep, rates = spec.rpartition('=')
+    messages, _, size = rates.partition(',')
+    try:
+        if not sep:
+            raise ValueError
+        return prefix, (float(messages or 0), float(size or 0))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected PREFIX=MESSAGES[,BYTES], got {spec!r}")
+
 def main():
     parser = argparse.ArgumentParser(description='MQTT Broker')
     parser.add_argument('--host', default='',
@@ -45,6 +86,60 @@ def main():
                         help='Port to run the broker on')
     parser.add_argument('--log-level', default='INFO',
                         help='Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='Connection engine: one thread per client or a single asyncio event loop')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Broker processes sharing the port (thread engine, no console commands)')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='Outbound queue size per client')
+    parser.add_argument('--overflow-policy', choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICIES[0],
+                        help='What to do when a client\'s outbound queue is full')
+    parser.add_argument('--retained-limit', type=int, default=64,
+                        help='Memory cap for retained messages in MiB')
+    parser.add_argument('--session-dir',
+                        help='Directory for the persistent session log (sessions are kept in memory without it)')
+    parser.add_argument('--session-queue-size', type=int, default=1000,
+                        help='Messages queued per offline persistent session')
+    parser.add_argument('--message-ttl', type=float, default=3600,
+                        help='Seconds a queued offline message is kept')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Collect metrics and publish them on $SYS/broker/... topics')
+    parser.add_argument('--sys-interval', type=float, default=10,
+                        help='Seconds between $SYS metric updates')
+    parser.add_argument('--metrics-file',
+                        help='Also write metrics to this file in the Prometheus text format')
+    parser.add_argument('--share-strategy', choices=SHARE_STRATEGIES, default=SHARE_STRATEGIES[0],
+                        help='How $share/<group>/<filter> subscriptions pick the member for a message')
+    parser.add_argument('--compression', action='store_true',
+                        help='Grant payload compression to clients that ask for it at CONNECT')
+    parser.add_argument('--compression-dict', action='append', default=[],
+                        help='Shared compression dictionary file (see train_dictionary.py), repeatable')
+    parser.add_argument('--conflate', action='append', default=[], metavar='FILTER',
+                        help='Conflate matching topics for every subscriber, repeatable')
+    parser.add_argument('--conflate-interval', type=float, default=0,
+                        help='Seconds between deliveries of one --conflate topic to a subscriber')
+    parser.add_argument('--client-rate', type=float, default=0,
+                        help='Messages per second a connection may publish, reads pause above it')
+    parser.add_argument('--client-byte-rate', type=float, default=0,
+                        help='Payload bytes per second a connection may publish')
+    parser.add_argument('--topic-rate', type=topic_rate, action='append', default=[], metavar='PREFIX=MSGS[,BYTES]',
+                        help='Messages (and bytes) per second published under a topic prefix, repeatable')
+    parser.add_argument('--receive-maximum', type=int, default=0,
+                        help='Unsent acks of QoS 1/2 publishes after which a connection is not read')
+    parser.add_argument('--rate-burst', type=float, default=1.0,
+                        help='Seconds of rate a client may publish in one burst')
+    parser.add_argument('--stream-threshold', type=int, default=1024,
+                        help='KB above which publishes are relayed while they arrive (thread engine), 0 never')
+    parser.add_argument('--stream-dir',
+                        help='Directory for the temp files streamed payloads are spooled to')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='Append every inbound frame to FILE for benchmarks/replay_bench.py (FILE.worker-N with --workers)')
+    parser.add_argument('--acl', metavar='FILE',
+                        help='ACL rules, one "allow|deny publish|subscribe|all *|user:NAME|client:ID FILTER" per line')
+    parser.add_argument('--acl-default', choices=[DENY, ALLOW], default=DENY,
+                        help='Decision for topics no --acl rule matches')
+    parser.add_argument('--acl-reload-interval', type=float, default=2,
+                        help='Seconds between checks of the --acl file for changes')
     
     args = parser.parse_args()
     
@@ -52,7 +147,31 @@ def main():
     log_level = getattr(logging, args.log_level.upper(), logging.INFO)
     logging.basicConfig(level=log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     
-    broker = MQTTBroker(args.port, args.host, log_level=log_level)
+    rate_limits = None
+    if args.client_rate or args.client_byte_rate or args.topic_rate or args.receive_maximum:
+        rate_limits = RateLimits(args.client_rate, args.client_byte_rate, dict(args.topic_rate),
+                                 receive_maximum=args.receive_maximum, burst=args.rate_burst)
+    broker_options = dict(log_level=log_level, queue_size=args.queue_size,
+                          overflow_policy=args.overflow_policy,
+                          retained_limit=args.retained_limit * 1024 * 1024,
+                          session_dir=args.session_dir, session_queue_size=args.session_queue_size,
+                          message_ttl=args.message_ttl, metrics=args.metrics or bool(args.metrics_file),
+                          sys_interval=args.sys_interval, metrics_file=args.metrics_file,
+                          share_strategy=args.share_strategy, compression=args.compression,
+                          compression_dictionaries=[Path(path).read_bytes() for path in args.compression_dict],
+                          conflate_topics=args.conflate, conflate_interval=args.conflate_interval,
+                          rate_limits=rate_limits, stream_threshold=args.stream_threshold * 1024,
+                          stream_dir=args.stream_dir, capture_file=args.capture, acl_file=args.acl,
+                          acl_default=args.acl_default, acl_reload_interval=args.acl_reload_interval)
+
+    if args.workers > 1:
+        if args.engine != 'thread':
+            parser.error('--workers runs the thread engine in every worker')
+        logging.info(f"Starting {args.workers} MQTT broker workers on {args.host or '*'}:{args.port}")
+        sys.exit(1 if run_workers(args.workers, args.port, args.host, **broker_options) else 0)
+
+    broker_class = AsyncMQTTBroker if args.engine == 'asyncio' else MQTTBroker
+    broker = broker_class(args.port, args.host, **broker_options)
     
     def signal_handler(sig, frame):
         logging.info("Stopping broker...")
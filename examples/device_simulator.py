@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import sys
+import os
+import time
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.async_client import AsyncMQTTClient
+from src.protocol.packet import PROTOCOL_LEGACY, PROTOCOL_MQTT311
+
+async def device(args, index: int, stats: dict, deadline: float):
+    """One simulated device: connect, then publish telemetry every interval"""
+    client = AsyncMQTTClient(args.host, args.port, client_id=f'{args.prefix}-{index}', protocol=args.protocol)
+    # spread the connects and the publishes over one interval
+    await asyncio.sleep(index * args.interval / args.devices)
+    if not await client.connect():
+        stats['failed'] += 1
+        return
+    stats['connected'] += 1
+    topic = f'{args.prefix}/{index}/telemetry'
+    try:
+        while time.monotonic() < deadline:
+            payload = f'{{"device": {index}, "time": {time.time():.3f}}}'
+            if await client.publish(topic, payload, qos=args.qos):
+                stats['published'] += 1
+            else:
+                stats['unacked'] += 1
+            await asyncio.sleep(args.interval)
+    finally:
+        stats['reconnects'] += client.reconnects
+        await client.disconnect()
+
+async def run(args) -> dict:
+    stats = dict(connected=0, failed=0, published=0, unacked=0, reconnects=0)
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(device(args, i, stats, deadline) for i in range(args.devices)))
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate many MQTT devices from one asyncio process')
+    parser.add_argument('--host', default='localhost',
+                        help='Broker host')
+    parser.add_argument('--port', type=int, default=1883,
+                        help='Broker port')
+    parser.add_argument('--protocol', choices=[PROTOCOL_MQTT311, PROTOCOL_LEGACY], default=PROTOCOL_MQTT311,
+                        help='Wire format to speak to the broker')
+    parser.add_argument('--devices', type=int, default=1000,
+                        help='Number of device connections (mind the open file limit)')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='Seconds between publishes of one device')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='Seconds to run for')
+    parser.add_argument('--qos', type=int, choices=[0, 1], default=1,
+                        help='Publish QoS')
+    parser.add_argument('--prefix', default='devices',
+                        help='Client id and topic prefix')
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+    stats = asyncio.run(run(args))
+    elapsed = time.perf_counter() - start
+    print(f"devices connected   {stats['connected']} / {args.devices} ({stats['failed']} failed)")
+    print(f"published           {stats['published']:,} ({stats['published'] / elapsed:,.0f} msgs/sec)")
+    print(f"unacknowledged      {stats['unacked']:,}")
+    print(f"reconnects          {stats['reconnects']}")
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,14 @@ import argparse
 import sys
 import os
 import time
+from pathlib import Path
 
 # Add parent directory to Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.application.client import MQTTClient
+from src.protocol.packet import PROTOCOL_LEGACY, PROTOCOL_MQTT311
+from src.protocol.compression import PayloadCodec
 
 def main():
     parser = argparse.ArgumentParser(description='MQTT Publisher')
@@ -14,15 +17,35 @@ def main():
                         help='Broker host')
     parser.add_argument('--port', type=int, default=1883,
                         help='Broker port')
+    parser.add_argument('--protocol', choices=[PROTOCOL_MQTT311, PROTOCOL_LEGACY], default=PROTOCOL_MQTT311,
+                        help='Wire format to speak to the broker')
     parser.add_argument('--topic', required=True,
                         help='Topic to publish to')
-    parser.add_argument('--message', required=True,
+    parser.add_argument('--username',
+                        help='Username sent at CONNECT, for the broker\'s ACL rules')
+    parser.add_argument('--password',
+                        help='Password sent at CONNECT')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--message',
                         help='Message to publish')
+    source.add_argument('--file',
+                        help='File to publish as the payload, streamed with sendfile')
     parser.add_argument('--interval', type=int, default=5,
                         help='Publishing interval in seconds')
+    parser.add_argument('--compress', action='store_true',
+                        help='Ask the broker for payload compression')
+    parser.add_argument('--compression-dict',
+                        help='Shared compression dictionary file, the broker must have it too')
+    parser.add_argument('--compression-threshold', type=int, default=256,
+                        help='Payloads shorter than this many bytes are sent uncompressed')
 
     args = parser.parse_args()
-    client = MQTTClient(args.host, args.port)
+    compression = None
+    if args.compress:
+        dictionary = Path(args.compression_dict).read_bytes() if args.compression_dict else None
+        compression = PayloadCodec(args.compression_threshold, dictionary=dictionary)
+    client = MQTTClient(args.host, args.port, protocol=args.protocol, compression=compression,
+                        username=args.username, password=args.password and args.password.encode())
     
     if not client.connect():
         print("Failed to connect to broker")
@@ -32,7 +55,11 @@ def main():
 
     try:
         while True:
-            if client.publish(args.topic, args.message):
+            if args.file:
+                published = client.publish_stream(args.topic, args.file)
+            else:
+                published = client.publish(args.topic, args.message)
+            if published:
                 print(f"Published message to {args.topic}")
             else:
                 print("Failed to publish message")
@@ -1,26 +1,86 @@
 import argparse
 import sys
 import os
+from pathlib import Path
 
 # Add parent directory to Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.application.client import MQTTClient
+from src.protocol.packet import PROTOCOL_LEGACY, PROTOCOL_MQTT311
+from src.protocol.dispatch import DISPATCH_MODES, PROCESS, create_dispatcher
+from src.protocol.compression import PayloadCodec
+from src.protocol.stream import PayloadStream
 
 def message_handler(topic: str, payload: bytes):
     print(f"Received message on {topic}: {payload.decode()}")
 
+def stream_handler(save_dir: str):
+    """message_handler that writes streamed payloads to files in ``save_dir``"""
+    count = [0]
+
+    def handle(topic: str, payload):
+        if isinstance(payload, PayloadStream):
+            count[0] += 1
+            path = payload.spill(os.path.join(save_dir, f"{topic.replace('/', '_')}-{count[0]}"))
+            print(f"Received {len(payload)} bytes on {topic}, saved to {path}")
+        else:
+            message_handler(topic, payload)
+    return handle
+
 def main():
     parser = argparse.ArgumentParser(description='MQTT Subscriber')
     parser.add_argument('--host', default='localhost',
                         help='Broker host')
     parser.add_argument('--port', type=int, default=1883,
                         help='Broker port')
+    parser.add_argument('--protocol', choices=[PROTOCOL_MQTT311, PROTOCOL_LEGACY], default=PROTOCOL_MQTT311,
+                        help='Wire format to speak to the broker')
     parser.add_argument('--topic', required=True,
                         help='Topic to subscribe to')
+    parser.add_argument('--client-id', default='',
+                        help='Client identifier, required with --persistent')
+    parser.add_argument('--username',
+                        help='Username sent at CONNECT, for the broker\'s ACL rules')
+    parser.add_argument('--password',
+                        help='Password sent at CONNECT')
+    parser.add_argument('--persistent', action='store_true',
+                        help='Keep the session and queue messages while disconnected')
+    parser.add_argument('--dispatch', choices=DISPATCH_MODES, default=DISPATCH_MODES[0],
+                        help='Run message handlers on the receiving thread, a thread pool or a process pool')
+    parser.add_argument('--dispatch-workers', type=int, default=4,
+                        help='Handler threads or processes; messages of one topic stay in order')
+    parser.add_argument('--compress', action='store_true',
+                        help='Ask the broker for payload compression')
+    parser.add_argument('--compression-dict',
+                        help='Shared compression dictionary file, the broker must have it too')
+    parser.add_argument('--compression-threshold', type=int, default=256,
+                        help='Payloads shorter than this many bytes are sent uncompressed')
+    parser.add_argument('--conflate', type=int, metavar='MS',
+                        help='Only receive the newest message per topic, at most one per MS milliseconds')
+    parser.add_argument('--stream-threshold', type=int, default=1024,
+                        help='KB above which payloads are streamed to a temp file instead of memory, 0 never')
+    parser.add_argument('--save-dir', default='.',
+                        help='Directory streamed payloads are saved to')
     
     args = parser.parse_args()
-    client = MQTTClient(args.host, args.port)
+    topic = args.topic
+    if args.conflate is not None:
+        topic = f'$conflate/{args.conflate}/{topic}'
+    compression = None
+    if args.compress:
+        dictionary = Path(args.compression_dict).read_bytes() if args.compression_dict else None
+        compression = PayloadCodec(args.compression_threshold, dictionary=dictionary)
+    # streamed payloads live in temp files, which cannot be handed to handler processes
+    streaming = args.stream_threshold and args.dispatch != PROCESS
+    handler = stream_handler(args.save_dir) if streaming else message_handler
+    client = MQTTClient(args.host, args.port, protocol=args.protocol, client_id=args.client_id,
+                        clean_session=not args.persistent,
+                        dispatcher=create_dispatcher(args.dispatch, args.dispatch_workers),
+                        compression=compression, stream_threshold=args.stream_threshold * 1024 if streaming else 0,
+                        username=args.username, password=args.password and args.password.encode())
+    # messages queued while a persistent session was offline arrive right after connecting
+    client.on_message = handler
     
     if not client.connect():
         print("Failed to connect to broker")
@@ -28,8 +88,8 @@ def main():
 
     print(f"Connected to broker at {args.host}:{args.port}")
     
-    if client.subscribe(args.topic, message_handler):
-        print(f"Subscribed to {args.topic}")
+    if client.subscribe(topic, handler):
+        print(f"Subscribed to {topic}")
         try:
             input("Press Enter to exit...\n")
         except KeyboardInterrupt:
@@ -0,0 +1,38 @@
+import argparse
+import sys
+import os
+from pathlib import Path
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.protocol.compression import PayloadCodec, dictionary_id, train_dictionary
+
+def main():
+    parser = argparse.ArgumentParser(description='Train a shared payload compression dictionary')
+    parser.add_argument('samples', nargs='+',
+                        help='Sample payload files')
+    parser.add_argument('--lines', action='store_true',
+                        help='Each line of a sample file is one payload (JSON lines)')
+    parser.add_argument('--size', type=int, default=32 * 1024,
+                        help='Dictionary size in bytes, deflate uses at most 32 KB')
+    parser.add_argument('--output', required=True,
+                        help='Dictionary file to write')
+
+    args = parser.parse_args()
+    samples = []
+    for path in args.samples:
+        data = Path(path).read_bytes()
+        samples.extend(line for line in data.splitlines() if line) if args.lines else samples.append(data)
+    dictionary = train_dictionary(samples, size=args.size)
+    Path(args.output).write_bytes(dictionary)
+    print(f"Wrote {len(dictionary)} byte dictionary {dictionary_id(dictionary):#010x} from {len(samples)} samples")
+
+    # how the samples compress with and without it
+    total = sum(len(sample) for sample in samples)
+    for name, codec in (('deflate', PayloadCodec(0)), ('deflate + dictionary', PayloadCodec(0, dictionary=dictionary))):
+        size = sum(len(codec.encode(sample)) for sample in samples)
+        print(f"{name:<22} {size / total:>6.1%} of the original size")
+
+if __name__ == '__main__':
+    main()
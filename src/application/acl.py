@@ -0,0 +1,292 @@
+import os
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from ..protocol.topic import TopicTrie, validate_filter, SINGLE_LEVEL, MULTI_LEVEL
+
+ALLOW = 'allow'
+DENY = 'deny'
+PUBLISH = 'publish'
+SUBSCRIBE = 'subscribe'
+ACTIONS = (PUBLISH, SUBSCRIBE)
+
+# who a rule applies to: everyone, or one username or client id
+ANYONE = '*'
+USER_PREFIX = 'user:'
+CLIENT_PREFIX = 'client:'
+
+# substituted in a rule's filter with the connection's username and client id
+USERNAME_PATTERN = '%u'
+CLIENT_ID_PATTERN = '%c'
+
+
+class AclRule(NamedTuple):
+    decision: str
+    actions: Tuple[str, ...]
+    principal: str
+    topic_filter: str
+    # where it was read from, for error messages
+    line: int = 0
+
+    @property
+    def pattern(self) -> bool:
+        return USERNAME_PATTERN in self.topic_filter or CLIENT_ID_PATTERN in self.topic_filter
+
+
+def parse_rules(lines: Iterable[str], source: str = '<rules>') -> List[AclRule]:
+    """Parse ``DECISION ACTION PRINCIPAL FILTER`` lines.
+
+    DECISION is allow or deny, ACTION publish, subscribe or all, PRINCIPAL
+    ``*``, ``user:<name>`` or ``client:<id>``; the filter is the rest of the
+    line. Blank lines and lines starting with ``#`` are skipped. Raises
+    ValueError naming the first bad line.
+    """
+    rules = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split(None, 3)
+        if len(fields) != 4:
+            raise ValueError(f"{source}:{number}: expected DECISION ACTION PRINCIPAL FILTER")
+        decision, action, principal, topic_filter = fields
+        if decision not in (ALLOW, DENY):
+            raise ValueError(f"{source}:{number}: unknown decision {decision!r}")
+        if action == 'all':
+            actions = ACTIONS
+        elif action in ACTIONS:
+            actions = (action,)
+        else:
+            raise ValueError(f"{source}:{number}: unknown action {action!r}")
+        if principal != ANYONE and not (principal.startswith(USER_PREFIX) or principal.startswith(CLIENT_PREFIX)):
+            raise ValueError(f"{source}:{number}: principal must be *, user:<name> or client:<id>")
+        # a placeholder stands for one topic level
+        if not validate_filter(topic_filter.replace(USERNAME_PATTERN, 'u').replace(CLIENT_ID_PATTERN, 'c')):
+            raise ValueError(f"{source}:{number}: invalid topic filter {topic_filter!r}")
+        rules.append(AclRule(decision, actions, principal, topic_filter, number))
+    return rules
+
+
+def _substitute(topic_filter: str, username: Optional[str], client_id: str) -> Optional[str]:
+    """A pattern filter for one connection, None if it cannot apply to it"""
+    for placeholder, value in ((USERNAME_PATTERN, username), (CLIENT_ID_PATTERN, client_id)):
+        if placeholder not in topic_filter:
+            continue
+        # a name must not widen the filter
+        if not value or SINGLE_LEVEL in value or MULTI_LEVEL in value or '/' in value:
+            return None
+        topic_filter = topic_filter.replace(placeholder, value)
+    return topic_filter
+
+
+def _principals(username: Optional[str], client_id: str) -> Tuple[str, ...]:
+    principals = (ANYONE, CLIENT_PREFIX + client_id)
+    if username is not None:
+        principals += (USER_PREFIX + username,)
+    return principals
+
+
+class RuleSet:
+    """Rules compiled into one topic trie per principal and action.
+
+    Trie entries are the decisions (ALLOW, DENY) of the rules whose filter
+    ends at a node, so a lookup walks the levels of one topic in the tries
+    of the connection's own principals, however many rules there are.
+    Pattern rules are compiled per connection, once its names are known.
+    """
+
+    def __init__(self, rules: List[AclRule]):
+        self.rules = rules
+        # (principal, action) -> TopicTrie of decisions
+        self.tries: Dict[Tuple[str, str], TopicTrie] = {}
+        self.patterns: List[AclRule] = []
+        for rule in rules:
+            if rule.pattern:
+                self.patterns.append(rule)
+                continue
+            for action in rule.actions:
+                trie = self.tries.get((rule.principal, action))
+                if trie is None:
+                    # connections cache their decisions, the tries need not
+                    trie = self.tries[rule.principal, action] = TopicTrie(cache_size=0)
+                trie.subscribe(rule.topic_filter, rule.decision)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def compile(self, username: Optional[str], client_id: str) -> Dict[str, List[TopicTrie]]:
+        """action -> the tries of the rules that apply to a connection"""
+        principals = _principals(username, client_id)
+        tries = {action: [self.tries[principal, action] for principal in principals
+                          if (principal, action) in self.tries]
+                 for action in ACTIONS}
+        patterns = {}
+        for rule in self.patterns:
+            if rule.principal not in principals:
+                continue
+            topic_filter = _substitute(rule.topic_filter, username, client_id)
+            if topic_filter is None:
+                continue
+            for action in rule.actions:
+                trie = patterns.get(action)
+                if trie is None:
+                    trie = patterns[action] = TopicTrie(cache_size=0)
+                    tries[action].append(trie)
+                trie.subscribe(topic_filter, rule.decision)
+        return tries
+
+
+class _Decisions:
+    """The tries of one connection under one rule set, and the decisions made with them"""
+    __slots__ = ('rules', 'tries', 'published', 'subscribed')
+
+    def __init__(self, rules: RuleSet, tries: Dict[str, List[TopicTrie]]):
+        self.rules = rules
+        self.tries = tries
+        # topic / filter -> allowed
+        self.published: Dict[str, bool] = {}
+        self.subscribed: Dict[str, bool] = {}
+
+
+class ClientAccess:
+    """Authorization of one connection, cached per topic.
+
+    Decisions are kept in a bounded dict per action that starts over when
+    full. A reload of the rules is noticed on the next check, which
+    compiles the connection's tries again with empty caches; the state is
+    swapped whole, so a check racing a reload sees the old or new rules.
+    """
+    __slots__ = ('acl', 'username', 'client_id', '_decisions')
+
+    def __init__(self, acl: 'AccessControl', username: Optional[str], client_id: str):
+        self.acl = acl
+        self.username = username
+        self.client_id = client_id
+        self._decisions: Optional[_Decisions] = None
+
+    def may_publish(self, topic: str) -> bool:
+        decisions = self._current()
+        allowed = decisions.published.get(topic)
+        if allowed is None:
+            allowed = self._cache(decisions.published, topic, self._decide_publish(decisions.tries[PUBLISH], topic))
+        if not allowed:
+            self.acl.record(PUBLISH)
+        return allowed
+
+    def may_subscribe(self, topic_filter: str) -> bool:
+        """Whether the client may receive every topic ``topic_filter`` matches"""
+        decisions = self._current()
+        allowed = decisions.subscribed.get(topic_filter)
+        if allowed is None:
+            allowed = self._cache(decisions.subscribed, topic_filter,
+                                  self._decide_subscribe(decisions.tries[SUBSCRIBE], topic_filter))
+        if not allowed:
+            self.acl.record(SUBSCRIBE)
+        return allowed
+
+    def _current(self) -> _Decisions:
+        decisions = self._decisions
+        rules = self.acl.rules
+        if decisions is None or decisions.rules is not rules:
+            decisions = self._decisions = _Decisions(rules, rules.compile(self.username, self.client_id))
+        return decisions
+
+    def _cache(self, cache: Dict[str, bool], key: str, allowed: bool) -> bool:
+        size = self.acl.cache_size
+        if size:
+            if len(cache) >= size:
+                # full, start over
+                cache.clear()
+            cache[key] = allowed
+        return allowed
+
+    def _decide_publish(self, tries: List[TopicTrie], topic: str) -> bool:
+        # a deny anywhere wins over every allow
+        allowed = False
+        for trie in tries:
+            decisions = trie.match(topic)
+            if DENY in decisions:
+                return False
+            allowed = allowed or ALLOW in decisions
+        return allowed or self.acl.default == ALLOW
+
+    def _decide_subscribe(self, tries: List[TopicTrie], topic_filter: str) -> bool:
+        # allowed filters must cover the subscription, a denied one only overlap it
+        allowed = False
+        for trie in tries:
+            if DENY in trie.overlapping(topic_filter):
+                return False
+            allowed = allowed or ALLOW in trie.covering(topic_filter)
+        return allowed or self.acl.default == ALLOW
+
+
+class AccessControl:
+    """Which topics clients may publish and subscribe to, by username and client id.
+
+    Rules are read from ``path`` (see parse_rules) and compiled into a
+    RuleSet. A deny rule matching a topic wins over allow rules, and a
+    topic no rule matches gets ``default``. A subscription is allowed if
+    allow rules match every topic its filter matches and no deny rule
+    matches any of them. Usernames are taken as the client sends them.
+
+    reload() compiles the file again when it changed; connections see the
+    new rules on their next check. A file that does not parse leaves the
+    current rules in place.
+    """
+
+    def __init__(self, path: str = None, default: str = DENY, cache_size: int = 1024):
+        if default not in (ALLOW, DENY):
+            raise ValueError(f"Unknown default decision: {default}")
+        self.path = path
+        self.default = default
+        # decisions cached per connection and action
+        self.cache_size = cache_size
+        self.rules = RuleSet([])
+        self.generation = 0
+        self.denied = Counter()
+        self._stamp = None
+        self._lock = threading.Lock()
+        # the reload timer and a console command may check the file at once
+        self._reload_lock = threading.Lock()
+        if path is not None:
+            self.reload()
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def connect(self, username: Optional[str] = None, client_id: str = '') -> ClientAccess:
+        """Authorization for a connection with these names"""
+        return ClientAccess(self, username, client_id)
+
+    def load(self, rules: List[AclRule]):
+        """Compile and swap in a new rule set"""
+        compiled = RuleSet(rules)
+        with self._lock:
+            self.rules = compiled
+            self.generation += 1
+
+    def reload(self) -> bool:
+        """Load the rule file if it changed since it was last read.
+
+        Returns whether new rules were loaded. Raises OSError or ValueError
+        for a file that cannot be read; it is not tried again until it
+        changes.
+        """
+        with self._reload_lock:
+            stat = os.stat(self.path)
+            stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            if stamp == self._stamp:
+                return False
+            self._stamp = stamp
+            with open(self.path) as f:
+                rules = parse_rules(f, self.path)
+            self.load(rules)
+            return True
+
+    def record(self, action: str):
+        with self._lock:
+            self.denied[action] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {f'acl_denied_{action}': self.denied[action] for action in ACTIONS}
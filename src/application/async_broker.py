@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+from .broker import MQTTBroker
+from .outbound import AsyncOutboundQueue, flatten_frames
+from .ratelimit import RECEIVE_MAXIMUM
+from ..protocol.packet import PacketReader, PacketType
+
+
+class StreamConnection:
+    """Socket-like wrapper around an asyncio stream writer.
+
+    MQTTBroker routes to objects exposing ``send``/``close``, so a stream
+    connection can sit in the same routing tables as a thread-engine socket.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    def send(self, data) -> int:
+        self.writer.write(data)
+        return len(data)
+
+    def close(self):
+        self.writer.close()
+
+    def shutdown(self, how=None):
+        """Drop the connection without flushing buffered data"""
+        self.writer.transport.abort()
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+    def setsockopt(self, level, option, value):
+        self.writer.get_extra_info('socket').setsockopt(level, option, value)
+
+
+class AsyncMQTTBroker(MQTTBroker):
+    """MQTTBroker that serves every connection from a single event loop.
+
+    Publishes are read whole whatever their size: relaying a stream blocks
+    its writer, so stream_threshold does not apply here.
+    """
+    queue_class = AsyncOutboundQueue
+
+    def __init__(self, port: int, host: str = '', log_level=logging.INFO,
+                 backlog: int = 1024, read_size: int = 65536, **kwargs):
+        super().__init__(port, host, log_level=log_level, **kwargs)
+        self.backlog = backlog
+        self.read_size = read_size
+        self.connections = {}
+        self._loop = None
+        self._stop_event = None
+
+    def start(self):
+        """Run the event loop until stop() is called"""
+        self.running = True
+        self._start_timers()
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            if self.capture is not None:
+                self.capture.close()
+
+    def stop(self):
+        self.running = False
+        if self._loop and self._stop_event:
+            try:
+                self._loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                pass  # loop already closed
+        self.logger.info("MQTT Broker stopped")
+
+    @staticmethod
+    def write_stream(writer: asyncio.StreamWriter, frames):
+        """Hand a batch of frames to the transport, returns (calls, bytes) like write_frames"""
+        buffers = flatten_frames(frames)
+        writer.writelines(buffers)
+        return 1, sum(map(len, buffers))
+
+    def disconnect_idle(self, conn):
+        """Keep-alive timers fire on the wheel thread, the abort runs on the loop"""
+        self.logger.info(f"Keep-alive timeout, disconnecting {conn.getpeername()}")
+        try:
+            self._loop.call_soon_threadsafe(conn.shutdown)
+        except RuntimeError:
+            pass  # loop already closed
+
+    def release_conflated(self, queue, topic: str, interval: float):
+        """Conflation timers fire on the wheel thread, queues are fed from the loop"""
+        try:
+            self._loop.call_soon_threadsafe(super().release_conflated, queue, topic, interval)
+        except RuntimeError:
+            pass  # loop already closed
+
+    def publish_metrics(self):
+        """Metrics timers fire on the wheel thread, queues are fed from the loop"""
+        try:
+            self._loop.call_soon_threadsafe(super().publish_metrics)
+        except (AttributeError, RuntimeError):
+            pass  # loop not started or already closed
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        if not self.running:
+            return
+
+        server = await asyncio.start_server(
+            self._handle_stream, self.host or None, self.port,
+            backlog=self.backlog, reuse_address=True)
+        self.logger.info(f"MQTT Broker started on port {self.port} (asyncio engine)")
+        async with server:
+            await self._stop_event.wait()
+        # closing the transports ends every handler's read loop
+        handlers = list(self.connections.values())
+        for conn in list(self.connections):
+            conn.close()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    async def _handle_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        conn = StreamConnection(writer)
+        client_address = conn.getpeername()
+        self.connections[conn] = asyncio.current_task()
+        self.logger.info(f"New client connected from {client_address}")
+        queue = self.register_client(conn)
+        write_task = asyncio.create_task(self._write_loop_async(conn, queue))
+        # idle connections keep only a small buffer, it grows with traffic
+        packets_reader = PacketReader(buffer_size=1024, keep_raw=True)
+        limits = self.client_limits.get(conn)
+        capture = self.capture
+        try:
+            while self.running:
+                data = await reader.read(self.read_size)
+                if not data:
+                    break
+                self.touch(conn)
+                packets = packets_reader.feed(data)
+                if capture is not None:
+                    capture.record(conn, packets)
+                if limits is None:
+                    handled = all(self.handle_packet(conn, packet) for packet in packets)
+                else:
+                    handled = await self.handle_limited_async(conn, packets, queue, limits)
+                if not handled:
+                    self.logger.info(f"Client {client_address} disconnected gracefully")
+                    break
+        except ConnectionError:
+            pass
+        except Exception as e:
+            self.logger.error(f"Client handling error: {e}")
+        finally:
+            self.connections.pop(conn, None)
+            self.remove_client(conn)
+            await write_task
+            self.logger.info(f"Connection closed for client {client_address}")
+
+    async def handle_limited_async(self, conn, packets, queue: AsyncOutboundQueue, limits) -> bool:
+        """handle_packet for each packet, not reading the stream while a publish is over the limits"""
+        for packet in packets:
+            if packet.packet_type == PacketType.PUBLISH:
+                delay = self.publish_delay(limits, packet)
+                if delay:
+                    await asyncio.sleep(delay)
+                if self.awaits_acks(queue, packet):
+                    start = time.monotonic()
+                    await queue.wait_acked_async(self.rate_limits.receive_maximum)
+                    self.rate_limits.record(limits, RECEIVE_MAXIMUM, time.monotonic() - start)
+            if not self.handle_packet(conn, packet):
+                return False
+        return True
+
+    async def _write_loop_async(self, conn: StreamConnection, queue: AsyncOutboundQueue):
+        """Drain the client's outbound queue into its stream"""
+        try:
+            while True:
+                frames = await queue.get_batch_async(self.write_batch)
+                if frames is None:
+                    break
+                queue.writes += self.write_stream(conn.writer, frames)[0]
+                await conn.writer.drain()
+        except ConnectionError as e:
+            self.logger.debug(f"Writer stopped: {e}")
+        finally:
+            if queue.overflowed:
+                self.logger.warning("Disconnecting slow consumer: outbound queue full")
+            # ends the read loop if it is still running
+            conn.close()
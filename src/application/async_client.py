@@ -0,0 +1,454 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, NamedTuple, Optional, Union
+from ..protocol.packet import (MQTTPacket, PacketType, PacketReader, PROTOCOL_LEGACY, PROTOCOL_MQTT311,
+                               CONNACK_ACCEPTED, SUBACK_FAILURE, ack_frame, control_frame)
+from ..protocol.topic import match_filter, topic_matches
+from ..protocol.compression import PayloadCodec
+
+
+class Message(NamedTuple):
+    topic: str
+    payload: bytes
+    qos: int = 0
+    retain: bool = False
+
+
+class Subscription:
+    """Messages for one subscribe call, used with ``async with`` and ``async for``.
+
+    Messages wait in a bounded queue. A consumer that falls behind loses the
+    oldest ones (counted in ``dropped``) instead of stalling every other
+    subscription on the connection. Iteration ends when the subscription or
+    the client is closed.
+    """
+
+    def __init__(self, client: 'AsyncMQTTClient', topic_filter: str, qos: int = 0, queue_size: int = 1000):
+        self.client = client
+        self.topic_filter = topic_filter
+        self.qos = qos
+        # the filter topics are matched with, without a $share/<group>/ prefix
+        self.match = match_filter(topic_filter)
+        self.dropped = 0
+        self.closed = False
+        self._queue: asyncio.Queue = asyncio.Queue(queue_size)
+
+    async def __aenter__(self) -> 'Subscription':
+        await self.client._add_subscription(self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Message:
+        if self.closed and self._queue.empty():
+            raise StopAsyncIteration
+        message = await self._queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self):
+        if self.closed:
+            return
+        self._end()
+        await self.client._remove_subscription(self)
+
+    def _deliver(self, message: Optional[Message]):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(message)
+
+    def _end(self):
+        """Stop the iteration once the queued messages are consumed"""
+        if not self.closed:
+            self.closed = True
+            self._deliver(None)
+
+
+class AsyncMQTTClient:
+    """MQTT client for asyncio applications.
+
+    A connection is a reader task and a keep-alive timer on the event loop,
+    without threads, so one process can run thousands of clients. Concurrent
+    ``publish`` calls are pipelined on the connection, with up to
+    ``max_inflight`` QoS 1 publishes waiting for their PUBACK.
+
+    With ``reconnect`` a lost connection is re-established with exponential
+    backoff; subscriptions are renewed and unacknowledged publishes are
+    resent with DUP set, so their ``publish`` calls still complete.
+    """
+
+    def __init__(self, host: str, port: int, client_id: str = '', max_inflight: int = 64,
+                 protocol: str = PROTOCOL_MQTT311, clean_session: bool = True, keep_alive: int = 30,
+                 ack_timeout: float = 10.0, reconnect: bool = True, reconnect_delay: float = 0.5,
+                 max_reconnect_delay: float = 30.0, queue_size: int = 1000,
+                 compression: Optional[PayloadCodec] = None, username: Optional[str] = None,
+                 password: Optional[bytes] = None):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.max_inflight = max_inflight
+        self.protocol = protocol
+        self.clean_session = clean_session
+        # sent in CONNECT, the broker's ACL rules may be keyed by username
+        self.username = username
+        self.password = password
+        self.keep_alive = keep_alive
+        self.ack_timeout = ack_timeout
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        # messages queued per subscription before the oldest are dropped
+        self.queue_size = queue_size
+        # payload compression to offer the broker, used if the CONNACK grants it
+        self.compression = compression
+        # called for publishes no subscription matches, such as messages
+        # queued for a resumed session before it subscribes again
+        self.on_message: Optional[Callable[[Message], None]] = None
+        self.session_present = False
+        self.reconnects = 0
+        self.logger = logging.getLogger('AsyncMQTTClient')
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._ping_handle: Optional[asyncio.TimerHandle] = None
+        self._last_write = 0.0
+        self._connack: Optional[asyncio.Future] = None
+        self._codec: Optional[PayloadCodec] = None
+        self._plain_codec: Optional[PayloadCodec] = None
+        self._connected = asyncio.Event()
+        self._established = False
+        self._closing = False
+        # futures of every unacknowledged PUBLISH/SUBSCRIBE/UNSUBSCRIBE by packet id,
+        # and the publishes among them, which are resent after reconnecting
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._inflight: Dict[int, MQTTPacket] = {}
+        self._window = asyncio.Semaphore(max_inflight)
+        self._next_id = 0
+        self._subscriptions: Dict[str, List[Subscription]] = {}
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    @property
+    def inflight(self) -> int:
+        """Number of publishes sent and not yet acknowledged"""
+        return len(self._inflight)
+
+    async def __aenter__(self) -> 'AsyncMQTTClient':
+        if not await self.connect():
+            raise ConnectionError(f"Could not connect to {self.host}:{self.port}")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect()
+
+    async def connect(self) -> bool:
+        """Connect and wait for the CONNACK, returns False if that fails"""
+        self._loop = asyncio.get_running_loop()
+        self._closing = False
+        try:
+            await self._open()
+        except (OSError, asyncio.TimeoutError) as e:
+            self.logger.warning(f"Connection error: {e}")
+            return False
+        self._established = True
+        self._connected.set()
+        return True
+
+    async def disconnect(self):
+        self._closing = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        if self._writer is not None and not self._writer.is_closing():
+            self._write(control_frame(PacketType.DISCONNECT, self.protocol))
+            self._writer.close()
+        if self._read_task:
+            await asyncio.gather(self._read_task, return_exceptions=True)
+        # ends the subscriptions kept for a reconnect that was in progress
+        self._connection_lost()
+
+    async def publish(self, topic: str, payload: Union[str, bytes], qos: int = 1,
+                      retain: bool = False) -> bool:
+        """Publish and wait for the broker's acknowledgment.
+
+        Returns False if the client is not connected within ``ack_timeout``,
+        or the PUBACK does not arrive within it. QoS 0 publishes return once
+        they are written (the legacy format acknowledges every publish).
+        """
+        if qos not in (0, 1):
+            raise ValueError(f"Unsupported QoS for publish: {qos}")
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if not await self._wait_connected():
+            return False
+        if self._codec:
+            payload = self._codec.encode(payload)
+        if qos == 0 and self.protocol != PROTOCOL_LEGACY:
+            self._send(MQTTPacket(PacketType.PUBLISH, topic=topic, payload=payload, retain=retain))
+            await self._drain()
+            return True
+
+        async with self._window:
+            packet_id = self._allocate_id()
+            packet = MQTTPacket(PacketType.PUBLISH, topic=topic, payload=payload, packet_id=packet_id,
+                                qos=1, retain=retain)
+            future = self._pending[packet_id] = self._loop.create_future()
+            self._inflight[packet_id] = packet
+            try:
+                # a publish not written now is resent once reconnected
+                self._send(packet)
+                await self._drain()
+                return await asyncio.wait_for(future, self.ack_timeout)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self._pending.pop(packet_id, None)
+                self._inflight.pop(packet_id, None)
+
+    def subscribe(self, topic_filter: str, qos: int = 0, queue_size: Optional[int] = None) -> Subscription:
+        """Subscription to ``topic_filter``, subscribed on entering ``async with``.
+
+        Entering raises ConnectionError if the client cannot reach the broker
+        and RuntimeError if the broker refuses the filter.
+        """
+        return Subscription(self, topic_filter, qos, queue_size or self.queue_size)
+
+    async def _add_subscription(self, subscription: Subscription):
+        subscriptions = self._subscriptions.setdefault(subscription.topic_filter, [])
+        subscriptions.append(subscription)
+        if len(subscriptions) > 1:
+            return
+        try:
+            if not await self._wait_connected():
+                raise ConnectionError(f"Not connected, could not subscribe to {subscription.topic_filter}")
+            ack = await self._request(MQTTPacket(PacketType.SUBSCRIBE, topic=subscription.topic_filter,
+                                                 qos=subscription.qos))
+            if ack is not None and SUBACK_FAILURE in (ack.return_codes or ()):
+                raise RuntimeError(f"Subscription to {subscription.topic_filter} refused")
+            if ack is None and not self.reconnect:
+                raise ConnectionError(f"No SUBACK for {subscription.topic_filter}")
+            # without an ack the subscription is renewed after reconnecting
+        except BaseException:
+            subscription._end()
+            self._discard(subscription)
+            raise
+
+    async def _remove_subscription(self, subscription: Subscription):
+        if self._discard(subscription) and self.connected:
+            await self._request(MQTTPacket(PacketType.UNSUBSCRIBE, topic=subscription.topic_filter))
+
+    def _discard(self, subscription: Subscription) -> bool:
+        """Forget a subscription, returns True if it was the last one on its filter"""
+        subscriptions = self._subscriptions.get(subscription.topic_filter, [])
+        if subscription in subscriptions:
+            subscriptions.remove(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.topic_filter]
+                return True
+        return False
+
+    async def _open(self):
+        """Open the connection and wait for an accepting CONNACK"""
+        reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                      self.ack_timeout)
+        self._connack = self._loop.create_future()
+        self._read_task = asyncio.create_task(self._read_loop(reader))
+        self._send(MQTTPacket(PacketType.CONNECT, client_id=self.client_id, keep_alive=self.keep_alive,
+                              clean_session=self.clean_session, username=self.username, password=self.password,
+                              compression=self.compression.dictionary_id if self.compression else None))
+        try:
+            ack = await asyncio.wait_for(self._connack, self.ack_timeout)
+            if ack.return_code != CONNACK_ACCEPTED:
+                raise ConnectionRefusedError(f"Connection refused, CONNACK return code {ack.return_code}")
+        except BaseException:
+            self._writer.close()
+            raise
+        self.session_present = ack.session_present
+        self._ping_handle = self._loop.call_later(self.keep_alive, self._ping)
+
+    async def _reconnect(self):
+        delay = self.reconnect_delay
+        codec = self._codec
+        while not self._closing:
+            await asyncio.sleep(delay)
+            try:
+                await self._open()
+            except (OSError, asyncio.TimeoutError) as e:
+                delay = min(delay * 2, self.max_reconnect_delay)
+                self.logger.debug(f"Reconnect failed, retrying in {delay:.1f}s: {e}")
+                continue
+            self.reconnects += 1
+            self.logger.info(f"Reconnected to {self.host}:{self.port}")
+            # renew subscriptions before resending, the acks are not awaited
+            for topic_filter, subscriptions in self._subscriptions.items():
+                self._track(MQTTPacket(PacketType.SUBSCRIBE, topic=topic_filter, qos=subscriptions[0].qos))
+            for packet in list(self._inflight.values()):
+                packet.dup = True
+                if self._codec is not codec:
+                    # compressed for the previous connection
+                    payload = codec.decode(packet.payload) if codec else packet.payload
+                    packet.payload = self._codec.encode(payload) if self._codec else payload
+                self._send(packet)
+            self._connected.set()
+            return
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        # idle connections keep only a small buffer, it grows with traffic
+        packets = PacketReader(buffer_size=1024, protocol=self.protocol)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for packet in packets.feed(data):
+                    self._handle_packet(packet)
+        except (OSError, ValueError) as e:
+            if not self._closing:
+                self.logger.warning(f"Receive error: {e}")
+        finally:
+            self._connection_lost()
+
+    def _connection_lost(self):
+        self._connected.clear()
+        if self._ping_handle:
+            self._ping_handle.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._connack is not None and not self._connack.done():
+            self._connack.set_exception(ConnectionResetError("Connection closed before CONNACK"))
+        resume = self.reconnect and self._established and not self._closing
+        for packet_id, future in list(self._pending.items()):
+            # publishes wait for the reconnect, they are resent then
+            if resume and packet_id in self._inflight:
+                continue
+            del self._pending[packet_id]
+            if not future.done():
+                future.set_result(False if packet_id in self._inflight else None)
+        if not resume:
+            for subscriptions in list(self._subscriptions.values()):
+                for subscription in subscriptions:
+                    subscription._end()
+        elif self._reconnect_task is None or self._reconnect_task.done():
+            self.logger.warning(f"Connection to {self.host}:{self.port} lost, reconnecting")
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    def _handle_packet(self, packet: MQTTPacket):
+        packet_type = packet.packet_type
+        if packet_type == PacketType.PUBLISH:
+            if packet.qos:
+                ack_type = PacketType.PUBACK if packet.qos == 1 else PacketType.PUBREC
+                self._write(ack_frame(ack_type, packet.packet_id, self.protocol))
+            payload = packet.payload or b''
+            if self._codec:
+                try:
+                    payload = self._codec.decode(payload)
+                except ValueError as e:
+                    self.logger.warning(f"Dropping publish to {packet.topic}: {e}")
+                    return
+            self._dispatch(Message(packet.topic, payload, packet.qos, packet.retain))
+        elif packet_type in (PacketType.PUBACK, PacketType.SUBACK, PacketType.UNSUBACK):
+            future = self._pending.pop(packet.packet_id, None)
+            if future is not None and not future.done():
+                future.set_result(True if packet_type == PacketType.PUBACK else packet)
+        elif packet_type == PacketType.CONNACK:
+            if self._connack is not None and not self._connack.done():
+                # set before the publishes that may follow in the same read
+                self._codec = self._granted_codec(packet)
+                self._connack.set_result(packet)
+        elif packet_type == PacketType.PUBREL:
+            self._write(ack_frame(PacketType.PUBCOMP, packet.packet_id, self.protocol))
+        elif packet_type == PacketType.PINGREQ:
+            self._write(control_frame(PacketType.PINGRESP, self.protocol))
+
+    def _granted_codec(self, ack: MQTTPacket) -> Optional[PayloadCodec]:
+        if ack.compression is None or self.compression is None:
+            return None
+        if ack.compression == self.compression.dictionary_id:
+            return self.compression
+        # the broker does not know our dictionary
+        if self._plain_codec is None:
+            self._plain_codec = PayloadCodec(self.compression.threshold, self.compression.level)
+        return self._plain_codec
+
+    def _dispatch(self, message: Message):
+        delivered = False
+        for subscriptions in self._subscriptions.values():
+            if topic_matches(subscriptions[0].match, message.topic):
+                for subscription in subscriptions:
+                    subscription._deliver(message)
+                delivered = True
+        if not delivered and self.on_message:
+            try:
+                self.on_message(message)
+            except Exception as e:
+                self.logger.error(f"Message callback error: {e}")
+
+    async def _request(self, packet: MQTTPacket) -> Optional[MQTTPacket]:
+        """Send a SUBSCRIBE/UNSUBSCRIBE, returns its ack or None if none arrives"""
+        future = self._track(packet)
+        try:
+            return await asyncio.wait_for(future, self.ack_timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._pending.pop(packet.packet_id, None)
+
+    def _track(self, packet: MQTTPacket) -> asyncio.Future:
+        packet.packet_id = self._allocate_id()
+        future = self._pending[packet.packet_id] = self._loop.create_future()
+        self._send(packet)
+        return future
+
+    def _allocate_id(self) -> int:
+        """Next packet id in 1..65535 not waiting for an ack"""
+        while True:
+            self._next_id = self._next_id % 65535 + 1
+            if self._next_id not in self._pending:
+                return self._next_id
+
+    def _send(self, packet: MQTTPacket) -> bool:
+        """Write a packet if the connection is open, returns whether it was written"""
+        return self._write(packet.encode(self.protocol))
+
+    def _write(self, frame: bytes) -> bool:
+        if self._writer is None or self._writer.is_closing():
+            return False
+        self._writer.write(frame)
+        self._last_write = self._loop.time()
+        return True
+
+    async def _drain(self):
+        try:
+            await self._writer.drain()
+        except (OSError, AttributeError):
+            pass  # the reader notices the lost connection
+
+    async def _wait_connected(self) -> bool:
+        if self._connected.is_set():
+            return True
+        if not self._established or self._closing:
+            return False
+        try:
+            await asyncio.wait_for(self._connected.wait(), self.ack_timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _ping(self):
+        """Send PINGREQ once the connection has been idle for keep_alive seconds"""
+        if self._writer is None or self._writer.is_closing():
+            return
+        delay = self.keep_alive - (self._loop.time() - self._last_write)
+        if delay <= 0.05:
+            self._write(control_frame(PacketType.PINGREQ, self.protocol))
+            delay = self.keep_alive
+        self._ping_handle = self._loop.call_later(delay, self._ping)
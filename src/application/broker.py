@@ -1,14 +1,116 @@
+import socket
 import threading
+import time
 import logging
+from functools import partial
 from .server import MQTTServer
-from ..protocol.packet import PacketType, MQTTPacket
+from .outbound import OutboundQueue, Conflated, StreamFrame, DROP_OLDEST, write_frames
+from .session import Session, SessionStore
+from .shared import SharedGroup, ROUND_ROBIN
+from .ratelimit import RateLimits, RECEIVE_MAXIMUM, THROTTLE_REASONS
+from .capture import TrafficCapture
+from .acl import AccessControl, ACTIONS, DENY
+from .metrics import (Metrics, instrument, MESSAGES_RECEIVED, MESSAGES_SENT, BYTES_RECEIVED, BYTES_SENT,
+                      ROUTING_TIME, SEND_TIME)
+from ..protocol.packet import (PacketType, MQTTPacket, PacketReader, PROTOCOL_LEGACY, PROTOCOL_MQTT311,
+                               CONNACK_ACCEPTED, CONNACK_IDENTIFIER_REJECTED, SUBACK_FAILURE, ack_frame,
+                               control_frame, publish_prefix)
+from ..protocol.topic import (TopicTrie, match_filter, parse_conflated, parse_shared, validate_filter, validate_topic,
+                              SHARED_PREFIX)
+from ..protocol.retained import RetainedStore
+from ..protocol.compression import RAW_HEADER, decompress, dictionary_id, payload_dictionary
 
 class MQTTBroker(MQTTServer):
-    def __init__(self, port: int, host: str = '', log_level=logging.INFO):
+    queue_class = OutboundQueue
+    # an instance attribute when metrics wrap it
+    write_frames = staticmethod(write_frames)
+
+    def __init__(self, port: int, host: str = '', log_level=logging.INFO,
+                 match_cache_size: int = 4096, queue_size: int = 1000,
+                 overflow_policy: str = DROP_OLDEST, write_batch: int = 64,
+                 retained_limit: int = 64 * 1024 * 1024, session_dir: str = None,
+                 session_queue_size: int = 1000, message_ttl: float = 3600.0,
+                 metrics: bool = False, sys_interval: float = 10.0, metrics_file: str = None,
+                 share_strategy: str = ROUND_ROBIN, compression: bool = False,
+                 compression_dictionaries: list = None, conflate_topics: list = None,
+                 conflate_interval: float = 0.0, conflate_send_buffer: int = 16 * 1024,
+                 rate_limits: RateLimits = None, stream_threshold: int = 1024 * 1024, stream_dir: str = None,
+                 capture_file: str = None, acl_file: str = None, acl_default: str = DENY,
+                 acl_reload_interval: float = 2.0):
         super().__init__(port, host)
-        self.topics = {}
+        self.topics = TopicTrie(cache_size=match_cache_size)
+        # last retained publish per topic, capped at retained_limit bytes
+        self.retained = RetainedStore(max_bytes=retained_limit)
         self.client_topics = {}
+        # (group, filter) -> SharedGroup, each subscribed to its filter in the trie
+        self.shared_groups = {}
+        self.share_strategy = share_strategy
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        # most frames a writer coalesces into one vectored send
+        self.write_batch = write_batch
+        self.outbound = {}
+        # wire format of each connection, set by its CONNECT
+        self.client_protocols = {}
+        # QoS 2 packet ids received but not yet released, per connection
+        self.qos2_pending = {}
+        # payload compression granted per connection, as the shared
+        # dictionary id (0 for plain deflate); compressed publishes are
+        # forwarded as they are to connections that can read them
+        self.compression = compression
+        self.dictionaries = {dictionary_id(d): d for d in compression_dictionaries or ()}
+        self.client_compression = {}
+        # topics conflated for every subscriber: only the newest unsent
+        # publish per topic is kept in an outbound queue, and queued at most
+        # once per conflate_interval seconds; $conflate/<ms>/<filter>
+        # subscriptions do the same for one subscriber
+        self.conflate_topics = TopicTrie()
+        self.conflate_interval = conflate_interval
+        # kernel send buffer of conflating connections, so a slow reader
+        # backs up the outbound queue where stale frames can be replaced
+        self.conflate_send_buffer = conflate_send_buffer
+        for topic_filter in conflate_topics or ():
+            if not validate_filter(topic_filter):
+                raise ValueError(f"Invalid conflated topic filter: {topic_filter}")
+            self.conflate_topics.subscribe(topic_filter, True)
+        # publish limits, a connection over them is not read until it is under
+        self.rate_limits = rate_limits
+        self.client_limits = {}
+        self.count_acks = bool(rate_limits and rate_limits.receive_maximum)
+        # MQTT 3.1.1 publishes larger than this many bytes (0 never) are
+        # relayed while they arrive, spooled to a temp file in stream_dir,
+        # instead of being read whole first
+        self.stream_threshold = stream_threshold
+        self.stream_dir = stream_dir
+        # every inbound frame is appended to capture_file for replay_bench.py
+        self.capture = TrafficCapture(capture_file) if capture_file else None
+        # topics each username / client id may publish and subscribe to,
+        # read from acl_file and reloaded when it changes
+        self.acl = AccessControl(acl_file, acl_default) if acl_file else None
+        self.client_acl = {}
+        self.acl_reload_interval = acl_reload_interval
+        # clean_session=false sessions; an offline session subscribes in its
+        # client's place so matching publishes are queued for it
+        self.sessions = SessionStore(session_dir, max_queue=session_queue_size, message_ttl=message_ttl)
+        self.client_sessions = {}
+        self.session_clients = {}
+        # seconds between sweeps of expired offline messages
+        self.expiry_interval = 1.0
+        # taken by subscription changes and connects/disconnects only, the
+        # publish path reads the trie's copy-on-write subscriber sets
         self.topics_lock = threading.Lock()
+        # retained messages are set by publishes, so they have a lock of their own
+        self.retained_lock = threading.Lock()
+        # packet type -> handler, a handler returns False once the client disconnects
+        self.packet_handlers = {
+            PacketType.PUBLISH: self.handle_publish_packet,
+            PacketType.PUBREL: self.handle_pubrel,
+            PacketType.SUBSCRIBE: self.handle_subscribe,
+            PacketType.UNSUBSCRIBE: self.handle_unsubscribe,
+            PacketType.PINGREQ: self.handle_pingreq,
+            PacketType.CONNECT: self.handle_connect,
+            PacketType.DISCONNECT: self.handle_disconnect,
+        }
         self.running = False  # 添加running状态变量
         
         # Configure logger
@@ -20,6 +122,20 @@ class MQTTBroker(MQTTServer):
             handler.setFormatter(formatter)
             self.logger.addHandler(handler)
 
+        # $SYS topics and the Prometheus file are refreshed every sys_interval
+        self.metrics = Metrics() if metrics else None
+        self.sys_interval = sys_interval
+        self.metrics_file = metrics_file
+        self._last_metrics = None
+        if self.metrics:
+            instrument(self, self.metrics)
+
+        for session in self.sessions.sessions.values():
+            for topic_filter in session.subscriptions:
+                self._subscribe(topic_filter, session)
+        if len(self.sessions):
+            self.logger.info(f"Recovered {len(self.sessions)} persistent sessions")
+
     def set_log_level(self, level):
         """Set the logger level
         Args:
@@ -29,91 +145,810 @@ class MQTTBroker(MQTTServer):
 
     def start(self):
         self.running = True
+        self._start_timers()
         super().start()
         self.logger.info("MQTT Broker started")
 
     def stop(self):
         self.running = False
         super().stop()
+        self.sessions.flush()
+        if self.capture is not None:
+            self.capture.close()
         self.logger.info("MQTT Broker stopped")
 
+    def _start_timers(self):
+        self._schedule_expiry()
+        if self.acl is not None:
+            self._schedule_acl_reload()
+        if self.metrics:
+            self.timers.schedule(self.sys_interval, self._publish_metrics)
+
+    def _publish_metrics(self):
+        """Publish $SYS topics and write the Prometheus file, runs on the timer wheel"""
+        if not self.running:
+            return
+        try:
+            self.publish_metrics()
+        except Exception as e:
+            self.logger.error(f"Publishing metrics failed: {e}")
+        self.timers.schedule(self.sys_interval, self._publish_metrics)
+
+    def metric_gauges(self) -> dict:
+        depths = [queue.depth for queue in list(self.outbound.values())]
+        gauges = {
+            'clients_connected': len(depths),
+            'subscriptions': len(self.topics),
+            'retained_messages': len(self.retained),
+            'sessions': len(self.sessions),
+            'queue_depth': sum(depths),
+            'queue_depth_max': max(depths, default=0),
+            'uptime_seconds': int(time.time() - self.metrics.started),
+        }
+        if self.acl is not None:
+            gauges['acl_rules'] = len(self.acl)
+        return gauges
+
+    def publish_metrics(self):
+        """Publish a metrics snapshot as retained $SYS/broker/... messages"""
+        metrics = self.metrics
+        snapshot = metrics.snapshot()
+        if self.rate_limits is not None:
+            # throttling is counted by the limits, not the metric shards
+            snapshot['counters'].update(self.rate_limits.stats())
+        if self.acl is not None:
+            snapshot['counters'].update(self.acl.stats())
+        gauges = self.metric_gauges()
+        if self.metrics_file:
+            metrics.write_prometheus(self.metrics_file, snapshot, gauges)
+
+        now = time.monotonic()
+        counters, topics = snapshot['counters'], snapshot['topics']
+        previous, previous_topics, since = self._last_metrics or ({}, {}, now - self.sys_interval)
+        self._last_metrics = (counters, topics, now)
+        elapsed = max(now - since, 1e-9)
+
+        values = {
+            'messages/received': counters[MESSAGES_RECEIVED],
+            'messages/sent': counters[MESSAGES_SENT],
+            'bytes/received': counters[BYTES_RECEIVED],
+            'bytes/sent': counters[BYTES_SENT],
+            'load/messages/received': round((counters[MESSAGES_RECEIVED] -
+                                             previous.get(MESSAGES_RECEIVED, 0)) / elapsed, 1),
+            'load/messages/sent': round((counters[MESSAGES_SENT] -
+                                         previous.get(MESSAGES_SENT, 0)) / elapsed, 1),
+            'clients/connected': gauges['clients_connected'],
+            'subscriptions/count': gauges['subscriptions'],
+            'retained/count': gauges['retained_messages'],
+            'sessions/count': gauges['sessions'],
+            'queue/depth': gauges['queue_depth'],
+            'queue/max': gauges['queue_depth_max'],
+            'uptime': gauges['uptime_seconds'],
+        }
+        if self.rate_limits is not None:
+            for reason in THROTTLE_REASONS:
+                values[f'throttle/{reason}'] = counters[f'throttled_{reason}']
+            values['throttle/seconds'] = counters['throttled_seconds']
+        if self.acl is not None:
+            for action in ACTIONS:
+                values[f'acl/denied/{action}'] = counters[f'acl_denied_{action}']
+            values['acl/rules'] = gauges['acl_rules']
+        for name, key in (('routing', ROUTING_TIME), ('send', SEND_TIME)):
+            histogram = snapshot['histograms'].get(key)
+            if histogram:
+                for q in (0.5, 0.99):
+                    values[f'latency/{name}/p{int(q * 100)}'] = metrics.quantile(histogram, q) * 1000
+        # per-topic message rates of the busiest topics
+        rates = {topic: (count - previous_topics.get(topic, 0)) / elapsed for topic, count in topics.items()}
+        for topic, rate in sorted(rates.items(), key=lambda item: -item[1])[:10]:
+            if rate > 0:
+                values[f'topics/{topic}/rate'] = round(rate, 1)
+
+        for name, value in values.items():
+            packet = MQTTPacket(PacketType.PUBLISH, topic=f'$SYS/broker/{name}',
+                                payload=str(value).encode(), retain=True)
+            # not counted as client traffic, and kept local to this worker
+            MQTTBroker.handle_publish(self, packet)
+
+    def _schedule_expiry(self):
+        self.timers.schedule(self.expiry_interval, self._expire_sessions)
+
+    def _expire_sessions(self):
+        """Drop offline messages past their TTL, runs on the timer wheel"""
+        if not self.running:
+            return
+        with self.topics_lock:
+            expired = self.sessions.expire()
+        if expired:
+            self.logger.debug(f"Expired {expired} queued session messages")
+        self._schedule_expiry()
+
+    def _schedule_acl_reload(self):
+        self.timers.schedule(self.acl_reload_interval, self._reload_acl)
+
+    def _reload_acl(self):
+        """Pick up a changed ACL file, runs on the timer wheel"""
+        if not self.running:
+            return
+        self.reload_acl()
+        self._schedule_acl_reload()
+
+    def reload_acl(self) -> bool:
+        """Load the ACL file if it changed and drop the subscriptions it no longer allows"""
+        try:
+            if not self.acl.reload():
+                return False
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Keeping the current ACL rules: {e}")
+            return False
+        self.logger.info(f"Loaded {len(self.acl)} ACL rules from {self.acl.path}")
+        self.revoke_subscriptions()
+        return True
+
+    def revoke_subscriptions(self):
+        """Unsubscribe connected clients from filters the ACL rules deny them now"""
+        with self.topics_lock:
+            for client_socket, topic_filters in list(self.client_topics.items()):
+                access = self.client_acl.get(client_socket)
+                if access is None:
+                    continue
+                session = self.client_sessions.get(client_socket)
+                for topic_filter in [f for f in topic_filters if not access.may_subscribe(match_filter(f))]:
+                    self._unsubscribe(topic_filter, client_socket)
+                    topic_filters.discard(topic_filter)
+                    if session is not None:
+                        self.sessions.unsubscribe(session, topic_filter)
+                    self.logger.info(f"Revoked subscription to {topic_filter}")
+
     def handle_client(self, client_socket):
+        reader = PacketReader(keep_raw=True, stream_threshold=self.stream_threshold, stream_dir=self.stream_dir)
         try:
             client_address = client_socket.getpeername()
             self.logger.info(f"New client connected from {client_address}")
+            queue = self.register_client(client_socket)
+            writer = threading.Thread(target=self._write_loop, args=(client_socket, queue))
+            writer.daemon = True
+            writer.start()
+            limits = self.client_limits.get(client_socket)
+            handle = self.handle_packet
+            if limits is not None:
+                handle = partial(self.handle_limited, queue=queue, limits=limits)
+            capture = self.capture
             
             while self.running:
-                data = client_socket.recv(1024)
-                if not data:
+                packets = reader.read_from(client_socket)
+                if packets is None:
                     break
-                
-                packet = MQTTPacket.decode(data)
-                if packet.packet_type == PacketType.PUBLISH:
-                    self.handle_publish(packet)
-                    ack = MQTTPacket(PacketType.PUBACK)
-                    client_socket.send(ack.encode())
-                elif packet.packet_type == PacketType.SUBSCRIBE:
-                    self.handle_subscribe(client_socket, packet)
-                elif packet.packet_type == PacketType.PINGREQ:
-                    resp = MQTTPacket(PacketType.PINGRESP)
-                    client_socket.send(resp.encode())
-                elif packet.packet_type == PacketType.DISCONNECT:
+                self.touch(client_socket)
+                if capture is not None:
+                    capture.record(client_socket, packets)
+                if not all(handle(client_socket, packet) for packet in packets):
                     self.logger.info(f"Client {client_address} disconnected gracefully")
                     break
         except Exception as e:
             self.logger.error(f"Client handling error: {e}")
         finally:
+            # subscribers relaying a payload the client did not finish are cut off
+            reader.reset()
             self.remove_client(client_socket)
             self.logger.info(f"Connection closed for client {client_address}")
 
-    def handle_publish(self, packet):
+    def _write_loop(self, client_socket, queue):
+        """Drain the client's outbound queue onto its socket"""
+        try:
+            while True:
+                frames = queue.get_batch(self.write_batch)
+                if frames is None:
+                    break
+                queue.writes += self.write_frames(client_socket, frames)[0]
+        except OSError as e:
+            self.logger.debug(f"Writer stopped: {e}")
+        finally:
+            if queue.overflowed:
+                self.logger.warning("Disconnecting slow consumer: outbound queue full")
+            # wake the reader so the connection is cleaned up
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def disconnect_idle(self, client_socket):
+        """Shut down a client that missed its keep-alive deadline"""
+        try:
+            self.logger.info(f"Keep-alive timeout, disconnecting {client_socket.getpeername()}")
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def register_client(self, client_socket):
+        """Create the outbound queue for a new connection"""
+        queue = self.queue_class(self.queue_size, self.overflow_policy)
+        if self.conflate_topics:
+            self.limit_send_buffer(client_socket)
         with self.topics_lock:
-            self.logger.debug(f"Publishing to topic: {packet.topic}")
-            self.logger.debug(f"Active topics: {list(self.topics.keys())}")
-            
-            if packet.topic in self.topics:
-                # 直接使用原始数据转发，避免重新编码
-                raw_data = packet.raw_data if hasattr(packet, 'raw_data') else packet.encode()
-                
-                for client in list(self.topics[packet.topic]):
-                    try:
-                        client.send(raw_data)
-                        self.logger.debug(f"Raw message forwarded to subscriber for topic {packet.topic}")
-                    except Exception as e:
-                        self.logger.error(f"Failed to send to subscriber: {e}")
-                        self.remove_client(client)
+            self.outbound[client_socket] = queue
+            if self.rate_limits is not None:
+                self.client_limits[client_socket] = self.rate_limits.connect()
+            if self.acl is not None:
+                # nothing is allowed by name before the CONNECT
+                self.client_acl[client_socket] = self.acl.connect()
+        if self.capture is not None:
+            self.capture.opened(client_socket)
+        return queue
+
+    def limit_send_buffer(self, client_socket):
+        """Cap the kernel send buffer of a connection that gets conflated publishes"""
+        if not self.conflate_send_buffer:
+            return
+        try:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.conflate_send_buffer)
+        except OSError:
+            pass
+
+    def send_to(self, client_socket, frame, control: bool = False, ack: bool = False) -> bool:
+        """Queue a frame for a client without blocking on its socket"""
+        queue = self.outbound.get(client_socket)
+        if queue is None:
+            client_socket.send(b''.join(frame) if isinstance(frame, tuple) else frame)
+            return True
+        if queue.put(frame, control, ack):
+            return True
+        self._shed_overflowed(client_socket, queue)
+        return False
+
+    def send_latest(self, client_socket, topic: str, frame, interval: float = 0.0) -> bool:
+        """Queue a publish frame replacing an unsent one to the same topic.
+
+        With an ``interval`` the topic is queued at most once per that many
+        seconds, the newest frame in between is queued when it has passed.
+        """
+        queue = self.outbound.get(client_socket)
+        if queue is None:
+            return self.send_to(client_socket, frame)
+        delay = queue.put_latest(topic, frame, interval)
+        if delay is None:
+            self._shed_overflowed(client_socket, queue)
+            return False
+        if delay:
+            self.timers.schedule(delay, self.release_conflated, queue, topic, interval)
+        return True
+
+    def release_conflated(self, queue, topic: str, interval: float):
+        """Queue the frame held back for ``topic`` once its interval has passed"""
+        queue.release(topic, interval)
+
+    @staticmethod
+    def _shed_overflowed(client_socket, queue):
+        if queue.overflowed:
+            # the writer may be stuck on a full socket, so break it off here
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def client_stats(self) -> dict:
+        """Outbound queue depth and drop counters per connected client"""
+        stats = {}
+        for client_socket, queue in list(self.outbound.items()):
+            try:
+                name = client_socket.getpeername()
+            except OSError:
+                name = id(client_socket)
+            stats[name] = queue.stats()
+            limits = self.client_limits.get(client_socket)
+            if limits is not None:
+                stats[name].update(throttled=limits.throttled, throttled_seconds=round(limits.paused, 3))
+        return stats
+
+    def send_packet(self, client_socket, packet) -> bool:
+        """Encode a control packet in the client's wire format and queue it"""
+        protocol = self.client_protocols.get(client_socket, PROTOCOL_MQTT311)
+        return self.send_to(client_socket, packet.encode(protocol), control=True)
+
+    def send_ack(self, client_socket, packet_type, packet_id: int) -> bool:
+        """Queue a PUBACK/PUBREC/PUBCOMP/UNSUBACK in the client's wire format"""
+        protocol = self.client_protocols.get(client_socket, PROTOCOL_MQTT311)
+        # acks of inbound publishes count towards the receive maximum
+        return self.send_to(client_socket, ack_frame(packet_type, packet_id, protocol), control=True,
+                            ack=self.count_acks and packet_type in (PacketType.PUBACK, PacketType.PUBREC))
+
+    def handle_packet(self, client_socket, packet) -> bool:
+        """Handle one decoded packet, returns False once the client disconnects"""
+        handler = self.packet_handlers.get(packet.packet_type)
+        return handler is None or handler(client_socket, packet) is not False
+
+    def handle_limited(self, client_socket, packet, queue, limits) -> bool:
+        """handle_packet after pausing the connection's reads until its limits let a publish through"""
+        if packet.packet_type == PacketType.PUBLISH:
+            delay = self.publish_delay(limits, packet)
+            if delay:
+                time.sleep(delay)
+            if self.awaits_acks(queue, packet):
+                start = time.monotonic()
+                queue.wait_acked(self.rate_limits.receive_maximum)
+                self.rate_limits.record(limits, RECEIVE_MAXIMUM, time.monotonic() - start)
+        return self.handle_packet(client_socket, packet)
+
+    def publish_delay(self, limits, packet) -> float:
+        """Seconds a publish waits for the connection and topic token buckets"""
+        if packet.stream is not None:
+            size = packet.stream.length
+        else:
+            size = len(packet.payload) if packet.payload else 0
+        return self.rate_limits.publish_delay(limits, packet.topic, size)
+
+    def awaits_acks(self, queue, packet) -> bool:
+        """Whether the receive maximum of acks still queued for the client holds back ``packet``"""
+        receive_maximum = self.rate_limits.receive_maximum
+        # legacy clients get an ack for every publish
+        return (bool(receive_maximum) and (packet.qos or packet.protocol == PROTOCOL_LEGACY)
+                and queue.unacked >= receive_maximum)
+
+    def handle_publish_packet(self, client_socket, packet):
+        if client_socket in self.client_compression:
+            packet.compressed = True
+        access = self.client_acl.get(client_socket)
+        # an invalid topic is dropped by handle_publish, ACL or not
+        if access is not None and validate_topic(packet.topic) and not access.may_publish(packet.topic):
+            # acked all the same, MQTT 3.1.1 has no way to refuse a publish
+            self.logger.debug(f"Dropping unauthorized publish to {packet.topic}")
+        elif packet.qos == 2:
+            # route once, duplicates are dropped until the PUBREL
+            pending = self.qos2_pending.setdefault(client_socket, set())
+            if packet.packet_id not in pending:
+                pending.add(packet.packet_id)
+                self.handle_publish(packet)
+        else:
+            self.handle_publish(packet)
+        if packet.stream is None:
+            self.ack_publish(client_socket, packet)
+        else:
+            # acked once the whole payload has arrived
+            packet.stream.add_done_callback(lambda stream: stream.complete and self.ack_publish(client_socket, packet))
+
+    def ack_publish(self, client_socket, packet):
+        """Queue the PUBREC/PUBACK a received publish asks for"""
+        if packet.qos == 2:
+            self.send_ack(client_socket, PacketType.PUBREC, packet.packet_id)
+        # legacy clients expect an ack for every publish
+        elif packet.qos == 1 or packet.protocol == PROTOCOL_LEGACY:
+            self.send_ack(client_socket, PacketType.PUBACK, packet.packet_id)
+
+    def handle_pubrel(self, client_socket, packet):
+        self.qos2_pending.get(client_socket, set()).discard(packet.packet_id)
+        self.send_ack(client_socket, PacketType.PUBCOMP, packet.packet_id)
+
+    def handle_pingreq(self, client_socket, packet):
+        protocol = self.client_protocols.get(client_socket, PROTOCOL_MQTT311)
+        self.send_to(client_socket, control_frame(PacketType.PINGRESP, protocol), control=True)
+
+    def handle_disconnect(self, client_socket, packet) -> bool:
+        return False
+
+    def handle_connect(self, client_socket, packet) -> bool:
+        """Answer CONNECT with CONNACK, returns False if the connection is refused"""
+        if client_socket in self.client_protocols:
+            # a second CONNECT is a protocol violation (MQTT 3.1.1 section 3.1.0),
+            # it must not re-key the connection's ACL or session
+            self.logger.warning("Second CONNECT on a connected client, disconnecting")
+            return False
+        self.client_protocols[client_socket] = packet.protocol
+        return_code = packet.return_code
+        if return_code == CONNACK_ACCEPTED and not packet.clean_session and not packet.client_id:
+            # a persistent session needs a client id to be found again
+            return_code = CONNACK_IDENTIFIER_REJECTED
+        ack = MQTTPacket(PacketType.CONNACK, return_code=return_code)
+        if return_code == CONNACK_ACCEPTED and packet.compression is not None and self.compression:
+            # plain deflate if the client's dictionary is unknown here
+            granted = packet.compression if packet.compression in self.dictionaries else 0
+            self.client_compression[client_socket] = ack.compression = granted
+        if return_code != CONNACK_ACCEPTED:
+            self.logger.warning(f"Refused connection, CONNACK return code {return_code}")
+            # written directly, the outbound queue is discarded on disconnect
+            client_socket.send(ack.encode(packet.protocol))
+            return False
+        self.watch_keep_alive(client_socket, packet.keep_alive)
+        if self.acl is not None:
+            self.client_acl[client_socket] = self.acl.connect(packet.username, packet.client_id)
+        ack.session_present, queued = self.attach_session(client_socket, packet.client_id,
+                                                          packet.clean_session)
+        self.send_packet(client_socket, ack)
+        # offline messages are bounded by the session queue size
+        compression = self.client_compression.get(client_socket)
+        for topic, payload in queued:
+            forward = MQTTPacket(PacketType.PUBLISH, topic=topic, payload=payload)
+            self.send_to(client_socket, self._forward_frame(forward, packet.protocol, compression), control=True)
+        return True
+
+    def attach_session(self, client_socket, client_id: str, clean_session: bool):
+        """Resume or discard the persistent session of ``client_id``.
+
+        Returns whether a session was resumed and the messages queued for it
+        while the client was offline.
+        """
+        with self.topics_lock:
+            previous = self.session_clients.pop(client_id, None)
+            if previous is not None and previous is not client_socket:
+                # the new connection takes the session over
+                self.client_sessions.pop(previous, None)
+                try:
+                    previous.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            if clean_session:
+                session = self.sessions.drop(client_id) if client_id else None
+                if session is not None:
+                    for topic_filter in session.subscriptions:
+                        self._unsubscribe(topic_filter, session)
+                return False, []
+
+            session, present = self.sessions.open(client_id)
+            access = self.client_acl.get(client_socket)
+            for topic_filter in list(session.subscriptions):
+                if access is not None and not access.may_subscribe(match_filter(topic_filter)):
+                    # the ACL rules changed while the client was away
+                    self._unsubscribe(topic_filter, session)
+                    self.sessions.unsubscribe(session, topic_filter)
+                    continue
+                # subscribed before the session lets go, so no publish misses both
+                self._subscribe(topic_filter, client_socket)
+                self._unsubscribe(topic_filter, session)
+            self.client_topics.setdefault(client_socket, set()).update(session.subscriptions)
+            self.client_sessions[client_socket] = session
+            self.session_clients[client_id] = client_socket
+            session.connected = True
+            queued = self.sessions.take(session)
+            if access is not None:
+                queued = [(topic, payload) for topic, payload in queued if access.may_subscribe(topic)]
+            return present, queued
+
+    @staticmethod
+    def _conflated(topic_filter: str, subscriber):
+        """The filter and trie entry of a subscription, unwrapping $conflate/<ms>/"""
+        conflated = parse_conflated(topic_filter)
+        if conflated is None:
+            return topic_filter, subscriber
+        interval, topic_filter = conflated
+        if isinstance(subscriber, Session):
+            # an offline session queues every message
+            return topic_filter, subscriber
+        return topic_filter, Conflated(subscriber, interval)
+
+    def _subscribe(self, topic_filter: str, subscriber) -> bool:
+        """Subscribe in the trie, or join the $share group the filter names"""
+        topic_filter, subscriber = self._conflated(topic_filter, subscriber)
+        if isinstance(subscriber, Conflated):
+            self.limit_send_buffer(subscriber.subscriber)
+        shared = parse_shared(topic_filter)
+        if shared is None:
+            return self.topics.subscribe(topic_filter, subscriber)
+        if isinstance(subscriber, Session):
+            # a group's messages go to its connected members only
+            return False
+        group = self.shared_groups.get(shared)
+        if group is None:
+            group = self.shared_groups[shared] = SharedGroup(*shared, strategy=self.share_strategy)
+            self.topics.subscribe(group.topic_filter, group)
+        return group.add(subscriber)
+
+    def _unsubscribe(self, topic_filter: str, subscriber) -> bool:
+        try:
+            topic_filter, subscriber = self._conflated(topic_filter, subscriber)
+            shared = parse_shared(topic_filter)
+        except ValueError:
+            return False
+        if shared is None:
+            return self.topics.unsubscribe(topic_filter, subscriber)
+        group = self.shared_groups.get(shared)
+        if group is None or not group.remove(subscriber):
+            return False
+        if not group:
+            del self.shared_groups[shared]
+            self.topics.unsubscribe(group.topic_filter, group)
+        return True
+
+    def _queue_depth(self, client_socket) -> int:
+        queue = self.outbound.get(client_socket)
+        return queue.depth if queue is not None else 0
+
+    @staticmethod
+    def _valid_filter(topic_filter: str) -> bool:
+        try:
+            return (parse_conflated(topic_filter) is not None or parse_shared(topic_filter) is not None
+                    or validate_filter(topic_filter))
+        except ValueError:
+            return False
+
+    def _forward_frame(self, packet, protocol: str, compression: int = None):
+        """The frame subscribers on ``protocol`` receive for a publish.
+
+        A QoS 0 publish is forwarded as the frame it arrived in. Otherwise
+        only a new header is encoded and the payload is shared by reference.
+        Subscribers with ``compression`` get an uncompressed payload marked
+        RAW; a compressed one must already be readable by them.
+        """
+        if (packet.raw_data is not None and packet.protocol == protocol and not packet.qos
+                and not packet.retain and packet.compressed == (compression is not None)):
+            return packet.raw_data
+        payload = packet.payload
+        if compression is not None and not packet.compressed:
+            payload = RAW_HEADER + payload if payload else RAW_HEADER
+        forward = MQTTPacket(PacketType.PUBLISH, topic=packet.topic, payload=payload)
+        if not payload:
+            return forward.encode(protocol)
+        return forward.encode_prefix(protocol), payload
+
+    def _decompressed(self, packet):
+        """Copy of a compressed publish with its payload decompressed"""
+        return MQTTPacket(PacketType.PUBLISH, topic=packet.topic, payload=decompress(packet.payload, self.dictionaries),
+                          qos=packet.qos, retain=packet.retain, packet_id=packet.packet_id)
+
+    def _readable(self, packet, compression) -> bool:
+        """Whether a subscriber with ``compression`` can take the payload as it is"""
+        if not packet.compressed:
+            return True
+        return compression is not None and payload_dictionary(packet.payload) in (0, compression)
+
+    def handle_publish(self, packet):
+        """Route a publish to its subscribers.
+
+        Takes no lock on the common path: the subscriber set is an immutable
+        snapshot, so a client removed meanwhile is skipped and one added
+        meanwhile gets the next publish.
+        """
+        if not validate_topic(packet.topic):
+            self.logger.warning(f"Dropping publish to invalid topic: {packet.topic}")
+            return
+        if packet.stream is not None:
+            self.handle_stream(packet)
+            return
+        try:
+            self._route(packet)
+        except ValueError as e:
+            # a compressed payload that cannot be read: dropped, and still
+            # acked, rather than taking the publisher's connection down.
+            # Subscribers that take it as it is may already have it.
+            self.logger.warning(f"Dropping unreadable publish to {packet.topic}: {e}")
+
+    def _route(self, packet):
+        """handle_publish for a whole, valid publish; raises ValueError for an unreadable compressed payload"""
+        # decompressed at most once, for retained, sessions and plain subscribers
+        plain = self._decompressed(packet) if packet.compressed and packet.retain else None
+        if packet.retain:
+            with self.retained_lock:
+                self.retained.set(packet.topic, (plain or packet).payload)
+        subscribers = self.topics.match(packet.topic)
+        if not subscribers:
+            return
+        # encode once per wire format, every subscriber queue shares the frame
+        frames = {}
+        conflate = None
+        if self.conflate_topics and self.conflate_topics.match(packet.topic):
+            conflate = self.conflate_interval
+        outbound = self.outbound
+
+        for client in subscribers:
+            interval = conflate
+            if isinstance(client, SharedGroup):
+                # one member of the group gets the message
+                client = client.pick(packet.topic, self._queue_depth)
+                if client is None:
+                    continue
+            elif isinstance(client, Conflated):
+                client, interval = client
+            if isinstance(client, Session):
+                if packet.qos:
+                    if packet.compressed:
+                        plain = plain or self._decompressed(packet)
+                    # the session store is guarded like the subscriptions
+                    with self.topics_lock:
+                        self.sessions.enqueue(client, packet.topic, (plain or packet).payload)
+                continue
+            if client not in outbound:
+                # disconnected after the snapshot was taken
+                continue
+            protocol = self.client_protocols.get(client, PROTOCOL_MQTT311)
+            compression = self.client_compression.get(client)
+            wire = (protocol, compression)
+            frame = frames.get(wire)
+            if frame is None:
+                source = packet
+                if not self._readable(packet, compression):
+                    source = plain = plain or self._decompressed(packet)
+                frame = frames[wire] = self._forward_frame(source, protocol, compression)
+            try:
+                if interval is None:
+                    self.send_to(client, frame)
+                else:
+                    self.send_latest(client, packet.topic, frame, interval)
+            except Exception as e:
+                self.logger.error(f"Failed to send to subscriber: {e}")
+
+    def buffered(self, packet):
+        """Copy of a streamed publish with the whole payload read in"""
+        buffered = MQTTPacket(PacketType.PUBLISH, topic=packet.topic, payload=packet.stream.read(),
+                              qos=packet.qos, retain=packet.retain, packet_id=packet.packet_id)
+        buffered.compressed = packet.compressed
+        buffered.protocol = packet.protocol
+        return buffered
+
+    def handle_stream(self, packet):
+        """Route a publish whose payload is still arriving.
+
+        Subscribers get the header right away and the payload relayed from
+        the stream as it arrives; every subscriber queue shares one frame per
+        wire format. What needs the whole payload (the retained store,
+        offline sessions and legacy subscribers) gets it once the stream is
+        complete, and a compressed payload, which some subscribers may need
+        decompressed, is routed like any publish then.
+        """
+        stream = packet.stream
+        if packet.compressed:
+            # past the instance's handle_publish, metrics already counted it
+            route = type(self).handle_publish
+            stream.add_done_callback(lambda stream: stream.complete and route(self, self.buffered(packet)))
+            return
+        frames = {}
+        conflate = None
+        if self.conflate_topics and self.conflate_topics.match(packet.topic):
+            conflate = self.conflate_interval
+        outbound = self.outbound
+        sessions = []
+        legacy = []
+        for client in self.topics.match(packet.topic):
+            interval = conflate
+            if isinstance(client, SharedGroup):
+                client = client.pick(packet.topic, self._queue_depth)
+                if client is None:
+                    continue
+            elif isinstance(client, Conflated):
+                client, interval = client
+            if isinstance(client, Session):
+                if packet.qos:
+                    sessions.append(client)
+                continue
+            if client not in outbound:
+                continue
+            if self.client_protocols.get(client, PROTOCOL_MQTT311) == PROTOCOL_LEGACY:
+                legacy.append(client)
+                continue
+            compression = self.client_compression.get(client)
+            frame = frames.get(compression is not None)
+            if frame is None:
+                if compression is None:
+                    prefix = publish_prefix(packet.topic, stream.length)
+                else:
+                    prefix = publish_prefix(packet.topic, len(RAW_HEADER) + stream.length) + RAW_HEADER
+                frame = frames[compression is not None] = StreamFrame(prefix, stream)
+            try:
+                if interval is None:
+                    self.send_to(client, frame)
+                else:
+                    self.send_latest(client, packet.topic, frame, interval)
+            except Exception as e:
+                self.logger.error(f"Failed to send to subscriber: {e}")
+        if packet.retain or sessions or legacy:
+            stream.add_done_callback(lambda stream: stream.complete and self._streamed(packet, sessions, legacy))
+
+    def _streamed(self, packet, sessions: list, legacy: list):
+        """Hand a completed stream to what could not take it while it arrived"""
+        payload = packet.stream.read()
+        if packet.retain:
+            with self.retained_lock:
+                self.retained.set(packet.topic, payload)
+        if sessions:
+            with self.topics_lock:
+                for session in sessions:
+                    self.sessions.enqueue(session, packet.topic, payload)
+        # a legacy frame's payload length is two bytes
+        if legacy and len(payload) <= 0xFFFF:
+            frame = MQTTPacket(PacketType.PUBLISH, topic=packet.topic, payload=payload).encode(PROTOCOL_LEGACY)
+            for client in legacy:
+                self.send_to(client, frame)
 
     def handle_subscribe(self, client_socket, packet):
         with self.topics_lock:
             try:
-                if not packet.topic:
+                topic_filters = packet.topic_filters
+                if not topic_filters:
                     self.logger.warning("Invalid subscription: no topic specified")
                     return
 
-                if packet.topic not in self.topics:
-                    self.topics[packet.topic] = set()
+                return_codes = []
+                accepted = []
+                access = self.client_acl.get(client_socket)
+                for topic_filter, qos in topic_filters:
+                    if not self._valid_filter(topic_filter):
+                        self.logger.warning(f"Invalid subscription filter: {topic_filter}")
+                        return_codes.append(SUBACK_FAILURE)
+                        continue
+                    if access is not None and not access.may_subscribe(match_filter(topic_filter)):
+                        self.logger.warning(f"Unauthorized subscription filter: {topic_filter}")
+                        return_codes.append(SUBACK_FAILURE)
+                        continue
+                    self._subscribe(topic_filter, client_socket)
+                    if client_socket not in self.client_topics:
+                        self.client_topics[client_socket] = set()
+                    self.client_topics[client_socket].add(topic_filter)
+                    # shared subscriptions get no retained messages
+                    if not topic_filter.startswith(SHARED_PREFIX):
+                        accepted.append(match_filter(topic_filter))
+                    session = self.client_sessions.get(client_socket)
+                    if session is not None:
+                        self.sessions.subscribe(session, topic_filter, qos)
+                    # messages are forwarded at QoS 0
+                    return_codes.append(0)
                 
-                self.topics[packet.topic].add(client_socket)
-                if client_socket not in self.client_topics:
-                    self.client_topics[client_socket] = set()
-                self.client_topics[client_socket].add(packet.topic)
+                    self.logger.debug(f"Client subscribed to {topic_filter}")
+                    self.logger.debug(f"Current subscriptions: {len(self.topics)}")
+                    self.logger.debug(f"Number of subscribers for {topic_filter}: {len(self.topics.subscribers(topic_filter))}")
                 
-                self.logger.debug(f"Client subscribed to {packet.topic}")
-                self.logger.debug(f"Current topics: {list(self.topics.keys())}")
-                self.logger.debug(f"Number of subscribers for {packet.topic}: {len(self.topics[packet.topic])}")
-                
-                ack = MQTTPacket(PacketType.SUBACK)
-                client_socket.send(ack.encode())
+                # legacy SUBACKs carry no return codes, so a refused legacy subscribe gets none
+                if packet.protocol == PROTOCOL_LEGACY and SUBACK_FAILURE in return_codes:
+                    return
+                ack = MQTTPacket(PacketType.SUBACK, packet_id=packet.packet_id, return_codes=return_codes)
+                self.send_packet(client_socket, ack)
+                self.send_retained(client_socket, accepted)
             except Exception as e:
                 self.logger.error(f"Subscription error: {e}")
 
+    def send_retained(self, client_socket, topic_filters):
+        """Queue the retained messages matching newly subscribed filters"""
+        messages = {}
+        with self.retained_lock:
+            for topic_filter in topic_filters:
+                for message in self.retained.match(topic_filter):
+                    messages[message.topic] = message
+        if not messages:
+            return
+        protocol = self.client_protocols.get(client_socket, PROTOCOL_MQTT311)
+        compressed = client_socket in self.client_compression
+        self.logger.debug(f"Sending {len(messages)} retained messages")
+        # a snapshot is bounded by the retained store, so it bypasses the queue bound
+        for message in messages.values():
+            if compressed:
+                frame = MQTTPacket(PacketType.PUBLISH, topic=message.topic, payload=RAW_HEADER + message.payload,
+                                   retain=True).encode(protocol)
+            else:
+                frame = message.encode(protocol)
+            self.send_to(client_socket, frame, control=True)
+
+    def handle_unsubscribe(self, client_socket, packet):
+        with self.topics_lock:
+            subscribed = self.client_topics.get(client_socket, set())
+            session = self.client_sessions.get(client_socket)
+            for topic_filter, _ in packet.topic_filters:
+                self._unsubscribe(topic_filter, client_socket)
+                subscribed.discard(topic_filter)
+                if session is not None:
+                    self.sessions.unsubscribe(session, topic_filter)
+            self.logger.debug(f"Client unsubscribed from {[f for f, _ in packet.topic_filters]}")
+            self.send_ack(client_socket, PacketType.UNSUBACK, packet.packet_id)
+
     def remove_client(self, client_socket):
         with self.topics_lock:
-            if client_socket in self.client_topics:
-                for topic in self.client_topics[client_socket]:
-                    if topic in self.topics:
-                        self.topics[topic].discard(client_socket)
-                del self.client_topics[client_socket]
+            session = self.client_sessions.pop(client_socket, None)
+            if session is not None:
+                # keep routing to the session while its client is away,
+                # subscribed before the client's filters are dropped
+                session.connected = False
+                self.session_clients.pop(session.client_id, None)
+                for topic_filter in session.subscriptions:
+                    self._subscribe(topic_filter, session)
+            # unsubscribing prunes the trie nodes and $share groups left empty
+            for topic in self.client_topics.pop(client_socket, ()):
+                self._unsubscribe(topic, client_socket)
+            queue = self.outbound.pop(client_socket, None)
+            self.client_protocols.pop(client_socket, None)
+            self.client_compression.pop(client_socket, None)
+            self.qos2_pending.pop(client_socket, None)
+            self.client_limits.pop(client_socket, None)
+            self.client_acl.pop(client_socket, None)
+            self.last_activity.pop(client_socket, None)
+        if queue is not None:
+            queue.close()
+        if self.capture is not None:
+            self.capture.closed(client_socket)
         try:
             client_socket.close()
         except Exception as e:
@@ -0,0 +1,162 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, Hashable, Iterator, NamedTuple
+from ..protocol.packet import MQTTPacket, publish_prefix
+
+# file header: magic and the wall-clock time the capture started
+MAGIC = b'MQTTCAP1'
+HEADER = struct.Struct('!8sd')
+# per record: nanoseconds since the start, connection id, kind, frame length
+RECORD = struct.Struct('!QIBI')
+
+OPENED = 0
+FRAME = 1
+CLOSED = 2
+
+
+class CaptureRecord(NamedTuple):
+    time: float
+    connection: int
+    kind: int
+    # the inbound frame as received, empty for OPENED/CLOSED
+    frame: memoryview
+
+
+class TrafficCapture:
+    """Appends every inbound frame of a broker to a capture file.
+
+    Each record holds the time the frame was read, the id of the
+    connection it arrived on and the frame as it was on the wire, so
+    replay_bench.py can send the same bytes on the same number of
+    connections with the same timing. Connects and disconnects are
+    recorded too. A streamed publish is recorded, with the time its header
+    arrived, once its payload is complete. Records are buffered and
+    flushed at least every ``flush_interval`` seconds.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 1024 * 1024, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = 0
+        self._file = open(path, 'wb', buffering=buffer_size)
+        self._start = time.perf_counter_ns()
+        self._file.write(HEADER.pack(MAGIC, time.time()))
+        self._flushed = time.monotonic()
+        self._ids: Dict[Hashable, int] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        # streamed payloads being copied into their reserved slots, close() waits for them
+        self._copies = 0
+        self._copied = threading.Condition(self._lock)
+
+    def opened(self, connection: Hashable):
+        """Give a new connection its id"""
+        with self._lock:
+            self._next_id += 1
+            self._ids[connection] = self._next_id
+            self._write(self._next_id, OPENED, time.perf_counter_ns())
+
+    def record(self, connection: Hashable, packets):
+        """Append the frames of packets just read from a connection"""
+        connection_id = self._ids.get(connection)
+        if connection_id is None:
+            return
+        now = time.perf_counter_ns()
+        streams = []
+        with self._lock:
+            for packet in packets:
+                if packet.stream is not None:
+                    streams.append(packet)
+                    continue
+                frame = packet.raw_data
+                if frame is None:
+                    frame = packet.encode(packet.protocol)
+                self._write(connection_id, FRAME, now, frame)
+        # outside the lock, a stream that already completed calls back right away
+        for packet in streams:
+            packet.stream.add_done_callback(
+                lambda stream, packet=packet: stream.complete and self._record_stream(connection_id, now, packet))
+
+    def closed(self, connection: Hashable):
+        with self._lock:
+            connection_id = self._ids.pop(connection, None)
+            if connection_id is not None:
+                self._write(connection_id, CLOSED, time.perf_counter_ns())
+
+    def close(self):
+        with self._lock:
+            self._copied.wait_for(lambda: not self._copies)
+            if not self._file.closed:
+                self._file.close()
+
+    def _record_stream(self, connection_id: int, now: int, packet: MQTTPacket):
+        stream = packet.stream
+        prefix = publish_prefix(packet.topic, stream.length, packet.qos, packet.packet_id, packet.retain, packet.dup)
+        # only the record header and prefix are written under the lock, the
+        # payload is copied into the slot skipped for it while other
+        # connections' frames are appended after it
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(RECORD.pack(now - self._start, connection_id, FRAME, len(prefix) + stream.length))
+            self._file.write(prefix)
+            offset = self._file.tell()
+            self._file.seek(stream.length, os.SEEK_CUR)
+            self.records += 1
+            self._copies += 1
+        try:
+            fd = self._file.fileno()
+            for chunk in stream.chunks():
+                view = memoryview(chunk)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    offset += written
+                    view = view[written:]
+        finally:
+            with self._lock:
+                self._copies -= 1
+                self._copied.notify_all()
+
+    def _write(self, connection_id: int, kind: int, now: int, frame=b''):
+        if self._file.closed:
+            return
+        self._file.write(RECORD.pack(now - self._start, connection_id, kind, len(frame)))
+        if frame:
+            self._file.write(frame)
+        self.records += 1
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self._file.flush()
+            self._flushed = time.monotonic()
+
+
+class CaptureFile:
+    """A capture file memory-mapped for reading, frames are views into the map"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, self.started = HEADER.unpack_from(self._view)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"Not a capture file: {path}")
+
+    def __iter__(self) -> Iterator[CaptureRecord]:
+        """Records in file order; a streamed publish comes after frames read while it arrived"""
+        view, pos, end = self._view, HEADER.size, len(self._view)
+        unpack = RECORD.unpack_from
+        while pos + RECORD.size <= end:
+            elapsed, connection, kind, length = unpack(view, pos)
+            pos += RECORD.size
+            if pos + length > end:
+                # cut off while the broker was writing it
+                break
+            yield CaptureRecord(elapsed / 1e9, connection, kind, view[pos:pos + length])
+            pos += length
+
+    def close(self):
+        self._view.release()
+        self._map.close()
@@ -1,45 +1,122 @@
 import socket
-from typing import Callable
+from concurrent.futures import Future
+from typing import Callable, Iterable, List, Optional, Tuple, Union
 from ..protocol.flow import MessageFlow
-from ..protocol.packet import MQTTPacket, PacketType
+from ..protocol.packet import MQTTPacket, PacketType, PROTOCOL_MQTT311, control_frame
+from ..protocol.compression import PayloadCodec
+from ..protocol.stream import PayloadSource
 
 class MQTTClient:
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, max_inflight: int = 64, client_id: str = '',
+                 protocol: str = PROTOCOL_MQTT311, clean_session: bool = True, dispatcher=None,
+                 compression: Optional[PayloadCodec] = None, stream_threshold: int = 0,
+                 stream_dir: Optional[str] = None, username: Optional[str] = None,
+                 password: Optional[bytes] = None, ack_timeout: float = 10.0):
         self.host = host
         self.port = port
+        self.max_inflight = max_inflight
+        self.client_id = client_id
+        self.protocol = protocol
+        # with clean_session=False the broker keeps subscriptions and queues
+        # QoS >= 1 messages for this client id while it is disconnected
+        self.clean_session = clean_session
+        # sent in CONNECT, the broker's ACL rules may be keyed by username
+        self.username = username
+        self.password = password
+        self.on_message: Optional[Callable[[str, bytes], None]] = None
+        # where message callbacks run, see create_dispatcher; inline by default
+        self.dispatcher = dispatcher
+        # payload compression to offer the broker, used if the CONNACK grants it
+        self.compression = compression
+        # received payloads larger than stream_threshold bytes (0 never) are
+        # spooled to a temp file in stream_dir and callbacks get a
+        # PayloadStream in place of the bytes, to iterate or spill
+        self.stream_threshold = stream_threshold
+        self.stream_dir = stream_dir
+        # how long publishes wait for a free in-flight slot and for their ack
+        self.ack_timeout = ack_timeout
         self.socket = None
         self.flow = None
 
+    @property
+    def connected(self) -> bool:
+        return self.flow is not None and self.flow.connected
+
     def connect(self) -> bool:
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.host, self.port))
-            self.flow = MessageFlow(self.socket)
-            packet = MQTTPacket(PacketType.CONNECT)
-            self.socket.send(packet.encode())
+            self.flow = MessageFlow(self.socket, max_inflight=self.max_inflight, ack_timeout=self.ack_timeout,
+                                    protocol=self.protocol, dispatcher=self.dispatcher, compression=self.compression,
+                                    stream_threshold=self.stream_threshold, stream_dir=self.stream_dir)
+            self.flow.on_message = self.on_message
+            packet = MQTTPacket(PacketType.CONNECT, client_id=self.client_id,
+                                keep_alive=self.flow.keep_alive_interval, clean_session=self.clean_session,
+                                username=self.username, password=self.password,
+                                compression=self.compression.dictionary_id if self.compression else None)
+            self.socket.send(packet.encode(self.protocol))
             self.flow.start()
+            if self.compression is not None:
+                # the broker reads every payload as compressed once it agreed,
+                # so nothing is published before its answer
+                self.flow.connack.result(self.flow.ack_timeout)
             return True
         except Exception as e:
             print(f"Connection error: {e}")
             return False
 
-    def publish(self, topic: str, message: str) -> bool:
+    def publish(self, topic: str, message: Union[str, bytes], qos: int = 1, retain: bool = False) -> bool:
         if not self.flow:
             return False
-        return self.flow.publish(topic, message.encode())
+        return self.flow.publish(topic, message.encode() if isinstance(message, str) else message,
+                                 qos=qos, retain=retain)
+
+    def publish_async(self, topic: str, message: Union[str, bytes], qos: int = 1, retain: bool = False) -> Future:
+        """Pipelined publish, the future resolves once the broker acknowledges"""
+        if not self.flow:
+            raise RuntimeError("Not connected")
+        return self.flow.publish_async(topic, message.encode() if isinstance(message, str) else message,
+                                       qos=qos, retain=retain)
 
-    def subscribe(self, topic: str, callback: Callable[[str, bytes], None]) -> bool:
+    def publish_stream(self, topic: str, source: PayloadSource, qos: int = 1, retain: bool = False) -> bool:
+        """Publish a file path, file object or buffer with sendfile and wait for the PUBACK"""
         if not self.flow:
             return False
-        return self.flow.subscribe(topic, callback)
+        try:
+            return self.flow.publish_stream(topic, source, qos=qos, retain=retain,
+                                            timeout=self.flow.ack_timeout).result(self.flow.ack_timeout)
+        except Exception as e:
+            print(f"Publish error: {e}")
+            return False
+
+    def publish_many(self, messages: Iterable[Tuple[str, Union[str, bytes]]], qos: int = 1,
+                     retain: bool = False) -> List[Future]:
+        """Publish ``(topic, message)`` pairs in batched writes, returns a future per message.
+
+        A failure partway is raised as by ``MessageFlow.publish_many``, with
+        the futures of the messages taken so far.
+        """
+        if not self.flow:
+            raise RuntimeError("Not connected")
+        return self.flow.publish_many(((topic, message.encode() if isinstance(message, str) else message)
+                                       for topic, message in messages), qos=qos, retain=retain)
+
+    def subscribe(self, topic: str, callback: Callable[[str, bytes], None], qos: int = 0) -> bool:
+        if not self.flow:
+            return False
+        return self.flow.subscribe(topic, callback, qos=qos)
 
     def disconnect(self):
+        if self.socket:
+            try:
+                # the broker closes the connection, which ends the receiver
+                self.socket.send(control_frame(PacketType.DISCONNECT, self.protocol))
+            except:
+                pass
         if self.flow:
             self.flow.stop()
         if self.socket:
             try:
-                packet = MQTTPacket(PacketType.DISCONNECT)
-                self.socket.send(packet.encode())
                 self.socket.close()
             except:
                 pass
\ No newline at end of file
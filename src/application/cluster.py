@@ -0,0 +1,271 @@
+import logging
+import os
+import signal
+import socket
+import threading
+from typing import Callable, Dict, List, Optional
+from .broker import MQTTBroker
+from .outbound import OutboundQueue, DROP_OLDEST, write_frames
+from ..protocol.packet import MQTTPacket, PacketType, PacketReader, PROTOCOL_MQTT311
+from ..protocol.topic import TopicTrie, validate_topic
+
+
+class InterestTrie(TopicTrie):
+    """TopicTrie that reports when a filter gains its first or loses its last subscriber"""
+
+    def __init__(self, on_change: Callable[[str, bool], None], cache_size: int = 4096):
+        super().__init__(cache_size=cache_size)
+        self.on_change = on_change
+
+    def subscribe(self, topic_filter: str, subscriber) -> bool:
+        added = super().subscribe(topic_filter, subscriber)
+        if added and self.subscriber_count(topic_filter) == 1:
+            self.on_change(topic_filter, True)
+        return added
+
+    def unsubscribe(self, topic_filter: str, subscriber) -> bool:
+        removed = super().unsubscribe(topic_filter, subscriber)
+        if removed and not self.subscriber_count(topic_filter):
+            self.on_change(topic_filter, False)
+        return removed
+
+
+class PeerLink:
+    """Unix socket to another worker, carrying MQTT 3.1.1 frames.
+
+    SUBSCRIBE/UNSUBSCRIBE announce which filters have subscribers on the
+    sending worker, PUBLISH carries publishes routed to it. Frames are
+    queued and written by a dedicated thread like a client connection.
+    """
+
+    def __init__(self, broker: 'WorkerBroker', worker_id: int, sock: socket.socket,
+                 queue_size: int = 100000):
+        self.broker = broker
+        self.worker_id = worker_id
+        self.socket = sock
+        self.queue = OutboundQueue(queue_size, DROP_OLDEST)
+
+    def start(self):
+        for target in (self._read_loop, self._write_loop):
+            thread = threading.Thread(target=target, name=f'peer-{self.worker_id}')
+            thread.daemon = True
+            thread.start()
+
+    def send(self, frame, control: bool = False) -> bool:
+        return self.queue.put(frame, control)
+
+    def close(self):
+        self.queue.close()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        try:
+            while True:
+                frames = self.queue.get_batch(1024)
+                if frames is None:
+                    break
+                self.queue.writes += write_frames(self.socket, frames)[0]
+        except OSError as e:
+            self.broker.logger.debug(f"Peer {self.worker_id} writer stopped: {e}")
+
+    def _read_loop(self):
+        reader = PacketReader(protocol=PROTOCOL_MQTT311, keep_raw=True)
+        try:
+            while True:
+                packets = reader.read_from(self.socket)
+                if packets is None:
+                    break
+                for packet in packets:
+                    self.broker.handle_peer_packet(self, packet)
+        except OSError as e:
+            self.broker.logger.debug(f"Peer {self.worker_id} reader stopped: {e}")
+        finally:
+            self.broker.remove_peer(self)
+
+
+class WorkerBroker(MQTTBroker):
+    """One process of a multi-process broker.
+
+    Workers share the listening port through SO_REUSEPORT, so the kernel
+    spreads connections across them. Each worker routes its own clients
+    and tells every peer which filters it has subscribers for; a publish
+    is relayed, once, to the peers whose interest matches (and to all
+    peers when retained, so every worker keeps the retained store).
+    """
+
+    def __init__(self, port: int, host: str = '', worker_id: int = 0,
+                 peers: Optional[Dict[int, socket.socket]] = None, **kwargs):
+        super().__init__(port, host, **kwargs)
+        self.worker_id = worker_id
+        self.reuse_port = True
+        self.logger = logging.getLogger(f'MQTTBroker.worker-{worker_id}')
+        self.peers: List[PeerLink] = []
+        # recovered session subscriptions are announced once the links start
+        subscriptions = [(f, s) for f in self.topics.filters() for s in self.topics.subscribers(f)]
+        self.topics = InterestTrie(self._announce, cache_size=self.topics.cache_size)
+        for topic_filter, subscriber in subscriptions:
+            self.topics.subscribe(topic_filter, subscriber)
+        self.peers = [PeerLink(self, i, sock) for i, sock in (peers or {}).items()]
+        # filters each peer has subscribers for, the subscribers are PeerLinks;
+        # matched without a lock, remote_lock serializes the peer changes
+        self.remote = TopicTrie(cache_size=self.topics.cache_size)
+        self.remote_lock = threading.Lock()
+
+    def start(self):
+        with self.topics_lock:
+            for peer in self.peers:
+                for topic_filter in self.topics.filters():
+                    peer.send(self._interest_frame(topic_filter, True), control=True)
+                peer.start()
+        super().start()
+
+    def stop(self):
+        for peer in self.peers:
+            peer.close()
+        super().stop()
+
+    def _interest_frame(self, topic_filter: str, subscribed: bool) -> bytes:
+        packet_type = PacketType.SUBSCRIBE if subscribed else PacketType.UNSUBSCRIBE
+        return MQTTPacket(packet_type, packet_id=1, subscriptions=[(topic_filter, 0)]).encode()
+
+    def _announce(self, topic_filter: str, subscribed: bool):
+        """Called by the trie, with topics_lock held, when local interest changes"""
+        frame = self._interest_frame(topic_filter, subscribed)
+        for peer in self.peers:
+            peer.send(frame, control=True)
+
+    def handle_publish(self, packet):
+        super().handle_publish(packet)
+        if packet.stream is None:
+            self.relay(packet)
+        elif not packet.compressed:
+            # peers get a streamed payload once all of it has arrived, a
+            # compressed one is routed through here again by then
+            packet.stream.add_done_callback(lambda stream: stream.complete and self.relay(self.buffered(packet)))
+
+    def relay(self, packet):
+        """Send a publish to the peers with matching subscribers"""
+        if not validate_topic(packet.topic):
+            return
+        peers = self.peers if packet.retain else self.remote.match(packet.topic)
+        if not peers:
+            return
+        if packet.compressed:
+            # peers read relayed payloads as plain
+            packet = self._decompressed(packet)
+        if packet.raw_data is not None and packet.protocol == PROTOCOL_MQTT311:
+            frame = packet.raw_data
+        else:
+            # qos and retain travel along so peers queue and retain like the origin
+            forward = MQTTPacket(PacketType.PUBLISH, topic=packet.topic, payload=packet.payload,
+                                 qos=packet.qos, retain=packet.retain, packet_id=packet.packet_id or 1)
+            frame = (forward.encode_prefix(), packet.payload) if packet.payload else forward.encode()
+        for peer in peers:
+            peer.send(frame)
+
+    def handle_peer_packet(self, peer: PeerLink, packet):
+        if packet.packet_type == PacketType.PUBLISH:
+            # routed to local clients only, the origin already relayed it
+            MQTTBroker.handle_publish(self, packet)
+        elif packet.packet_type == PacketType.SUBSCRIBE:
+            with self.remote_lock:
+                for topic_filter, _ in packet.topic_filters:
+                    self.remote.subscribe(topic_filter, peer)
+        elif packet.packet_type == PacketType.UNSUBSCRIBE:
+            with self.remote_lock:
+                for topic_filter, _ in packet.topic_filters:
+                    self.remote.unsubscribe(topic_filter, peer)
+
+    def remove_peer(self, peer: PeerLink):
+        with self.remote_lock:
+            for topic_filter in list(self.remote.filters()):
+                self.remote.unsubscribe(topic_filter, peer)
+        peer.queue.close()
+        if self.running:
+            self.logger.warning(f"Lost link to worker {peer.worker_id}")
+
+
+def run_workers(workers: int, port: int, host: str = '', **broker_kwargs) -> int:
+    """Fork ``workers`` WorkerBroker processes and wait for them to exit.
+
+    Every pair of workers is connected by a Unix socket pair created before
+    forking. A persistent session directory is split per worker, since a
+    session lives in the worker its client last connected to; each worker
+    writes its own capture file. SIGINT or
+    SIGTERM stops all workers. Returns the number of workers that failed.
+    """
+    logger = logging.getLogger('MQTTBroker')
+    pairs = {}
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            pairs[i, j] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    session_dir = broker_kwargs.pop('session_dir', None)
+    capture_file = broker_kwargs.pop('capture_file', None)
+
+    pids = {}
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid:
+            pids[pid] = worker_id
+            continue
+        # child: keep only this worker's end of its links
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        peers = {}
+        for (i, j), (a, b) in pairs.items():
+            if worker_id == i:
+                peers[j] = a
+                b.close()
+            elif worker_id == j:
+                peers[i] = b
+                a.close()
+            else:
+                a.close()
+                b.close()
+        status = 0
+        try:
+            broker = WorkerBroker(port, host, worker_id=worker_id, peers=peers,
+                                  session_dir=session_dir and os.path.join(session_dir, f'worker-{worker_id}'),
+                                  capture_file=capture_file and f'{capture_file}.worker-{worker_id}',
+                                  **broker_kwargs)
+            signal.signal(signal.SIGTERM, lambda *args: broker.stop())
+            broker.start()
+        except Exception as e:
+            logger.error(f"Worker {worker_id} failed: {e}")
+            status = 1
+        finally:
+            os._exit(status)
+
+    for a, b in pairs.values():
+        a.close()
+        b.close()
+    logger.info(f"Started {workers} broker workers on port {port}")
+
+    def terminate(*args):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    previous = {sig: signal.signal(sig, terminate) for sig in (signal.SIGINT, signal.SIGTERM)}
+    failed = 0
+    try:
+        while pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            worker_id = pids.pop(pid, None)
+            if status:
+                failed += 1
+                logger.error(f"Worker {worker_id} exited with status {status}")
+                terminate()
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+    return failed
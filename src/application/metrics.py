@@ -0,0 +1,224 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, List
+
+# upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+MESSAGES_RECEIVED = 'messages_received'
+MESSAGES_SENT = 'messages_sent'
+BYTES_RECEIVED = 'bytes_received'
+BYTES_SENT = 'bytes_sent'
+ROUTING_TIME = 'routing_seconds'
+SEND_TIME = 'send_seconds'
+
+# topics counted individually per thread, the rest are summed as OTHER_TOPICS
+MAX_TOPICS = 1000
+OTHER_TOPICS = '<other>'
+
+
+class _Shard:
+    """Counters written by one thread only"""
+    __slots__ = ('thread', 'received', 'bytes_received', 'sent', 'bytes_sent', 'batches',
+                 'counters', 'histograms', 'topics')
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        # hot-path counters are slots, the rest live in ``counters``
+        self.received = 0
+        self.bytes_received = 0
+        self.sent = 0
+        self.bytes_sent = 0
+        self.batches = 0
+        self.counters: Dict[str, int] = {}
+        # name -> bucket counts followed by the sum of observed values
+        self.histograms: Dict[str, List[float]] = {}
+        self.topics: Dict[str, int] = {}
+
+
+class Metrics:
+    """Counters and fixed-bucket histograms sharded per thread.
+
+    Every thread updates its own shard without locking; ``snapshot`` sums
+    the shards. Shards of finished threads are folded into a retired shard
+    so short-lived connection threads do not accumulate.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._local = threading.local()
+        self._shards: List[_Shard] = []
+        self._retired = _Shard()
+        self._lock = threading.Lock()
+
+    def shard(self) -> _Shard:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name: str, value: int = 1):
+        counters = self.shard().counters
+        counters[name] = counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        histograms = self.shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = [0] * (len(self.buckets) + 2)
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def count_topic(self, topic: str, value: int = 1):
+        topics = self.shard().topics
+        if topic not in topics and len(topics) >= MAX_TOPICS:
+            topic = OTHER_TOPICS
+        topics[topic] = topics.get(topic, 0) + value
+
+    def snapshot(self) -> dict:
+        """Totals of every shard: counters, histograms and per-topic counts"""
+        with self._lock:
+            live = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    live.append(shard)
+                else:
+                    self._merge(self._retired, shard)
+            self._shards = live
+            total = _Shard()
+            self._merge(total, self._retired)
+        for shard in live:
+            self._merge(total, shard)
+        counters = dict(total.counters)
+        counters[MESSAGES_RECEIVED] = total.received
+        counters[BYTES_RECEIVED] = total.bytes_received
+        counters[MESSAGES_SENT] = total.sent
+        counters[BYTES_SENT] = total.bytes_sent
+        return {'counters': counters, 'histograms': total.histograms, 'topics': total.topics}
+
+    def _merge(self, into: _Shard, shard: _Shard):
+        into.received += shard.received
+        into.bytes_received += shard.bytes_received
+        into.sent += shard.sent
+        into.bytes_sent += shard.bytes_sent
+        # dict() copies atomically while the owning thread keeps writing
+        for name, value in dict(shard.counters).items():
+            into.counters[name] = into.counters.get(name, 0) + value
+        for name, histogram in dict(shard.histograms).items():
+            target = into.histograms.setdefault(name, [0] * len(histogram))
+            for i, value in enumerate(list(histogram)):
+                target[i] += value
+        for topic, value in dict(shard.topics).items():
+            into.topics[topic] = into.topics.get(topic, 0) + value
+
+    def quantile(self, histogram: List[float], q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile"""
+        counts = histogram[:-1]
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank, seen = q * total, 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def prometheus(self, snapshot: dict, gauges: Dict[str, float], prefix: str = 'mqtt') -> str:
+        """Render a snapshot in the Prometheus text exposition format"""
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {value}')
+        for name, value in sorted(gauges.items()):
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            lines.append(f'{prefix}_{name} {value}')
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            lines.append(f'# TYPE {prefix}_{name} histogram')
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ['+Inf'], histogram[:-1]):
+                cumulative += count
+                lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_{name}_sum {histogram[-1]}')
+            lines.append(f'{prefix}_{name}_count {cumulative}')
+        if snapshot['topics']:
+            lines.append(f'# TYPE {prefix}_topic_messages_total counter')
+            for topic, value in sorted(snapshot['topics'].items()):
+                escaped = topic.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append(f'{prefix}_topic_messages_total{{topic="{escaped}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str, snapshot: dict, gauges: Dict[str, float]):
+        """Replace ``path`` atomically so scrapers never read a partial file"""
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus(snapshot, gauges))
+        os.replace(tmp, path)
+
+
+def instrument(broker, metrics: Metrics, sample_every: int = 16):
+    """Wrap the broker's publish routing and socket writes with measurements.
+
+    The wrappers are installed on the instance, so an uninstrumented broker
+    runs the plain methods with no metrics code in its hot path. Message and
+    byte counts are exact; routing and send times, and the per-topic counts,
+    are sampled once every ``sample_every`` calls per thread to keep the
+    overhead low.
+    """
+    handle_publish = broker.handle_publish
+    write_frames = broker.write_frames
+    write_stream = getattr(broker, 'write_stream', None)
+    clock = time.perf_counter
+    local = metrics._local
+    shard_for = metrics.shard
+    observe = metrics.observe
+    count_topic = metrics.count_topic
+
+    def timed_publish(packet):
+        try:
+            shard = local.shard
+        except AttributeError:
+            shard = shard_for()
+        shard.received = count = shard.received + 1
+        payload = packet.payload
+        if payload:
+            shard.bytes_received += len(payload)
+        elif packet.stream is not None:
+            shard.bytes_received += packet.stream.length
+        if count % sample_every:
+            handle_publish(packet)
+            return
+        start = clock()
+        handle_publish(packet)
+        observe(ROUTING_TIME, clock() - start)
+        count_topic(packet.topic, sample_every)
+
+    def timed(write):
+        def timed_write(target, frames):
+            try:
+                shard = local.shard
+            except AttributeError:
+                shard = shard_for()
+            shard.batches = count = shard.batches + 1
+            if count % sample_every:
+                result = write(target, frames)
+            else:
+                start = clock()
+                result = write(target, frames)
+                observe(SEND_TIME, clock() - start)
+            shard.sent += len(frames)
+            shard.bytes_sent += result[1]
+            return result
+        return timed_write
+
+    broker.handle_publish = timed_publish
+    broker.write_frames = timed(write_frames)
+    if write_stream is not None:
+        broker.write_stream = timed(write_stream)
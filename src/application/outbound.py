@@ -0,0 +1,337 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Hashable, List, NamedTuple, Optional, Tuple
+from ..protocol.stream import PayloadStream
+
+try:
+    from os import sysconf
+    IOV_MAX = sysconf('SC_IOV_MAX')
+except (ImportError, ValueError, OSError):
+    IOV_MAX = 1024
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+
+class StreamFrame:
+    """Queued PUBLISH whose payload is still arriving in a PayloadStream.
+
+    The writer sends ``prefix`` and then relays the stream from ``offset``
+    as it arrives, so frames queued after it wait until it is complete.
+    """
+    __slots__ = ('prefix', 'stream', 'offset')
+
+    def __init__(self, prefix: bytes, stream: PayloadStream, offset: int = 0):
+        self.prefix = prefix
+        self.stream = stream
+        self.offset = offset
+
+
+def flatten_frames(frames) -> list:
+    """Queued frames are buffers or tuples of buffers (prefix, shared payload)"""
+    buffers = []
+    for frame in frames:
+        if isinstance(frame, tuple):
+            buffers.extend(frame)
+        else:
+            buffers.append(frame)
+    return buffers
+
+
+def write_frames(sock, frames) -> Tuple[int, int]:
+    """Write a batch of frames with as few syscalls as possible.
+
+    Frames are gathered into vectored ``sendmsg`` calls so the shared payload
+    buffers are never copied, a StreamFrame is relayed with sendfile. Returns
+    the number of send calls made and the bytes written.
+    """
+    buffers = flatten_frames(frames)
+    calls = size = 0
+    while True:
+        stream = next((i for i, buffer in enumerate(buffers) if type(buffer) is StreamFrame), None)
+        if stream is None:
+            break
+        frame = buffers[stream]
+        buffers[stream] = frame.prefix
+        written = _write_buffers(sock, buffers[:stream + 1])
+        relayed = frame.stream.send_to(sock, frame.offset)
+        calls += written[0] + relayed[0]
+        size += written[1] + relayed[1]
+        del buffers[:stream + 1]
+    written = _write_buffers(sock, buffers)
+    return calls + written[0], size + written[1]
+
+
+def _write_buffers(sock, buffers: list) -> Tuple[int, int]:
+    if not buffers:
+        return 0, 0
+    if not hasattr(sock, 'sendmsg'):
+        data = b''.join(buffers)
+        sock.sendall(data)
+        return 1, len(data)
+    calls = size = 0
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+        calls += 1
+        size += sent
+        done = 0
+        while done < len(buffers) and sent >= len(buffers[done]):
+            sent -= len(buffers[done])
+            done += 1
+        del buffers[:done]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+    return calls, size
+
+
+class Conflated(NamedTuple):
+    """Topic trie entry of a ``$conflate/<ms>/<filter>`` subscription.
+
+    Publishes it matches are queued for ``subscriber`` with
+    OutboundQueue.put_latest, keyed by topic.
+    """
+    subscriber: Hashable
+    interval: float
+
+
+class _Latest:
+    """Queue slot of a conflated frame, overwritten by newer frames of its key"""
+    __slots__ = ('key', 'frame')
+
+    def __init__(self, key, frame):
+        self.key = key
+        self.frame = frame
+
+
+class _Ack(bytes):
+    """An ack of an inbound publish, counted in OutboundQueue.unacked until taken"""
+    __slots__ = ()
+
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to one client.
+
+    A frame is a bytes-like object, or a tuple of them written back to back,
+    so a publish fanned out to many clients can share one payload buffer.
+    Publishers only enqueue; a dedicated writer drains the queue. When the
+    queue is full the overflow policy decides whether the oldest frame is
+    dropped, the new frame is dropped, or the client is disconnected.
+    Control frames (acks, ping responses) bypass the bound.
+
+    Frames queued with put_latest are conflated: a newer frame of the same
+    key (topic) replaces one that was not written yet, in its place.
+
+    Acks of inbound publishes queued with ``ack=True`` are counted in
+    ``unacked`` until the writer takes them, see wait_acked.
+    """
+
+    def __init__(self, maxsize: int = 1000, policy: str = DROP_OLDEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.closed = False
+        self.overflowed = False
+        self.enqueued = 0
+        self.dropped = 0
+        # frames replaced or held back by newer ones of the same key
+        self.conflated = 0
+        self.sent = 0
+        self.unacked = 0
+        # send calls made by the writer, sent / writes is the batching ratio
+        self.writes = 0
+        self._frames = deque()
+        # key -> its unwritten _Latest slot in _frames
+        self._latest = {}
+        # key -> frame waiting for its interval, and when the key may be queued again
+        self._held = {}
+        self._due = {}
+        lock = threading.RLock()
+        # the writer waits for frames, a throttled reader for acks to go out
+        self._cond = threading.Condition(lock)
+        self._acked = threading.Condition(lock)
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    @property
+    def depth(self) -> int:
+        return len(self._frames)
+
+    def put(self, frame, control: bool = False, ack: bool = False) -> bool:
+        """Queue a frame, returns False if it was not accepted"""
+        with self._cond:
+            if self.closed:
+                return False
+            if ack:
+                frame = _Ack(frame)
+                self.unacked += 1
+            if not control and len(self._frames) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return False
+                if self.policy == DISCONNECT:
+                    self.overflowed = True
+                    self._close()
+                    return False
+                dropped = self._frames.popleft()
+                if type(dropped) is _Latest:
+                    del self._latest[dropped.key]
+                elif type(dropped) is _Ack:
+                    self.unacked -= 1
+            self._frames.append(frame)
+            self.enqueued += 1
+            self._notify()
+            return True
+
+    def put_latest(self, key, frame, interval: float = 0.0) -> Optional[float]:
+        """Queue the newest frame for ``key``, replacing one not written yet.
+
+        With an ``interval`` the key is queued at most once per that many
+        seconds, a frame arriving sooner is held (replacing a held one).
+        Returns the delay after which release() should queue a newly held
+        frame, 0 if there is none, or None if the frame was not accepted.
+        """
+        with self._cond:
+            if self.closed:
+                return None
+            latest = self._latest.get(key)
+            if latest is not None:
+                latest.frame = frame
+                self.conflated += 1
+                return 0.0
+            if interval:
+                now = time.monotonic()
+                wait = self._due.get(key, 0.0) - now
+                if wait > 0:
+                    held = key in self._held
+                    self._held[key] = frame
+                    if held:
+                        self.conflated += 1
+                        return 0.0
+                    return wait
+                if self._held.pop(key, None) is not None:
+                    # due before its release timer fired, this frame is newer
+                    self.conflated += 1
+                self._due[key] = now + interval
+            latest = _Latest(key, frame)
+            if not self.put(latest):
+                self._due.pop(key, None)
+                return None
+            self._latest[key] = latest
+            return 0.0
+
+    def release(self, key, interval: float):
+        """Queue the frame held for ``key`` once its interval has passed"""
+        with self._cond:
+            frame = self._held.pop(key, None)
+            if frame is None or self.closed:
+                return
+            self._due[key] = time.monotonic() + interval
+            latest = _Latest(key, frame)
+            if self.put(latest):
+                self._latest[key] = latest
+
+    def get_batch(self, limit: int = 64, timeout: Optional[float] = None) -> Optional[List]:
+        """Wait for frames and take up to ``limit`` of them.
+
+        Returns None once the queue is closed, or an empty list on timeout.
+        """
+        with self._cond:
+            if not self._frames and not self.closed:
+                self._cond.wait(timeout)
+            if self.closed:
+                return None
+            return self._take(limit)
+
+    def wait_acked(self, limit: int, timeout: Optional[float] = None) -> bool:
+        """Wait until fewer than ``limit`` acks are queued, False if the queue closed"""
+        with self._cond:
+            self._acked.wait_for(lambda: self.unacked < limit or self.closed, timeout)
+            return not self.closed
+
+    def close(self):
+        with self._cond:
+            self._close()
+
+    def stats(self) -> dict:
+        return {
+            'depth': len(self._frames),
+            'enqueued': self.enqueued,
+            'sent': self.sent,
+            'writes': self.writes,
+            'dropped': self.dropped,
+            'conflated': self.conflated,
+            'unacked': self.unacked,
+            'policy': self.policy,
+        }
+
+    def _take(self, limit: int) -> List:
+        frames = self._frames
+        count = min(limit, len(frames))
+        batch = [frames.popleft() for _ in range(count)]
+        if self._latest:
+            # a written slot can no longer be replaced
+            for i, frame in enumerate(batch):
+                if type(frame) is _Latest:
+                    del self._latest[frame.key]
+                    batch[i] = frame.frame
+        if self.unacked:
+            acks = sum(type(frame) is _Ack for frame in batch)
+            if acks:
+                self.unacked -= acks
+                self._notify_acked()
+        self.sent += count
+        return batch
+
+    def _close(self):
+        self.closed = True
+        self._frames.clear()
+        self._latest.clear()
+        self._held.clear()
+        self.unacked = 0
+        self._notify()
+        self._notify_acked()
+
+    def _notify(self):
+        self._cond.notify()
+
+    def _notify_acked(self):
+        self._acked.notify_all()
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    """OutboundQueue drained by a coroutine on the broker's event loop.
+
+    Frames must be queued from the loop thread.
+    """
+
+    def __init__(self, maxsize: int = 1000, policy: str = DROP_OLDEST):
+        super().__init__(maxsize, policy)
+        self._ready = asyncio.Event()
+        self._acks_taken = asyncio.Event()
+
+    async def get_batch_async(self, limit: int = 64) -> Optional[List]:
+        while not self._frames and not self.closed:
+            self._ready.clear()
+            await self._ready.wait()
+        if self.closed:
+            return None
+        with self._cond:
+            return self._take(limit)
+
+    async def wait_acked_async(self, limit: int) -> bool:
+        while self.unacked >= limit and not self.closed:
+            self._acks_taken.clear()
+            await self._acks_taken.wait()
+        return not self.closed
+
+    def _notify(self):
+        self._ready.set()
+
+    def _notify_acked(self):
+        self._acks_taken.set()
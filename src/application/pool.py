@@ -0,0 +1,149 @@
+import threading
+import time
+import zlib
+from bisect import bisect
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from .client import MQTTClient
+from ..protocol.packet import PROTOCOL_MQTT311
+
+
+def _failed() -> Future:
+    future = Future()
+    future.set_result(False)
+    return future
+
+
+class MQTTClientPool:
+    """``size`` broker connections shared by one publisher.
+
+    Each topic is mapped to a connection by consistent hashing, so all
+    publishes to a topic travel, in order, over the same connection while
+    different topics are acknowledged in parallel. A connection found dead
+    is replaced in its slot, at most every ``reconnect_delay`` seconds;
+    publishes that were in flight on it resolve as failed, and publishes to
+    its topics fail until it is back.
+    """
+
+    def __init__(self, host: str, port: int, size: int = 4, client_id: str = '', max_inflight: int = 64,
+                 protocol: str = PROTOCOL_MQTT311, replicas: int = 64, reconnect_delay: float = 1.0,
+                 ack_timeout: float = 10.0, topic_cache_size: int = 65536):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.client_id = client_id
+        self.max_inflight = max_inflight
+        self.protocol = protocol
+        self.reconnect_delay = reconnect_delay
+        self.ack_timeout = ack_timeout
+        self.reconnects = 0
+        self.members: List[Optional[MQTTClient]] = [None] * size
+        self._locks = [threading.Lock() for _ in range(size)]
+        self._retry_at = [0.0] * size
+        # hash ring with ``replicas`` points per slot
+        points = sorted((zlib.crc32(f'{slot}-{replica}'.encode()), slot)
+                        for slot in range(size) for replica in range(replicas))
+        self._ring = [point for point, _ in points]
+        self._ring_slots = [slot for _, slot in points]
+        self._slots: Dict[str, int] = {}
+        self.topic_cache_size = topic_cache_size
+
+    def __enter__(self) -> 'MQTTClientPool':
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disconnect()
+
+    def connect(self) -> bool:
+        """Open every connection, returns False if any failed (it is retried on use)"""
+        return all([self._member(slot) is not None for slot in range(self.size)])
+
+    def disconnect(self):
+        for slot, lock in enumerate(self._locks):
+            with lock:
+                client, self.members[slot] = self.members[slot], None
+            if client is not None:
+                client.disconnect()
+
+    def slot(self, topic: str) -> int:
+        """Index of the connection that carries ``topic``"""
+        slot = self._slots.get(topic)
+        if slot is None:
+            index = bisect(self._ring, zlib.crc32(topic.encode('utf-8'))) % len(self._ring)
+            slot = self._ring_slots[index]
+            if len(self._slots) >= self.topic_cache_size:
+                self._slots.clear()
+            self._slots[topic] = slot
+        return slot
+
+    def publish(self, topic: str, message: Union[str, bytes], qos: int = 1, retain: bool = False) -> bool:
+        """Publish and wait for the acknowledgment"""
+        try:
+            return self.publish_async(topic, message, qos=qos, retain=retain).result(self.ack_timeout)
+        except Exception:
+            return False
+
+    def publish_async(self, topic: str, message: Union[str, bytes], qos: int = 1,
+                      retain: bool = False) -> Future:
+        client = self._member(self.slot(topic))
+        if client is None:
+            return _failed()
+        payload = message.encode() if isinstance(message, str) else message
+        try:
+            return client.flow.publish_async(topic, payload, qos=qos, retain=retain)
+        except (OSError, TimeoutError):
+            return _failed()
+
+    def publish_many(self, messages: Iterable[Tuple[str, Union[str, bytes]]], qos: int = 1,
+                     retain: bool = False) -> List[Future]:
+        """Publish ``(topic, message)`` pairs, returns their futures in the same order.
+
+        Messages are grouped by connection and each group is sent with
+        batched writes. If a connection fails partway through its group, the
+        messages it already wrote keep their futures and only the rest fail.
+        """
+        groups: Dict[int, list] = {}
+        order = []
+        for topic, message in messages:
+            slot = self.slot(topic)
+            group = groups.setdefault(slot, [])
+            order.append((slot, len(group)))
+            group.append((topic, message))
+        results = {}
+        for slot, group in groups.items():
+            client = self._member(slot)
+            try:
+                if client is None:
+                    raise ConnectionError("Not connected")
+                results[slot] = client.publish_many(group, qos=qos, retain=retain)
+            except (OSError, TimeoutError, RuntimeError) as e:
+                # a member that dropped since _member() raises RuntimeError
+                futures = getattr(e, 'futures', [])
+                results[slot] = futures + [_failed() for _ in group[len(futures):]]
+        return [results[slot][i] for slot, i in order]
+
+    def _member(self, slot: int) -> Optional[MQTTClient]:
+        """The live connection of ``slot``, reconnecting it if it died"""
+        client = self.members[slot]
+        if client is not None and client.connected:
+            return client
+        with self._locks[slot]:
+            client = self.members[slot]
+            if client is not None and client.connected:
+                return client
+            now = time.monotonic()
+            if now < self._retry_at[slot]:
+                return None
+            if client is not None:
+                client.disconnect()
+                self.reconnects += 1
+            client = MQTTClient(self.host, self.port, max_inflight=self.max_inflight,
+                                client_id=f'{self.client_id}-{slot}' if self.client_id else '',
+                                protocol=self.protocol, ack_timeout=self.ack_timeout)
+            if not client.connect():
+                self.members[slot] = None
+                self._retry_at[slot] = now + self.reconnect_delay
+                return None
+            self.members[slot] = client
+            return client
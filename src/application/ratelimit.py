@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+# why a connection's reads were paused
+CONNECTION_LIMIT = 'connection'
+TOPIC_LIMIT = 'topic'
+RECEIVE_MAXIMUM = 'receive_maximum'
+THROTTLE_REASONS = (CONNECTION_LIMIT, TOPIC_LIMIT, RECEIVE_MAXIMUM)
+
+
+class TokenBucket:
+    """``rate`` tokens per second, holding at most ``burst``.
+
+    Taking more tokens than are left runs the bucket into debt instead of
+    refusing: the caller waits until the debt is paid back, so a flood is
+    slowed down to ``rate`` without losing anything.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, amount: float, now: float) -> float:
+        """Take ``amount`` tokens, returns the seconds to wait before using them"""
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - amount
+        self.tokens = tokens
+        self.stamp = now
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+
+def _buckets(messages: float, size: float, burst: float) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+    # a burst always fits at least one message
+    return (TokenBucket(messages, max(1.0, messages * burst)) if messages else None,
+            TokenBucket(size, size * burst) if size else None)
+
+
+class ConnectionLimits:
+    """Token buckets and throttle counters of one connection"""
+    __slots__ = ('messages', 'bytes', 'throttled', 'paused')
+
+    def __init__(self, messages: Optional[TokenBucket], size: Optional[TokenBucket]):
+        self.messages = messages
+        self.bytes = size
+        self.throttled = 0
+        self.paused = 0.0
+
+
+class RateLimits:
+    """What clients may publish, enforced by pausing their reads.
+
+    ``messages`` and ``bytes`` (payload bytes) per second apply to each
+    connection. ``topics`` maps a topic prefix to a (messages, bytes) per
+    second budget shared by everything published under it, the longest
+    matching prefix applies; 0 means unlimited. Buckets hold ``burst``
+    seconds worth of tokens. ``receive_maximum`` caps the QoS 1/2 publishes
+    of a connection whose acks are still queued, so a client that does not
+    read its acks stops being read.
+    """
+
+    def __init__(self, messages: float = 0, bytes: float = 0,
+                 topics: Optional[Dict[str, Tuple[float, float]]] = None,
+                 receive_maximum: int = 0, burst: float = 1.0):
+        self.messages = messages
+        self.bytes = bytes
+        self.burst = burst
+        self.receive_maximum = receive_maximum
+        # longest prefix first
+        self.topics = [(prefix, *_buckets(rate, size, burst))
+                       for prefix, (rate, size) in sorted((topics or {}).items(), key=lambda item: -len(item[0]))]
+        # totals per reason, including connections that are gone
+        self.throttled = Counter()
+        self.paused = 0.0
+        self._lock = threading.Lock()
+
+    def connect(self) -> ConnectionLimits:
+        """Limits for a new connection"""
+        return ConnectionLimits(*_buckets(self.messages, self.bytes, self.burst))
+
+    def publish_delay(self, limits: ConnectionLimits, topic: str, size: int) -> float:
+        """Seconds the connection waits before a publish of ``size`` bytes to ``topic`` is routed"""
+        now = time.monotonic()
+        delay = topic_delay = 0.0
+        if limits.messages is not None:
+            delay = limits.messages.take(1, now)
+        if limits.bytes is not None:
+            delay = max(delay, limits.bytes.take(size, now))
+        for prefix, messages, size_bucket in self.topics:
+            if topic.startswith(prefix):
+                with self._lock:
+                    # shared by every reader, so timed under the lock
+                    now = time.monotonic()
+                    if messages is not None:
+                        topic_delay = messages.take(1, now)
+                    if size_bucket is not None:
+                        topic_delay = max(topic_delay, size_bucket.take(size, now))
+                break
+        if not delay and not topic_delay:
+            return 0.0
+        # one pause, counted against the limit that made it longest
+        self.record(limits, CONNECTION_LIMIT if delay >= topic_delay else TOPIC_LIMIT, max(delay, topic_delay))
+        return max(delay, topic_delay)
+
+    def record(self, limits: ConnectionLimits, reason: str, paused: float):
+        """Count a throttle event that paused a connection for ``paused`` seconds"""
+        limits.throttled += 1
+        limits.paused += paused
+        with self._lock:
+            self.throttled[reason] += 1
+            self.paused += paused
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {f'throttled_{reason}': self.throttled[reason] for reason in THROTTLE_REASONS}
+            stats['throttled_seconds'] = round(self.paused, 3)
+            return stats
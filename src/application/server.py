@@ -2,8 +2,8 @@ import socket
 import threading
 import time
 from typing import Optional, Dict
-from ..protocol.flow import MessageFlow
-from ..protocol.packet import MQTTPacket, PacketType
+from ..protocol.packet import MQTTPacket, PacketType, PacketReader, control_frame
+from ..protocol.timer import default_wheel
 
 class MQTTServer:
     def __init__(self, port: int, host: str = ''):
@@ -11,18 +11,26 @@ class MQTTServer:
         self.port = port
         self.socket: Optional[socket.socket] = None
         self.running = False
+        # let several processes bind the same port, the kernel balances connections
+        self.reuse_port = False
+        # pending connects the kernel queues, a burst beyond it waits for SYN retransmits
+        self.backlog = 1024
         self.accept_thread: Optional[threading.Thread] = None
-        self.client_flows: Dict[socket.socket, MessageFlow] = {}
         self.client_threads: Dict[socket.socket, threading.Thread] = {}
         self._lock = threading.Lock()
+        # keep-alive deadlines of every connection share one timer wheel
+        self.timers = default_wheel()
+        self.last_activity: Dict[socket.socket, float] = {}
 
     def start(self):
         """启动MQTT服务器"""
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.socket.bind((self.host, self.port))
-            self.socket.listen(5)
+            self.socket.listen(self.backlog)
             self.running = True
             
             self.accept_thread = threading.Thread(target=self._accept_connections)
@@ -54,13 +62,9 @@ class MQTTServer:
             except:
                 pass
 
-        # 停止所有客户端flow
+        # 关闭所有客户端连接
         with self._lock:
-            for client_socket, flow in self.client_flows.items():
-                try:
-                    flow.stop()
-                except:
-                    pass
+            for client_socket in self.client_threads:
                 try:
                     client_socket.close()
                 except:
@@ -72,7 +76,6 @@ class MQTTServer:
                 thread.join(timeout=1)
 
         # 清理资源
-        self.client_flows.clear()
         self.client_threads.clear()
         
         if self.accept_thread and self.accept_thread.is_alive():
@@ -99,38 +102,71 @@ class MQTTServer:
                     print("Accept error, server stopping...")
                 break
 
+    def watch_keep_alive(self, client_socket, keep_alive: int):
+        """Disconnect the client once nothing arrives for 1.5 times its keep-alive"""
+        if not keep_alive:
+            return
+        timeout = keep_alive * 1.5
+        self.last_activity[client_socket] = time.monotonic()
+        self.timers.schedule(timeout, self._check_keep_alive, client_socket, timeout)
+
+    def touch(self, client_socket):
+        """Record traffic from a client, pushing back its keep-alive deadline"""
+        if client_socket in self.last_activity:
+            self.last_activity[client_socket] = time.monotonic()
+
+    def _check_keep_alive(self, client_socket, timeout: float):
+        # deadlines are checked lazily: traffic only updates last_activity and
+        # the timer is re-armed for the remaining time when it fires
+        last = self.last_activity.get(client_socket)
+        if last is None:
+            return
+        idle = time.monotonic() - last
+        if idle < timeout:
+            self.timers.schedule(timeout - idle, self._check_keep_alive, client_socket, timeout)
+            return
+        self.last_activity.pop(client_socket, None)
+        self.disconnect_idle(client_socket)
+
+    def disconnect_idle(self, client_socket):
+        """Break off a client that missed its keep-alive deadline"""
+        print("Keep-alive timeout, disconnecting client")
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def handle_client(self, client_socket):
         """改进的客户端处理方法"""
         try:
-            flow = MessageFlow(client_socket)
-            with self._lock:
-                self.client_flows[client_socket] = flow
-            flow.start()
-            
+            # the server only reads this socket: keep-alive is watched on the
+            # timer wheel, no per-connection flow or receiver thread is needed
+            reader = PacketReader()
             while self.running:
-                data = client_socket.recv(1024)
-                if not data:
+                packets = reader.read_from(client_socket)
+                if packets is None:
                     break
+                self.touch(client_socket)
                 
-                packet = MQTTPacket.decode(data)
-                if packet.packet_type == PacketType.CONNECT:
-                    response = flow.handle_connect(packet)
-                    if response:
-                        client_socket.send(response.encode())
-                elif packet.packet_type == PacketType.SUBSCRIBE:
-                    # 发送订阅确认
-                    ack = MQTTPacket(PacketType.SUBACK)
-                    client_socket.send(ack.encode())
+                for packet in packets:
+                    if packet.packet_type == PacketType.CONNECT:
+                        self.watch_keep_alive(client_socket, packet.keep_alive)
+                        client_socket.send(MQTTPacket(PacketType.CONNACK).encode(packet.protocol))
+                    elif packet.packet_type == PacketType.PINGREQ:
+                        client_socket.send(control_frame(PacketType.PINGRESP, packet.protocol))
+                    elif packet.packet_type == PacketType.SUBSCRIBE:
+                        # 发送订阅确认
+                        ack = MQTTPacket(PacketType.SUBACK, packet_id=packet.packet_id,
+                                         return_codes=[0] * len(packet.topic_filters))
+                        client_socket.send(ack.encode(packet.protocol))
         except Exception as e:
             if self.running:
                 print(f"Client handling error: {e}")
         finally:
             with self._lock:
-                if client_socket in self.client_flows:
-                    self.client_flows[client_socket].stop()
-                    del self.client_flows[client_socket]
                 if client_socket in self.client_threads:
                     del self.client_threads[client_socket]
+            self.last_activity.pop(client_socket, None)
             try:
                 client_socket.close()
             except:
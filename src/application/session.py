@@ -0,0 +1,358 @@
+import heapq
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# log record types
+_OPEN = 1
+_DROP = 2
+_SUBSCRIBE = 3
+_UNSUBSCRIBE = 4
+_ENQUEUE = 5
+_ACK = 6
+
+# body length, crc32 of type + body, type
+_HEADER = struct.Struct('!IIB')
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+_SEQ = struct.Struct('!Qd')
+
+SEGMENT_SUFFIX = '.seg'
+SNAPSHOT_SUFFIX = '.snap'
+
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return _U16.pack(len(data)) + data
+
+
+def _unpack_str(body: bytes, pos: int) -> Tuple[str, int]:
+    length = _U16.unpack_from(body, pos)[0]
+    pos += 2
+    return body[pos:pos + length].decode('utf-8'), pos + length
+
+
+def _record(record_type: int, body: bytes) -> bytes:
+    crc = zlib.crc32(body, zlib.crc32(bytes([record_type])))
+    return _HEADER.pack(len(body), crc, record_type) + body
+
+
+def _read_records(data) -> Iterator[Tuple[int, bytes]]:
+    """Records in ``data`` up to the zeroed tail or the first torn record"""
+    pos = 0
+    end = len(data)
+    while pos + _HEADER.size <= end:
+        length, crc, record_type = _HEADER.unpack_from(data, pos)
+        if not record_type:
+            return
+        start = pos + _HEADER.size
+        body = bytes(data[start:start + length])
+        if len(body) != length or zlib.crc32(body, zlib.crc32(bytes([record_type]))) != crc:
+            return
+        yield record_type, body
+        pos = start + length
+
+
+class SegmentLog:
+    """Append-only log split into preallocated, memory-mapped segments.
+
+    Appends are copied into the mapped segment and reach disk through the
+    page cache. ``compact`` replaces everything written so far with a
+    snapshot of live records, so recovery reads the snapshot plus the
+    segments written after it instead of the whole history.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 4 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segments_written = 0
+        self._number = 0
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._offset = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, number: int, suffix: str) -> str:
+        return os.path.join(self.directory, f'{number:08d}{suffix}')
+
+    def _numbers(self, suffix: str) -> List[int]:
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.endswith(suffix) and name[:-len(suffix)].isdigit():
+                numbers.append(int(name[:-len(suffix)]))
+        return sorted(numbers)
+
+    def replay(self) -> Iterator[Tuple[int, bytes]]:
+        """Yield the records of the latest snapshot and every segment after it.
+
+        Leaves the log positioned after the last intact record.
+        """
+        snapshots = self._numbers(SNAPSHOT_SUFFIX)
+        first = snapshots[-1] if snapshots else 0
+        if snapshots:
+            with open(self._path(first, SNAPSHOT_SUFFIX), 'rb') as f:
+                yield from _read_records(f.read())
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(self.directory, name))
+
+        segments = [n for n in self._numbers(SEGMENT_SUFFIX) if n >= first]
+        for number in segments:
+            with open(self._path(number, SEGMENT_SUFFIX), 'rb') as f:
+                data = f.read()
+            offset = 0
+            for record_type, body in _read_records(data):
+                offset += _HEADER.size + len(body)
+                yield record_type, body
+            self._number, self._offset = number, offset
+        self._remove_before(first)
+        if segments:
+            self._map_segment(self._number)
+        else:
+            self._roll(max(first, 1))
+
+    def append(self, data: bytes):
+        if self._map is None:
+            self._roll(1)
+        if self._offset + len(data) > len(self._map):
+            self._roll(self._number + 1, len(data))
+        self._map[self._offset:self._offset + len(data)] = data
+        self._offset += len(data)
+
+    def compact(self, records: Iterator[bytes]):
+        """Start a new segment and snapshot ``records`` as the state before it"""
+        self._roll(self._number + 1)
+        number = self._number
+        tmp = self._path(number, SNAPSHOT_SUFFIX + '.tmp')
+        with open(tmp, 'wb') as f:
+            for data in records:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(number, SNAPSHOT_SUFFIX))
+        self._remove_before(number)
+        self.segments_written = 0
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    def _roll(self, number: int, min_size: int = 0):
+        self.close()
+        path = self._path(number, SEGMENT_SUFFIX)
+        with open(path, 'wb') as f:
+            f.truncate(max(self.segment_size, min_size))
+        self._map_segment(number)
+        self._offset = 0
+        self.segments_written += 1
+
+    def _map_segment(self, number: int):
+        self._number = number
+        self._file = open(self._path(number, SEGMENT_SUFFIX), 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def _remove_before(self, number: int):
+        for suffix in (SEGMENT_SUFFIX, SNAPSHOT_SUFFIX):
+            for old in self._numbers(suffix):
+                if old < number:
+                    os.remove(self._path(old, suffix))
+
+
+class Session:
+    """Subscriptions and offline messages of a clean_session=false client"""
+
+    def __init__(self, client_id: str):
+        self.client_id = client_id
+        self.subscriptions: Dict[str, int] = {}
+        # seq -> (expiry, topic, payload)
+        self.queue: 'OrderedDict[int, Tuple[float, str, bytes]]' = OrderedDict()
+        self.next_seq = 1
+        self.dropped = 0
+        self.connected = False
+
+
+class SessionStore:
+    """Persistent sessions keyed by client id.
+
+    While a session's client is offline, QoS >= 1 publishes matching its
+    subscriptions are queued, up to ``max_queue`` messages (the oldest is
+    dropped first) and for at most ``message_ttl`` seconds; expiry times are
+    kept in a heap. With a ``directory`` every change is appended to a
+    SegmentLog, compacted every ``compact_segments`` segments, and sessions
+    are recovered from it on start.
+
+    The store is not thread-safe; callers serialize access.
+    """
+
+    def __init__(self, directory: str = None, max_queue: int = 1000, message_ttl: float = 3600.0,
+                 segment_size: int = 4 * 1024 * 1024, compact_segments: int = 4):
+        self.max_queue = max_queue
+        self.message_ttl = message_ttl
+        self.compact_segments = compact_segments
+        self.sessions: Dict[str, Session] = {}
+        # (expiry, client_id, seq), entries of delivered messages are skipped when popped
+        self._expiry: List[Tuple[float, str, int]] = []
+        # heap size at which entries of delivered and dropped messages are swept out
+        self._sweep_at = 1024
+        self.log = SegmentLog(directory, segment_size) if directory else None
+        if self.log:
+            self._recover()
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def get(self, client_id: str) -> Optional[Session]:
+        return self.sessions.get(client_id)
+
+    def open(self, client_id: str) -> Tuple[Session, bool]:
+        """Session for ``client_id``, returns it and whether it already existed"""
+        session = self.sessions.get(client_id)
+        if session is not None:
+            return session, True
+        session = self.sessions[client_id] = Session(client_id)
+        self._append(_OPEN, _pack_str(client_id))
+        return session, False
+
+    def drop(self, client_id: str) -> Optional[Session]:
+        session = self.sessions.pop(client_id, None)
+        if session is not None:
+            self._append(_DROP, _pack_str(client_id))
+        return session
+
+    def subscribe(self, session: Session, topic_filter: str, qos: int):
+        session.subscriptions[topic_filter] = qos
+        self._append(_SUBSCRIBE, _pack_str(session.client_id) + _pack_str(topic_filter) + bytes([qos]))
+
+    def unsubscribe(self, session: Session, topic_filter: str):
+        if session.subscriptions.pop(topic_filter, None) is not None:
+            self._append(_UNSUBSCRIBE, _pack_str(session.client_id) + _pack_str(topic_filter))
+
+    def enqueue(self, session: Session, topic: str, payload: bytes):
+        """Queue a message for an offline session"""
+        now = time.time()
+        self.expire(now)
+        seq = session.next_seq
+        expiry = now + self.message_ttl
+        payload = bytes(payload or b'')
+        self._add(session, seq, expiry, topic, payload)
+        self._append(_ENQUEUE, _pack_str(session.client_id) + _SEQ.pack(seq, expiry) +
+                     _pack_str(topic) + _U32.pack(len(payload)) + payload)
+
+    def take(self, session: Session) -> List[Tuple[str, bytes]]:
+        """Remove and return the session's queued ``(topic, payload)`` messages"""
+        self.expire()
+        if not session.queue:
+            return []
+        messages = [(topic, payload) for _, topic, payload in session.queue.values()]
+        last = next(reversed(session.queue))
+        session.queue.clear()
+        self._append(_ACK, _pack_str(session.client_id) + _SEQ.pack(last, 0))
+        return messages
+
+    def expire(self, now: float = None) -> int:
+        """Drop queued messages whose TTL has passed, returns how many"""
+        now = time.time() if now is None else now
+        heap = self._expiry
+        expired = 0
+        while heap and heap[0][0] <= now:
+            _, client_id, seq = heapq.heappop(heap)
+            session = self.sessions.get(client_id)
+            # a stale entry may name the seq of a newer message of a reopened session
+            message = session.queue.get(seq) if session is not None else None
+            if message is not None and message[0] <= now:
+                del session.queue[seq]
+                expired += 1
+        return expired
+
+    def flush(self):
+        if self.log:
+            self.log.flush()
+
+    def close(self):
+        if self.log:
+            self.log.close()
+
+    def _add(self, session: Session, seq: int, expiry: float, topic: str, payload: bytes):
+        session.next_seq = max(session.next_seq, seq + 1)
+        if len(session.queue) >= self.max_queue:
+            session.queue.popitem(last=False)
+            session.dropped += 1
+        session.queue[seq] = (expiry, topic, payload)
+        heapq.heappush(self._expiry, (expiry, session.client_id, seq))
+        if len(self._expiry) >= self._sweep_at:
+            self._sweep()
+
+    def _sweep(self):
+        """Rebuild the expiry heap from the queued messages.
+
+        Messages taken, dropped on overflow or of dropped sessions leave
+        their entries behind; sweeping once the heap doubled keeps it within
+        twice the queued messages at an amortized O(1) per enqueue.
+        """
+        self._expiry = [(expiry, client_id, seq) for client_id, session in self.sessions.items()
+                        for seq, (expiry, _, _) in session.queue.items()]
+        heapq.heapify(self._expiry)
+        self._sweep_at = max(1024, 2 * len(self._expiry))
+
+    def _append(self, record_type: int, body: bytes):
+        if not self.log:
+            return
+        self.log.append(_record(record_type, body))
+        if self.log.segments_written > self.compact_segments:
+            self.log.compact(self._snapshot())
+
+    def _snapshot(self) -> Iterator[bytes]:
+        """Records that recreate the live sessions"""
+        for client_id, session in self.sessions.items():
+            name = _pack_str(client_id)
+            yield _record(_OPEN, name)
+            for topic_filter, qos in session.subscriptions.items():
+                yield _record(_SUBSCRIBE, name + _pack_str(topic_filter) + bytes([qos]))
+            for seq, (expiry, topic, payload) in session.queue.items():
+                yield _record(_ENQUEUE, name + _SEQ.pack(seq, expiry) + _pack_str(topic) +
+                              _U32.pack(len(payload)) + payload)
+
+    def _recover(self):
+        now = time.time()
+        sessions = self.sessions
+        for record_type, body in self.log.replay():
+            client_id, pos = _unpack_str(body, 0)
+            if record_type == _OPEN:
+                sessions.setdefault(client_id, Session(client_id))
+                continue
+            if record_type == _DROP:
+                sessions.pop(client_id, None)
+                continue
+            session = sessions.get(client_id)
+            if session is None:
+                continue
+            if record_type == _SUBSCRIBE:
+                topic_filter, pos = _unpack_str(body, pos)
+                session.subscriptions[topic_filter] = body[pos]
+            elif record_type == _UNSUBSCRIBE:
+                topic_filter, _ = _unpack_str(body, pos)
+                session.subscriptions.pop(topic_filter, None)
+            elif record_type == _ENQUEUE:
+                seq, expiry = _SEQ.unpack_from(body, pos)
+                topic, pos = _unpack_str(body, pos + _SEQ.size)
+                length = _U32.unpack_from(body, pos)[0]
+                session.next_seq = max(session.next_seq, seq + 1)
+                if expiry > now:
+                    self._add(session, seq, expiry, topic, body[pos + 4:pos + 4 + length])
+            elif record_type == _ACK:
+                last = _SEQ.unpack_from(body, pos)[0]
+                while session.queue and next(iter(session.queue)) <= last:
+                    session.queue.popitem(last=False)
+        # start from the recovered state rather than the replayed history
+        self.log.compact(self._snapshot())
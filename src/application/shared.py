@@ -0,0 +1,74 @@
+import zlib
+from typing import Callable, Hashable, Optional, Tuple
+
+ROUND_ROBIN = 'round-robin'
+LEAST_OUTSTANDING = 'least-outstanding'
+STICKY = 'sticky'
+SHARE_STRATEGIES = (ROUND_ROBIN, LEAST_OUTSTANDING, STICKY)
+
+
+class SharedGroup:
+    """Members of one ``$share/<group>/<filter>`` subscription.
+
+    The group subscribes to the filter in the broker's topic trie like a
+    single subscriber, and every matching publish is handed to one member
+    chosen by ``strategy``:
+
+    - round-robin: members take turns
+    - least-outstanding: the member with the fewest queued frames, ties go
+      round-robin
+    - sticky: a hash of the topic, so one topic keeps going to the same
+      member while the membership does not change
+
+    The members are a tuple replaced on every change, so pick() needs no
+    lock while the broker adds or removes members.
+    """
+
+    def __init__(self, name: str, topic_filter: str, strategy: str = ROUND_ROBIN):
+        if strategy not in SHARE_STRATEGIES:
+            raise ValueError(f"Unknown share strategy: {strategy}")
+        self.name = name
+        self.topic_filter = topic_filter
+        self.strategy = strategy
+        self.members: Tuple[Hashable, ...] = ()
+        self._next = 0
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def add(self, member: Hashable) -> bool:
+        if member in self.members:
+            return False
+        self.members += (member,)
+        return True
+
+    def remove(self, member: Hashable) -> bool:
+        if member not in self.members:
+            return False
+        self.members = tuple(m for m in self.members if m != member)
+        return True
+
+    def pick(self, topic: str, depth: Callable[[Hashable], int]) -> Optional[Hashable]:
+        """The member that receives a publish to ``topic``.
+
+        ``depth`` returns a member's outbound queue depth and is only called
+        by the least-outstanding strategy.
+        """
+        members = self.members
+        if not members:
+            return None
+        if self.strategy == STICKY:
+            return members[zlib.crc32(topic.encode('utf-8')) % len(members)]
+        start = self._next % len(members)
+        self._next = start + 1
+        if self.strategy == ROUND_ROBIN:
+            return members[start]
+        best, best_depth = None, None
+        for i in range(len(members)):
+            member = members[(start + i) % len(members)]
+            member_depth = depth(member)
+            if best is None or member_depth < best_depth:
+                best, best_depth = member, member_depth
+                if not member_depth:
+                    break
+        return best
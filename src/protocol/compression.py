@@ -0,0 +1,138 @@
+import struct
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, Optional
+
+# Payload compression, negotiated at CONNECT. Once both sides agreed every
+# PUBLISH payload between them starts with a method byte:
+#   RAW                   payload as is
+#   DEFLATE               raw deflate stream
+#   DEFLATE_DICTIONARY    4-byte dictionary id, then a raw deflate stream
+#                         primed with that shared dictionary
+RAW = 0
+DEFLATE = 1
+DEFLATE_DICTIONARY = 2
+RAW_HEADER = bytes([RAW])
+
+MAX_PAYLOAD = 268435455
+
+_DICTIONARY_HEADER = struct.Struct('!BI')
+_WBITS = -15
+
+
+def dictionary_id(dictionary: Optional[bytes]) -> int:
+    """The nonzero id a shared dictionary is negotiated by, 0 for none"""
+    if not dictionary:
+        return 0
+    return zlib.crc32(dictionary) or 1
+
+
+def payload_dictionary(data) -> int:
+    """Id of the dictionary a compressed payload needs, 0 if it needs none"""
+    if len(data) >= _DICTIONARY_HEADER.size and data[0] == DEFLATE_DICTIONARY:
+        return _DICTIONARY_HEADER.unpack_from(data)[1]
+    return 0
+
+
+def decompress(data, dictionaries: Optional[Dict[int, bytes]] = None, max_size: int = MAX_PAYLOAD) -> bytes:
+    """Payload of a compressed payload, raises ValueError if it cannot be read"""
+    if not data:
+        raise ValueError("Empty compressed payload")
+    method = data[0]
+    if method == RAW:
+        return bytes(data[1:])
+    if method == DEFLATE:
+        decompressor = zlib.decompressobj(_WBITS)
+        body = data[1:]
+    elif method == DEFLATE_DICTIONARY:
+        if len(data) < _DICTIONARY_HEADER.size:
+            raise ValueError("Truncated dictionary id")
+        _, dictionary = _DICTIONARY_HEADER.unpack_from(data)
+        if not dictionaries or dictionary not in dictionaries:
+            raise ValueError(f"Unknown compression dictionary: {dictionary:#010x}")
+        decompressor = zlib.decompressobj(_WBITS, zdict=dictionaries[dictionary])
+        body = data[_DICTIONARY_HEADER.size:]
+    else:
+        raise ValueError(f"Unknown compression method: {method}")
+    try:
+        payload = decompressor.decompress(body, max_size)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed payload: {e}")
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Decompressed payload exceeds {max_size} bytes")
+    return payload
+
+
+class PayloadCodec:
+    """Compresses outgoing and decompresses incoming payloads of one connection.
+
+    Payloads shorter than ``threshold`` bytes, or that deflate does not
+    shrink, are sent RAW. With a ``dictionary`` (see train_dictionary),
+    which the peer must know by the same id, deflate starts from it, so
+    even small payloads of a repetitive format compress well.
+    """
+
+    def __init__(self, threshold: int = 256, level: int = 6, dictionary: Optional[bytes] = None):
+        self.threshold = threshold
+        self.level = level
+        self.dictionary = dictionary or None
+        self.dictionary_id = dictionary_id(dictionary)
+        self.dictionaries = {self.dictionary_id: dictionary} if self.dictionary else {}
+        if self.dictionary:
+            self._header = _DICTIONARY_HEADER.pack(DEFLATE_DICTIONARY, self.dictionary_id)
+            # loading the dictionary is the expensive part, so each payload
+            # starts from a copy of a compressor that already has
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS, zdict=self.dictionary)
+        else:
+            self._header = bytes([DEFLATE])
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS)
+
+    def encode(self, payload) -> bytes:
+        if len(payload) < self.threshold:
+            return RAW_HEADER + payload
+        compressor = self._compressor.copy()
+        body = compressor.compress(payload) + compressor.flush()
+        if len(body) + len(self._header) >= len(payload) + 1:
+            return RAW_HEADER + payload
+        return self._header + body
+
+    def decode(self, data) -> bytes:
+        return decompress(data, self.dictionaries)
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = 32 * 1024, segment: int = 8) -> bytes:
+    """Build a shared dictionary from sample payloads.
+
+    Byte runs made of ``segment``-long pieces that recur in at least a
+    tenth of the samples (keys, field order, fixed values) are kept, most
+    common last, where deflate reaches them with the shortest distances.
+    """
+    samples = [bytes(sample) for sample in samples]
+    pieces = Counter()
+    for sample in samples:
+        pieces.update({sample[i:i + segment] for i in range(len(sample) - segment + 1)})
+    common = max(2, len(samples) // 10)
+
+    runs = Counter()
+    for sample in samples:
+        found = set()
+        start = end = None
+        for i in range(len(sample) - segment + 1):
+            if pieces[sample[i:i + segment]] < common:
+                continue
+            if start is not None and i <= end:
+                end = i + segment
+            else:
+                if start is not None:
+                    found.add(sample[start:end])
+                start, end = i, i + segment
+        if start is not None:
+            found.add(sample[start:end])
+        runs.update(found)
+
+    dictionary = bytearray()
+    for run, _ in runs.most_common():
+        if len(dictionary) + len(run) > size:
+            continue
+        dictionary[:0] = run
+    return bytes(dictionary)
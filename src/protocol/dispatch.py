@@ -0,0 +1,140 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional
+
+INLINE = 'inline'
+THREAD = 'thread'
+PROCESS = 'process'
+DISPATCH_MODES = (INLINE, THREAD, PROCESS)
+
+Callback = Callable[[str, bytes], None]
+
+
+def _call(callback: Callback, topic: str, payload: bytes):
+    try:
+        callback(topic, payload)
+    except Exception as e:
+        print(f"Callback error: {e}")
+
+
+class InlineDispatcher:
+    """Runs callbacks on the receiving thread, which reads nothing meanwhile"""
+
+    def dispatch(self, topic: str, payload: bytes, callbacks: List[Callback]):
+        for callback in callbacks:
+            _call(callback, topic, payload)
+
+    def stop(self):
+        pass
+
+
+class ShardedDispatcher:
+    """Runs callbacks on ``workers`` threads, sharded by topic.
+
+    All messages of one topic go to the same worker, so they are handled in
+    the order they arrived while other topics run in parallel. Each worker
+    has a hand-off queue of ``queue_size`` messages; when it is full
+    ``dispatch`` blocks, so the receiving thread stops reading and a slow
+    handler pushes back on the broker instead of buffering without limit.
+    A callback that waits for the same connection (a blocking publish, say)
+    can therefore stall while its worker's queue is full.
+
+    Workers start with the first message and ``stop`` lets them finish the
+    queued messages, so a dispatcher can be reused after a reconnect.
+    """
+
+    def __init__(self, workers: int = 4, queue_size: int = 1000):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues: Optional[List[queue.Queue]] = None
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    @property
+    def backlog(self) -> int:
+        """Messages handed off and not yet handled"""
+        return sum(q.qsize() for q in self._queues or ())
+
+    def dispatch(self, topic: str, payload: bytes, callbacks: List[Callback]):
+        queues = self._queues or self._start()
+        queues[hash(topic) % len(queues)].put((topic, payload, callbacks))
+
+    def stop(self):
+        with self._lock:
+            queues, self._queues = self._queues, None
+            threads, self._threads = self._threads, []
+        for q in queues or ():
+            q.put(None)
+        for thread in threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def _start(self) -> List[queue.Queue]:
+        with self._lock:
+            if self._queues is None:
+                queues = [queue.Queue(self.queue_size) for _ in range(self.workers)]
+                for i, q in enumerate(queues):
+                    thread = threading.Thread(target=self._work, args=(q,), name=f'dispatch-{i}')
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+                self._queues = queues
+            return self._queues
+
+    def _work(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            topic, payload, callbacks = item
+            for callback in callbacks:
+                self._call(callback, topic, payload)
+
+    def _call(self, callback: Callback, topic: str, payload: bytes):
+        _call(callback, topic, payload)
+
+
+class ProcessDispatcher(ShardedDispatcher):
+    """ShardedDispatcher that runs CPU-heavy callbacks in a process pool.
+
+    Each shard thread waits for its callback to finish in the pool before
+    the next, which keeps per-topic order. Callbacks and payloads are
+    pickled, so callbacks must be module-level functions. Pool processes are
+    spawned rather than forked, so they inherit neither the receiving
+    threads nor open sockets.
+    """
+
+    def __init__(self, workers: int = 4, queue_size: int = 1000):
+        super().__init__(workers, queue_size)
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def stop(self):
+        super().stop()
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def _start(self) -> List[queue.Queue]:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return super()._start()
+
+    def _call(self, callback: Callback, topic: str, payload: bytes):
+        try:
+            self._pool.submit(callback, topic, payload).result()
+        except Exception as e:
+            print(f"Callback error: {e}")
+
+
+def create_dispatcher(mode: str = INLINE, workers: int = 4, queue_size: int = 1000):
+    """Dispatcher for one of DISPATCH_MODES"""
+    if mode == INLINE:
+        return InlineDispatcher()
+    if mode == THREAD:
+        return ShardedDispatcher(workers, queue_size)
+    if mode == PROCESS:
+        return ProcessDispatcher(workers, queue_size)
+    raise ValueError(f"Unknown dispatch mode: {mode}")
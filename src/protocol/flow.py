@@ -1,126 +1,416 @@
 import threading
-import time
-from typing import Callable, Optional
-from .packet import MQTTPacket, PacketType
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from .packet import (MQTTPacket, PacketType, PacketReader, PROTOCOL_LEGACY, PROTOCOL_MQTT311, SUBACK_FAILURE,
+                     ack_frame, control_frame, publish_prefix)
+from .topic import match_filter, topic_matches
+from .timer import TimerWheel, default_wheel
+from .dispatch import InlineDispatcher
+from .compression import PayloadCodec, RAW_HEADER
+from .stream import PayloadSource, PayloadStream, open_payload, send_payload
 
 class MessageFlow:
-    def __init__(self, socket=None):
+    def __init__(self, socket=None, max_inflight: int = 64, ack_timeout: float = 10.0,
+                 protocol: str = PROTOCOL_MQTT311, retry_interval: float = 5.0,
+                 timers: Optional[TimerWheel] = None, dispatcher=None,
+                 compression: Optional[PayloadCodec] = None, stream_threshold: int = 0,
+                 stream_dir: Optional[str] = None):
         self.socket = socket
+        self.protocol = protocol
         self.running = False
         self.callbacks = {}
+        # called for publishes no subscription callback matches, such as
+        # messages queued for a resumed session before it subscribes again
+        self.on_message: Optional[Callable[[str, bytes], None]] = None
+        # runs the callbacks of received publishes, inline on the receiver
+        # thread by default, see dispatch.py for threads and processes
+        self.dispatcher = dispatcher or InlineDispatcher()
+        # payload compression offered at CONNECT, codec is what the CONNACK granted
+        self.compression = compression
+        self.codec: Optional[PayloadCodec] = None
+        self.connack = Future()
         self.keep_alive_interval = 30
+        self.max_inflight = max_inflight
+        self.ack_timeout = ack_timeout
+        # unacknowledged QoS 1 publishes are resent with DUP set this often
+        self.retry_interval = retry_interval
+        # keep-alive pings and retransmits run on a shared timer wheel
+        self._timers = timers or default_wheel()
+        self._ping_timer = None
+        self._retries = {}
         self._receiver_thread = None
-        self._keep_alive_thread = None
+        # received publishes larger than stream_threshold bytes are spooled
+        # to a temp file in stream_dir, callbacks get the PayloadStream
+        self._reader = PacketReader(protocol=protocol, stream_threshold=stream_threshold, stream_dir=stream_dir)
+        self._send_lock = threading.Lock()
+        # unacknowledged PUBLISH/SUBSCRIBE futures keyed by packet id
+        self._inflight: Dict[int, Future] = {}
+        self._pending_subacks: Dict[int, Future] = {}
+        self._inflight_lock = threading.Lock()
+        self._window = threading.BoundedSemaphore(max_inflight)
+        self._next_id = 0
 
     def set_socket(self, socket):
         """设置新的socket连接"""
         self.socket = socket
+        self._reader.reset()
 
     def start(self):
         if not self.socket:
             raise RuntimeError("Socket not set")
         self.running = True
+        self.codec = None
+        self.connack = Future()
         self._receiver_thread = threading.Thread(target=self._receive_loop)
-        self._keep_alive_thread = threading.Thread(target=self._keep_alive_loop)
         self._receiver_thread.daemon = True
-        self._keep_alive_thread.daemon = True
         self._receiver_thread.start()
-        self._keep_alive_thread.start()
+        self._ping_timer = self._timers.schedule(self.keep_alive_interval, self._keep_alive)
 
     def stop(self):
         self.running = False
+        if self._ping_timer:
+            self._ping_timer.cancel()
         if self._receiver_thread:
             self._receiver_thread.join()
-        if self._keep_alive_thread:
-            self._keep_alive_thread.join()
+        self.dispatcher.stop()
 
-    def publish(self, topic: str, payload: bytes) -> bool:
-        packet = MQTTPacket(PacketType.PUBLISH, topic=topic, payload=payload)
-        self.socket.send(packet.encode())
-        # Wait for acknowledgment
+    @property
+    def connected(self) -> bool:
+        """True while the receiver thread is reading from the socket"""
+        return self.running and self._receiver_thread is not None and self._receiver_thread.is_alive()
+
+    @property
+    def inflight(self) -> int:
+        """Number of publishes sent and not yet acknowledged"""
+        return len(self._inflight)
+
+    def publish(self, topic: str, payload: bytes, qos: int = 1, retain: bool = False) -> bool:
+        """Publish and wait for the PUBACK"""
         try:
-            ack = self._receive_packet()
-            return ack and ack.packet_type == PacketType.PUBACK
-        except:
+            return self.publish_async(topic, payload, qos=qos, retain=retain).result(self.ack_timeout)
+        except Exception:
             return False
 
+    def publish_async(self, topic: str, payload: bytes, timeout: Optional[float] = None,
+                      qos: int = 1, retain: bool = False) -> Future:
+        """Send a PUBLISH without waiting for its acknowledgment.
+
+        Blocks only while ``max_inflight`` publishes are unacknowledged. The
+        returned future resolves to True when the PUBACK arrives, or False
+        if the connection is lost first. QoS 0 publishes are resolved as
+        soon as they are written (the legacy format acknowledges every
+        publish).
+        """
+        if qos not in (0, 1):
+            raise ValueError(f"Unsupported QoS for publish: {qos}")
+        if self.codec:
+            payload = self.codec.encode(payload)
+        if qos == 0 and self.protocol != PROTOCOL_LEGACY:
+            future = Future()
+            packet = MQTTPacket(PacketType.PUBLISH, topic=topic, payload=payload, retain=retain)
+            self._send(packet.encode(self.protocol))
+            future.set_result(True)
+            return future
+
+        if not self._window.acquire(timeout=timeout):
+            raise TimeoutError("In-flight window is full")
+        packet_id, packet, future = self._track_publish(topic, payload, retain)
+        try:
+            self._send(packet.encode(self.protocol))
+        except Exception:
+            self._complete_publish(packet_id, False)
+            raise
+        return future
+
+    def publish_many(self, messages: Iterable[Tuple[str, bytes]], qos: int = 1,
+                     retain: bool = False) -> List[Future]:
+        """Publish ``(topic, payload)`` pairs with as few socket writes as possible.
+
+        Frames are encoded into one buffer that is written when the in-flight
+        window fills up and once at the end. Returns one future per message,
+        resolved like those of ``publish_async``.
+
+        If sending fails partway the error is raised with a ``futures``
+        attribute: the futures of the messages taken so far, in order. Those
+        already written resolve as usual, the rest are failed; messages not
+        yet taken have none.
+        """
+        if qos not in (0, 1):
+            raise ValueError(f"Unsupported QoS for publish: {qos}")
+        acked = qos == 1 or self.protocol == PROTOCOL_LEGACY
+        futures = []
+        buffer = bytearray()
+        # QoS 1 ids in the buffer, and QoS 0 futures resolved once it is written
+        unsent, written = [], []
+        try:
+            for topic, payload in messages:
+                if self.codec:
+                    payload = self.codec.encode(payload)
+                if not acked:
+                    future = Future()
+                    packet = MQTTPacket(PacketType.PUBLISH, topic=topic, payload=payload, retain=retain)
+                    written.append(future)
+                else:
+                    if not self._window.acquire(blocking=False):
+                        # wait for acks only after what is already encoded went out
+                        self._flush(buffer, unsent, written)
+                        if not self._window.acquire(timeout=self.ack_timeout):
+                            raise TimeoutError("In-flight window is full")
+                    packet_id, packet, future = self._track_publish(topic, payload, retain)
+                    unsent.append(packet_id)
+                buffer += packet.encode(self.protocol)
+                futures.append(future)
+            self._flush(buffer, unsent, written)
+        except Exception as e:
+            for packet_id in unsent:
+                self._complete_publish(packet_id, False)
+            for future in written:
+                future.set_result(False)
+            # written publishes may still be acked, the caller must not resend them
+            e.futures = futures
+            raise
+        return futures
+
+    def publish_stream(self, topic: str, source: PayloadSource, qos: int = 1, retain: bool = False,
+                       timeout: Optional[float] = None) -> Future:
+        """Publish a file path, file object or buffer without reading it into memory.
+
+        The PUBLISH header is written first and the body after it with
+        sendfile, a buffer as it is. Resolved like the futures of
+        ``publish_async``, except that a QoS 1 stream is sent once and not
+        retransmitted. An active codec marks the payload RAW, it is never
+        compressed.
+        """
+        if qos not in (0, 1):
+            raise ValueError(f"Unsupported QoS for publish: {qos}")
+        if self.protocol == PROTOCOL_LEGACY:
+            raise ValueError("The legacy format cannot stream payloads")
+        body, size, opened = open_payload(source)
+        try:
+            future = Future()
+            packet_id = 0
+            if qos:
+                if not self._window.acquire(timeout=timeout):
+                    raise TimeoutError("In-flight window is full")
+                with self._inflight_lock:
+                    packet_id = self._allocate_id(self._inflight)
+                    self._inflight[packet_id] = future
+            if self.codec:
+                prefix = publish_prefix(topic, len(RAW_HEADER) + size, qos, packet_id, retain) + RAW_HEADER
+            else:
+                prefix = publish_prefix(topic, size, qos, packet_id, retain)
+            try:
+                with self._send_lock:
+                    self.socket.sendall(prefix)
+                    send_payload(self.socket, body, size)
+            except Exception:
+                if qos:
+                    self._complete_publish(packet_id, False)
+                raise
+            if not qos:
+                future.set_result(True)
+            return future
+        finally:
+            if opened:
+                body.close()
+
+    def _flush(self, buffer: bytearray, unsent: List[int], written: List[Future]):
+        if buffer:
+            self._send(bytes(buffer))
+            buffer.clear()
+        unsent.clear()
+        for future in written:
+            future.set_result(True)
+        written.clear()
+
+    def _track_publish(self, topic: str, payload: bytes, retain: bool) -> Tuple[int, MQTTPacket, Future]:
+        """Register a QoS 1 publish that holds a window slot, arming its retransmit"""
+        future = Future()
+        with self._inflight_lock:
+            packet_id = self._allocate_id(self._inflight)
+            self._inflight[packet_id] = future
+        packet = MQTTPacket(PacketType.PUBLISH, topic=topic, payload=payload, packet_id=packet_id,
+                            qos=1, retain=retain)
+        self._retries[packet_id] = self._timers.schedule(self.retry_interval, self._retransmit,
+                                                         packet_id, packet, future)
+        return packet_id, packet, future
+
     def handle_connect(self, packet: 'MQTTPacket') -> 'MQTTPacket':
         """处理连接请求"""
         if packet.packet_type == PacketType.CONNECT:
             return MQTTPacket(PacketType.CONNACK)
         return None
 
-    def subscribe(self, topic: str, callback: Callable[[str, bytes], None]) -> bool:
+    def subscribe(self, topic: str, callback: Callable[[str, bytes], None], qos: int = 0) -> bool:
         """修复的订阅方法"""
+        packet_id = 0
         try:
             self.callbacks[topic] = callback  # 先注册回调
-            packet = MQTTPacket(PacketType.SUBSCRIBE, topic=topic)
-            self.socket.send(packet.encode())
-            # 等待订阅确认
-            for _ in range(3):  # 重试3次
-                data = self.socket.recv(1024)
-                if data:
-                    ack = MQTTPacket.decode(data)
-                    if ack.packet_type == PacketType.SUBACK:
-                        print(f"Successfully subscribed to {topic}")
-                        return True
+            future = Future()
+            with self._inflight_lock:
+                packet_id = self._allocate_id(self._pending_subacks)
+                self._pending_subacks[packet_id] = future
+            packet = MQTTPacket(PacketType.SUBSCRIBE, topic=topic, packet_id=packet_id, qos=qos)
+            self._send(packet.encode(self.protocol))
+            # 等待订阅确认, matched by packet id on the receiver thread
+            if future.result(self.ack_timeout):
+                print(f"Successfully subscribed to {topic}")
+                return True
             return False
         except Exception as e:
             print(f"Subscribe error: {e}")
+            with self._inflight_lock:
+                self._pending_subacks.pop(packet_id, None)
             if topic in self.callbacks:
                 del self.callbacks[topic]
             return False
 
-    def _receive_packet(self) -> Optional[MQTTPacket]:
+    def _allocate_id(self, in_use: Dict[int, Future]) -> int:
+        """Next free packet id in 1..65535, called with _inflight_lock held"""
+        while True:
+            self._next_id = self._next_id % 65535 + 1
+            if self._next_id not in in_use:
+                return self._next_id
+
+    def _send(self, data: bytes):
+        with self._send_lock:
+            self.socket.sendall(data)
+
+    def _retransmit(self, packet_id: int, packet: MQTTPacket, future: Future):
+        """Resend an unacknowledged publish, runs on the timer wheel"""
+        if future.done() or not self.running:
+            return
+        packet.dup = True
         try:
-            data = self.socket.recv(1024)
-            if data:
-                return MQTTPacket.decode(data)
-        except:
-            pass
-        return None
+            self._send(packet.encode(self.protocol))
+        except OSError:
+            return
+        with self._inflight_lock:
+            # the ack may have arrived, and the id been reused, while resending
+            if self._inflight.get(packet_id) is future:
+                self._retries[packet_id] = self._timers.schedule(self.retry_interval, self._retransmit,
+                                                                 packet_id, packet, future)
+
+    def _complete_publish(self, packet_id: int, result: bool):
+        with self._inflight_lock:
+            future = self._inflight.pop(packet_id, None)
+            timer = self._retries.pop(packet_id, None)
+        if timer is not None:
+            timer.cancel()
+        if future is not None:
+            self._window.release()
+            future.set_result(result)
+
+    def _fail_pending(self):
+        """Resolve every outstanding ack as failed once the connection is gone"""
+        with self._inflight_lock:
+            publishes, self._inflight = self._inflight, {}
+            subacks, self._pending_subacks = self._pending_subacks, {}
+            retries, self._retries = self._retries, {}
+        for timer in retries.values():
+            timer.cancel()
+        for future in publishes.values():
+            self._window.release()
+            future.set_result(False)
+        for future in subacks.values():
+            future.set_result(False)
 
     def _receive_loop(self):
-        while self.running:
-            try:
-                packet = self._receive_packet()
-                if packet:
+        try:
+            while self.running:
+                packets = self._reader.read_from(self.socket)
+                if packets is None:
+                    break
+                for packet in packets:
                     self._handle_packet(packet)
-            except Exception as e:
+        except Exception as e:
+            if self.running:
                 print(f"Receive error: {e}")
-                break
+        finally:
+            self._fail_pending()
 
     def _handle_packet(self, packet: MQTTPacket):
         """改进的包处理方法"""
         try:
-            if packet.packet_type == PacketType.PUBLISH and packet.topic and packet.payload:
-                print(f"Received PUBLISH for topic: {packet.topic}")
-                if packet.topic in self.callbacks:
-                    callback = self.callbacks[packet.topic]
-                    if callback:
-                        try:
-                            callback(packet.topic, packet.payload)
-                        except Exception as e:
-                            print(f"Callback error: {e}")
+            if packet.packet_type == PacketType.PUBLISH and packet.stream is not None:
+                packet.stream.add_done_callback(lambda stream: stream.complete and self._handle_stream(packet))
+            elif packet.packet_type == PacketType.PUBLISH:
+                if packet.topic and packet.payload:
+                    callbacks = self._match_callbacks(packet.topic)
+                    if callbacks:
+                        payload = self.codec.decode(packet.payload) if self.codec else packet.payload
+                        self.dispatcher.dispatch(packet.topic, payload, callbacks)
+                if packet.qos:
+                    ack_type = PacketType.PUBACK if packet.qos == 1 else PacketType.PUBREC
+                    self._send(ack_frame(ack_type, packet.packet_id, self.protocol))
+            elif packet.packet_type == PacketType.PUBACK:
+                self._complete_publish(packet.packet_id, True)
             elif packet.packet_type == PacketType.PINGREQ:
                 self._send_ping_response()
             elif packet.packet_type == PacketType.SUBACK:
-                print("Subscription acknowledged by broker")
+                with self._inflight_lock:
+                    future = self._pending_subacks.pop(packet.packet_id, None)
+                if future is not None:
+                    future.set_result(SUBACK_FAILURE not in (packet.return_codes or ()))
+            elif packet.packet_type == PacketType.PUBREL:
+                self._send(ack_frame(PacketType.PUBCOMP, packet.packet_id, self.protocol))
+            elif packet.packet_type == PacketType.CONNACK:
+                self._handle_connack(packet)
         except Exception as e:
             print(f"Packet handling error: {e}")
 
-    def _keep_alive_loop(self):
-        while self.running:
-            try:
-                ping = MQTTPacket(PacketType.PINGREQ)
-                self.socket.send(ping.encode())
-                time.sleep(self.keep_alive_interval)
-            except:
-                break
+    def _handle_stream(self, packet: MQTTPacket):
+        """Dispatch a streamed publish once all of it has arrived, then ack it"""
+        try:
+            stream: PayloadStream = packet.stream
+            callbacks = self._match_callbacks(packet.topic)
+            if callbacks:
+                payload = stream
+                if self.codec:
+                    if stream.read(len(RAW_HEADER)) == RAW_HEADER:
+                        stream.start = len(RAW_HEADER)
+                    else:
+                        # compressed payloads are decompressed in memory
+                        payload = self.codec.decode(stream.read())
+                self.dispatcher.dispatch(packet.topic, payload, callbacks)
+            if packet.qos:
+                ack_type = PacketType.PUBACK if packet.qos == 1 else PacketType.PUBREC
+                self._send(ack_frame(ack_type, packet.packet_id, self.protocol))
+        except Exception as e:
+            print(f"Packet handling error: {e}")
+
+    def _handle_connack(self, packet: MQTTPacket):
+        if packet.compression is not None and self.compression is not None:
+            if packet.compression == self.compression.dictionary_id:
+                self.codec = self.compression
+            else:
+                # the broker does not know our dictionary
+                self.codec = PayloadCodec(self.compression.threshold, self.compression.level)
+        if not self.connack.done():
+            self.connack.set_result(packet)
+
+    def _match_callbacks(self, topic: str):
+        """Callbacks whose subscription filter matches ``topic``"""
+        callback = self.callbacks.get(topic)
+        if callback:
+            return [callback]
+        callbacks = [cb for topic_filter, cb in list(self.callbacks.items())
+                     if cb and topic_matches(match_filter(topic_filter), topic)]
+        if not callbacks and self.on_message:
+            return [self.on_message]
+        return callbacks
+
+    def _keep_alive(self):
+        if not self.running:
+            return
+        try:
+            self._send(control_frame(PacketType.PINGREQ, self.protocol))
+        except:
+            return
+        self._ping_timer = self._timers.schedule(self.keep_alive_interval, self._keep_alive)
 
     def _send_ping_response(self):
         try:
-            resp = MQTTPacket(PacketType.PINGRESP)
-            self.socket.send(resp.encode())
+            self._send(control_frame(PacketType.PINGRESP, self.protocol))
         except:
-            pass
\ No newline at end of file
+            pass
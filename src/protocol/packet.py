@@ -1,4 +1,7 @@
+import struct
 from enum import Enum, auto
+from typing import List, Optional
+from .stream import PayloadStream
 
 class PacketType(Enum):
     CONNECT = auto()
@@ -10,27 +13,238 @@ class PacketType(Enum):
     PINGREQ = auto()
     PINGRESP = auto()
     DISCONNECT = auto()
+    UNSUBSCRIBE = auto()
+    UNSUBACK = auto()
+    PUBREC = auto()
+    PUBREL = auto()
+    PUBCOMP = auto()
+
+# Wire formats. The legacy format writes PacketType.value as the first byte
+# and uses 2-byte length prefixes; MQTT 3.1.1 uses the standard fixed header
+# with a variable-length remaining length.
+PROTOCOL_LEGACY = 'legacy'
+PROTOCOL_MQTT311 = 'mqtt311'
+
+# packets that carry a 2-byte packet identifier right after the type byte
+IDENTIFIED_TYPES = (PacketType.PUBLISH, PacketType.PUBACK, PacketType.SUBSCRIBE, PacketType.SUBACK,
+                    PacketType.UNSUBSCRIBE, PacketType.UNSUBACK, PacketType.PUBREC, PacketType.PUBREL,
+                    PacketType.PUBCOMP)
+
+# MQTT 3.1.1 control packet type codes (upper nibble of the fixed header)
+MQTT_TYPE_CODES = {
+    PacketType.CONNECT: 1,
+    PacketType.CONNACK: 2,
+    PacketType.PUBLISH: 3,
+    PacketType.PUBACK: 4,
+    PacketType.PUBREC: 5,
+    PacketType.PUBREL: 6,
+    PacketType.PUBCOMP: 7,
+    PacketType.SUBSCRIBE: 8,
+    PacketType.SUBACK: 9,
+    PacketType.UNSUBSCRIBE: 10,
+    PacketType.UNSUBACK: 11,
+    PacketType.PINGREQ: 12,
+    PacketType.PINGRESP: 13,
+    PacketType.DISCONNECT: 14,
+}
+_TYPES_BY_CODE = {code: packet_type for packet_type, code in MQTT_TYPE_CODES.items()}
+MQTT_TYPES = [_TYPES_BY_CODE.get(code) for code in range(16)]
+
+# fixed header flags required by the spec for these types
+_FIXED_FLAGS = {PacketType.PUBREL: 0x02, PacketType.SUBSCRIBE: 0x02, PacketType.UNSUBSCRIBE: 0x02}
+# first byte of the fixed header, a PUBLISH adds its dup/qos/retain flags
+_MQTT_HEADERS = {packet_type: (code << 4) | _FIXED_FLAGS.get(packet_type, 0)
+                 for packet_type, code in MQTT_TYPE_CODES.items()}
+_PUBLISH_HEADER = _MQTT_HEADERS[PacketType.PUBLISH]
+
+# legacy type byte -> PacketType, so decoding does not construct the Enum
+_LEGACY_TYPES = [None] * 256
+for _packet_type in PacketType:
+    _LEGACY_TYPES[_packet_type.value] = _packet_type
+_LEGACY_IDENTIFIED = frozenset(packet_type.value for packet_type in IDENTIFIED_TYPES)
+# length-prefixed fields that follow the packet identifier of a legacy frame
+_LEGACY_FIELDS = {PacketType.PUBLISH.value: 2, PacketType.SUBSCRIBE.value: 1, PacketType.UNSUBSCRIBE.value: 1}
+
+MAX_REMAINING_LENGTH = 268435455
+PROTOCOL_NAME = b'MQTT'
+PROTOCOL_LEVEL = 4
+
+# Payload compression is a tinyMQTT extension: a CONNECT with the reserved
+# flag set ends with the dictionary id it asks for, and a CONNACK granting
+# it sets acknowledge flag 0x02 and carries the id it accepted.
+CONNECT_COMPRESSION = 0x01
+CONNACK_COMPRESSION = 0x02
+
+# CONNACK return codes
+CONNACK_ACCEPTED = 0
+CONNACK_BAD_PROTOCOL = 1
+CONNACK_IDENTIFIER_REJECTED = 2
+CONNACK_NOT_AUTHORIZED = 5
+SUBACK_FAILURE = 0x80
+
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+_ACK = struct.Struct('!BBH')
+_LEGACY_ACK = struct.Struct('!BH')
+_SHORT_LENGTHS = [bytes([length]) for length in range(128)]
+
+
+def encode_remaining_length(length: int) -> bytes:
+    """Encode the MQTT variable-length remaining length (1-4 bytes)"""
+    if 0 <= length < 128:
+        return _SHORT_LENGTHS[length]
+    if not 0 <= length <= MAX_REMAINING_LENGTH:
+        raise ValueError(f"Remaining length out of range: {length}")
+    out = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        if length:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_remaining_length(data, pos: int, end: int):
+    """Decode a remaining length starting at ``data[pos]``.
+
+    Returns ``(length, bytes_used)`` or None if the field is incomplete.
+    """
+    length = 0
+    for i in range(4):
+        if pos + i >= end:
+            return None
+        byte = data[pos + i]
+        length |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return length, i + 1
+    raise ValueError("Malformed remaining length")
+
+
+def publish_prefix(topic, payload_length: int, qos: int = 0, packet_id: int = 0,
+                   retain: bool = False, dup: bool = False) -> bytes:
+    """Everything of an MQTT 3.1.1 PUBLISH frame before a payload of ``payload_length`` bytes"""
+    topic = _as_bytes(topic)
+    prefix = bytearray([_PUBLISH_HEADER | (dup << 3) | (qos << 1) | int(retain)])
+    prefix += encode_remaining_length(2 + len(topic) + (2 if qos else 0) + payload_length)
+    prefix += _U16.pack(len(topic))
+    prefix += topic
+    if qos:
+        prefix += _U16.pack(packet_id)
+    return bytes(prefix)
+
+
+def _remaining_length_size(length: int) -> int:
+    if length < 128:
+        return 1
+    if length < 16384:
+        return 2
+    if length < 2097152:
+        return 3
+    return 4
+
+
+def _as_bytes(value) -> bytes:
+    if value is None:
+        return b''
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
 
 class MQTTPacket:
-    def __init__(self, packet_type: PacketType, topic: str = None, payload: bytes = None, keep_alive: int = 60):
+    # a packet is allocated per frame, so no per-instance __dict__
+    __slots__ = ('packet_type', 'topic', 'payload', 'keep_alive', 'packet_id', 'qos', 'retain', 'dup',
+                 'client_id', 'clean_session', 'username', 'password', 'will_topic', 'will_payload',
+                 'subscriptions', 'return_code', 'return_codes', 'session_present', 'compression', 'compressed',
+                 'protocol', 'raw_data', 'stream')
+
+    def __init__(self, packet_type: PacketType, topic: str = None, payload: bytes = None, keep_alive: int = 60,
+                 packet_id: int = 0, qos: int = 0, retain: bool = False, dup: bool = False,
+                 client_id: str = '', clean_session: bool = True, username: str = None, password: bytes = None,
+                 subscriptions: list = None, return_code: int = 0, return_codes: list = None,
+                 session_present: bool = False, compression: Optional[int] = None):
         self.packet_type = packet_type
         self.topic = topic
         self.payload = payload
         self.keep_alive = keep_alive
+        self.packet_id = packet_id
+        self.qos = qos
+        self.retain = retain
+        self.dup = dup
+        # CONNECT
+        self.client_id = client_id
+        self.clean_session = clean_session
+        self.username = username
+        self.password = password
+        self.will_topic = None
+        self.will_payload = None
+        # SUBSCRIBE/UNSUBSCRIBE: [(topic_filter, qos)]
+        self.subscriptions = subscriptions
+        # CONNACK / SUBACK
+        self.return_code = return_code
+        self.return_codes = return_codes
+        self.session_present = session_present
+        # CONNECT / CONNACK: payload compression asked for / granted, as the
+        # shared dictionary id (0 for plain deflate), None without
+        self.compression = compression
+        # PUBLISH: the payload starts with a compression method byte
+        self.compressed = False
+        # wire format the packet was decoded from, and the frame itself when
+        # the reader keeps raw frames
+        self.protocol = None
+        self.raw_data = None
+        # PUBLISH: the payload, still arriving, when a reader streams it
+        self.stream: Optional[PayloadStream] = None
+
+    @property
+    def topic_filters(self) -> list:
+        """``[(topic_filter, qos)]`` of a SUBSCRIBE/UNSUBSCRIBE, whatever its wire format"""
+        if self.subscriptions:
+            return self.subscriptions
+        if self.topic:
+            return [(self.topic, self.qos)]
+        return []
 
-    def encode(self) -> bytes:
+    def encode(self, protocol: str = PROTOCOL_MQTT311) -> bytes:
         """改进的编码方法"""
+        if protocol == PROTOCOL_LEGACY:
+            return self._encode_legacy()
+        buffer = bytearray(self.encoded_length())
+        self.encode_into(buffer)
+        return bytes(buffer)
+
+    def encode_prefix(self, protocol: str = PROTOCOL_MQTT311) -> bytes:
+        """Encode everything of a PUBLISH frame that precedes the payload.
+
+        Sending the prefix followed by the payload buffer produces the same
+        bytes as encode() without copying the payload.
+        """
+        topic = _as_bytes(self.topic)
+        payload_length = len(_as_bytes(self.payload))
+        if protocol == PROTOCOL_LEGACY:
+            return (bytes([self.packet_type.value]) + _U16.pack(self.packet_id) +
+                    _U16.pack(len(topic)) + topic + _U16.pack(payload_length))
+        return publish_prefix(topic, payload_length, self.qos, self.packet_id, self.retain, self.dup)
+
+    def _encode_legacy(self) -> bytes:
         try:
             data = bytearray([self.packet_type.value])
-            if self.topic:
-                topic_bytes = self.topic.encode('utf-8')
+            if self.packet_type in IDENTIFIED_TYPES:
+                data.extend(self.packet_id.to_bytes(2, 'big'))
+            # PUBLISH/SUBSCRIBE always carry their length fields so that a
+            # stream reader can find the frame boundary
+            framed = self.packet_type in (PacketType.PUBLISH, PacketType.SUBSCRIBE, PacketType.UNSUBSCRIBE)
+            if self.topic or framed:
+                topic_bytes = self.topic.encode('utf-8') if self.topic else b''
                 data.extend(len(topic_bytes).to_bytes(2, 'big'))
                 data.extend(topic_bytes)
-            if self.payload:
+            if self.payload or self.packet_type == PacketType.PUBLISH:
                 if isinstance(self.payload, str):
                     payload_bytes = self.payload.encode('utf-8')
                 else:
-                    payload_bytes = self.payload
+                    payload_bytes = self.payload or b''
                 data.extend(len(payload_bytes).to_bytes(2, 'big'))
                 data.extend(payload_bytes)
             return bytes(data)
@@ -38,29 +252,578 @@ class MQTTPacket:
             print(f"Encode error: {e}")
             return bytes([self.packet_type.value])
 
+    def _body_length(self) -> int:
+        """Length of the MQTT variable header plus payload"""
+        return _MQTT_ENCODERS[self.packet_type][1](self)
+
+    def encoded_length(self) -> int:
+        """Size of the MQTT 3.1.1 frame, header included"""
+        body = self._body_length()
+        return 1 + _remaining_length_size(body) + body
+
+    def encode_into(self, buffer, offset: int = 0) -> int:
+        """Write the MQTT 3.1.1 frame into a preallocated buffer.
+
+        Returns the number of bytes written.
+        """
+        header, body_length, write_body = _MQTT_ENCODERS[self.packet_type]
+        if header == _PUBLISH_HEADER:
+            header |= (self.dup << 3) | (self.qos << 1) | int(self.retain)
+        body = body_length(self)
+        view = memoryview(buffer)
+        view[offset] = header
+        if body < 128:
+            view[offset + 1] = body
+            pos = offset + 2
+        else:
+            length_field = encode_remaining_length(body)
+            pos = offset + 1
+            view[pos:pos + len(length_field)] = length_field
+            pos += len(length_field)
+        return write_body(self, view, pos) - offset
+
+    @classmethod
+    def decode(cls, data: bytes, protocol: str = None, keep_raw: bool = False):
+        """Decode one complete frame, detecting the wire format when not given.
+
+        With ``keep_raw`` the frame is kept as ``raw_data`` and the payload
+        is a memoryview into it instead of a copy, so ``data`` must not be
+        reused afterwards.
+        """
+        if protocol is None:
+            protocol = detect_protocol(data[0])
+        if protocol == PROTOCOL_MQTT311:
+            return cls._decode_mqtt(memoryview(data), keep_raw)
+        return cls._decode_legacy(data, keep_raw)
+
     @classmethod
-    def decode(cls, data: bytes):
+    def _decode_legacy(cls, data: bytes, keep_raw: bool = False):
         """改进的解码方法"""
+        packet_type = _LEGACY_TYPES[data[0]]
+        if packet_type is None:
+            raise ValueError(f"Unknown packet type: {data[0]}")
         try:
-            packet_type = PacketType(data[0])
             pos = 1
             topic = None
             payload = None
-            
+            packet_id = 0
+            if data[0] in _LEGACY_IDENTIFIED and len(data) >= pos + 2:
+                packet_id = int.from_bytes(data[pos:pos+2], 'big')
+                pos += 2
+
             if len(data) > pos + 2:
                 topic_len = int.from_bytes(data[pos:pos+2], 'big')
                 pos += 2
                 if topic_len > 0:
-                    topic = data[pos:pos+topic_len].decode('utf-8')
+                    topic = str(data[pos:pos+topic_len], 'utf-8')
                     pos += topic_len
-                    
+
                     if len(data) > pos + 2:
                         payload_len = int.from_bytes(data[pos:pos+2], 'big')
                         pos += 2
                         if payload_len > 0:
                             payload = data[pos:pos+payload_len]
-            
-            return cls(packet_type, topic, payload)
+                            if not keep_raw:
+                                payload = bytes(payload)
+
+            packet = cls(packet_type, topic, payload, packet_id=packet_id)
+            packet.protocol = PROTOCOL_LEGACY
+            if keep_raw:
+                packet.raw_data = data
+            return packet
         except Exception as e:
             print(f"Decode error: {e}")
-            return cls(packet_type)
\ No newline at end of file
+            return cls(packet_type)
+
+    @classmethod
+    def _decode_mqtt(cls, view: memoryview, keep_raw: bool = False):
+        """Decode an MQTT 3.1.1 frame, raises ValueError if it is malformed"""
+        header = view[0]
+        decode_body = _MQTT_DECODERS[header >> 4]
+        if decode_body is None:
+            raise ValueError(f"Unknown MQTT packet type: {header >> 4}")
+        if len(view) > 1 and view[1] < 128:
+            length, pos = view[1], 2
+        else:
+            decoded = decode_remaining_length(view, 1, len(view))
+            if decoded is None:
+                raise ValueError("Truncated fixed header")
+            length, used = decoded
+            pos = 1 + used
+        end = pos + length
+        if end > len(view):
+            raise ValueError("Truncated packet")
+
+        packet = cls(MQTT_TYPES[header >> 4])
+        packet.protocol = PROTOCOL_MQTT311
+        if keep_raw:
+            packet.raw_data = view
+        try:
+            decode_body(packet, header, view, pos, end, keep_raw)
+        except (IndexError, struct.error, UnicodeDecodeError) as e:
+            raise ValueError(f"Malformed {packet.packet_type.name} packet: {e}")
+        return packet
+
+
+def _write_string(view: memoryview, pos: int, value) -> int:
+    data = _as_bytes(value)
+    _U16.pack_into(view, pos, len(data))
+    pos += 2
+    view[pos:pos + len(data)] = data
+    return pos + len(data)
+
+
+def _read_string(view: memoryview, pos: int):
+    length = _U16.unpack_from(view, pos)[0]
+    pos += 2
+    if pos + length > len(view):
+        raise IndexError("string runs past the end of the packet")
+    return str(view[pos:pos + length], 'utf-8'), pos + length
+
+
+def _read_binary(view: memoryview, pos: int):
+    length = _U16.unpack_from(view, pos)[0]
+    pos += 2
+    return bytes(view[pos:pos + length]), pos + length
+
+
+# MQTT 3.1.1 bodies, one (length, writer) pair and one decoder per type
+
+def _publish_length(packet: MQTTPacket) -> int:
+    length = 2 + len(_as_bytes(packet.topic)) + len(_as_bytes(packet.payload))
+    return length + 2 if packet.qos else length
+
+
+def _write_publish(packet: MQTTPacket, view: memoryview, pos: int) -> int:
+    pos = _write_string(view, pos, packet.topic)
+    if packet.qos:
+        _U16.pack_into(view, pos, packet.packet_id)
+        pos += 2
+    payload = _as_bytes(packet.payload)
+    view[pos:pos + len(payload)] = payload
+    return pos + len(payload)
+
+
+def _decode_publish(packet: MQTTPacket, header: int, view: memoryview, pos: int, end: int, keep_raw: bool):
+    packet.dup = bool(header & 0x08)
+    packet.qos = (header >> 1) & 0x03
+    packet.retain = bool(header & 0x01)
+    packet.topic, pos = _read_string(view, pos)
+    if packet.qos:
+        packet.packet_id = _U16.unpack_from(view, pos)[0]
+        pos += 2
+    packet.payload = view[pos:end] if keep_raw else bytes(view[pos:end])
+
+
+def _two_bytes(packet: MQTTPacket) -> int:
+    return 2
+
+
+def _write_packet_id(packet: MQTTPacket, view: memoryview, pos: int) -> int:
+    _U16.pack_into(view, pos, packet.packet_id)
+    return pos + 2
+
+
+def _decode_packet_id(packet: MQTTPacket, header: int, view: memoryview, pos: int, end: int, keep_raw: bool):
+    packet.packet_id = _U16.unpack_from(view, pos)[0]
+
+
+def _connack_length(packet: MQTTPacket) -> int:
+    return 2 if packet.compression is None else 6
+
+
+def _write_connack(packet: MQTTPacket, view: memoryview, pos: int) -> int:
+    view[pos] = int(packet.session_present)
+    view[pos + 1] = packet.return_code
+    if packet.compression is None:
+        return pos + 2
+    view[pos] |= CONNACK_COMPRESSION
+    _U32.pack_into(view, pos + 2, packet.compression)
+    return pos + 6
+
+
+def _decode_connack(packet: MQTTPacket, header: int, view: memoryview, pos: int, end: int, keep_raw: bool):
+    packet.session_present = bool(view[pos] & 0x01)
+    packet.return_code = view[pos + 1]
+    if view[pos] & CONNACK_COMPRESSION:
+        packet.compression = _U32.unpack_from(view, pos + 2)[0]
+
+
+def _subscribe_length(packet: MQTTPacket) -> int:
+    return 2 + sum(3 + len(_as_bytes(f)) for f, _ in packet.topic_filters)
+
+
+def _unsubscribe_length(packet: MQTTPacket) -> int:
+    return 2 + sum(2 + len(_as_bytes(f)) for f, _ in packet.topic_filters)
+
+
+def _write_subscribe(packet: MQTTPacket, view: memoryview, pos: int) -> int:
+    _U16.pack_into(view, pos, packet.packet_id)
+    pos += 2
+    for topic_filter, qos in packet.topic_filters:
+        pos = _write_string(view, pos, topic_filter)
+        view[pos] = qos
+        pos += 1
+    return pos
+
+
+def _write_unsubscribe(packet: MQTTPacket, view: memoryview, pos: int) -> int:
+    _U16.pack_into(view, pos, packet.packet_id)
+    pos += 2
+    for topic_filter, _ in packet.topic_filters:
+        pos = _write_string(view, pos, topic_filter)
+    return pos
+
+
+def _decode_filters(packet: MQTTPacket, view: memoryview, pos: int, end: int, with_qos: bool):
+    packet.packet_id = _U16.unpack_from(view, pos)[0]
+    pos += 2
+    subscriptions = []
+    while pos < end:
+        topic_filter, pos = _read_string(view, pos)
+        qos = 0
+        if with_qos:
+            qos = view[pos]
+            pos += 1
+        subscriptions.append((topic_filter, qos))
+    packet.subscriptions = subscriptions
+    if subscriptions:
+        packet.topic, packet.qos = subscriptions[0]
+
+
+def _decode_subscribe(packet: MQTTPacket, header: int, view: memoryview, pos: int, end: int, keep_raw: bool):
+    _decode_filters(packet, view, pos, end, True)
+
+
+def _decode_unsubscribe(packet: MQTTPacket, header: int, view: memoryview, pos: int, end: int, keep_raw: bool):
+    _decode_filters(packet, view, pos, end, False)
+
+
+def _suback_length(packet: MQTTPacket) -> int:
+    return 2 + len(packet.return_codes if packet.return_codes is not None else [0])
+
+
+def _write_suback(packet: MQTTPacket, view: memoryview, pos: int) -> int:
+    _U16.pack_into(view, pos, packet.packet_id)
+    pos += 2
+    for code in (packet.return_codes if packet.return_codes is not None else [0]):
+        view[pos] = code
+        pos += 1
+    return pos
+
+
+def _decode_suback(packet: MQTTPacket, header: int, view: memoryview, pos: int, end: int, keep_raw: bool):
+    packet.packet_id = _U16.unpack_from(view, pos)[0]
+    packet.return_codes = list(view[pos + 2:end])
+
+
+def _connect_length(packet: MQTTPacket) -> int:
+    length = 10 + 2 + len(_as_bytes(packet.client_id))
+    if packet.will_topic is not None:
+        length += 4 + len(_as_bytes(packet.will_topic)) + len(_as_bytes(packet.will_payload))
+    if packet.username is not None:
+        length += 2 + len(_as_bytes(packet.username))
+    if packet.password is not None:
+        length += 2 + len(_as_bytes(packet.password))
+    if packet.compression is not None:
+        length += 4
+    return length
+
+
+def _write_connect(packet: MQTTPacket, view: memoryview, pos: int) -> int:
+    pos = _write_string(view, pos, PROTOCOL_NAME)
+    view[pos] = PROTOCOL_LEVEL
+    connect_flags = 0x02 if packet.clean_session else 0
+    if packet.will_topic is not None:
+        connect_flags |= 0x04
+    if packet.username is not None:
+        connect_flags |= 0x80
+    if packet.password is not None:
+        connect_flags |= 0x40
+    if packet.compression is not None:
+        connect_flags |= CONNECT_COMPRESSION
+    view[pos + 1] = connect_flags
+    _U16.pack_into(view, pos + 2, packet.keep_alive)
+    pos = _write_string(view, pos + 4, packet.client_id)
+    if packet.will_topic is not None:
+        pos = _write_string(view, pos, packet.will_topic)
+        pos = _write_string(view, pos, packet.will_payload)
+    if packet.username is not None:
+        pos = _write_string(view, pos, packet.username)
+    if packet.password is not None:
+        pos = _write_string(view, pos, packet.password)
+    if packet.compression is not None:
+        _U32.pack_into(view, pos, packet.compression)
+        pos += 4
+    return pos
+
+
+def _decode_connect(packet: MQTTPacket, header: int, view: memoryview, pos: int, end: int, keep_raw: bool):
+    name, pos = _read_string(view, pos)
+    level = view[pos]
+    flags = view[pos + 1]
+    packet.keep_alive = _U16.unpack_from(view, pos + 2)[0]
+    # kept so the broker can refuse unsupported protocol levels
+    packet.return_code = CONNACK_ACCEPTED if (name, level) in (('MQTT', 4), ('MQIsdp', 3)) \
+        else CONNACK_BAD_PROTOCOL
+    packet.clean_session = bool(flags & 0x02)
+    packet.client_id, pos = _read_string(view, pos + 4)
+    if flags & 0x04:
+        packet.will_topic, pos = _read_string(view, pos)
+        packet.will_payload, pos = _read_binary(view, pos)
+    if flags & 0x80:
+        packet.username, pos = _read_string(view, pos)
+    if flags & 0x40:
+        packet.password, pos = _read_binary(view, pos)
+    if flags & CONNECT_COMPRESSION:
+        packet.compression = _U32.unpack_from(view, pos)[0]
+
+
+def _empty_length(packet: MQTTPacket) -> int:
+    return 0
+
+
+def _write_nothing(packet: MQTTPacket, view: memoryview, pos: int) -> int:
+    return pos
+
+
+def _decode_nothing(packet: MQTTPacket, header: int, view: memoryview, pos: int, end: int, keep_raw: bool):
+    pass
+
+
+# packet type -> (fixed header byte, body length, body writer)
+_MQTT_ENCODERS = {
+    PacketType.CONNECT: (_connect_length, _write_connect),
+    PacketType.CONNACK: (_connack_length, _write_connack),
+    PacketType.PUBLISH: (_publish_length, _write_publish),
+    PacketType.PUBACK: (_two_bytes, _write_packet_id),
+    PacketType.PUBREC: (_two_bytes, _write_packet_id),
+    PacketType.PUBREL: (_two_bytes, _write_packet_id),
+    PacketType.PUBCOMP: (_two_bytes, _write_packet_id),
+    PacketType.SUBSCRIBE: (_subscribe_length, _write_subscribe),
+    PacketType.SUBACK: (_suback_length, _write_suback),
+    PacketType.UNSUBSCRIBE: (_unsubscribe_length, _write_unsubscribe),
+    PacketType.UNSUBACK: (_two_bytes, _write_packet_id),
+    PacketType.PINGREQ: (_empty_length, _write_nothing),
+    PacketType.PINGRESP: (_empty_length, _write_nothing),
+    PacketType.DISCONNECT: (_empty_length, _write_nothing),
+}
+_MQTT_ENCODERS = {packet_type: (_MQTT_HEADERS[packet_type],) + functions
+                  for packet_type, functions in _MQTT_ENCODERS.items()}
+
+# indexed by the type nibble of the fixed header
+_MQTT_DECODERS = [None] * 16
+for _packet_type, _decoder in ((PacketType.CONNECT, _decode_connect), (PacketType.CONNACK, _decode_connack),
+                               (PacketType.PUBLISH, _decode_publish), (PacketType.PUBACK, _decode_packet_id),
+                               (PacketType.PUBREC, _decode_packet_id), (PacketType.PUBREL, _decode_packet_id),
+                               (PacketType.PUBCOMP, _decode_packet_id), (PacketType.SUBSCRIBE, _decode_subscribe),
+                               (PacketType.SUBACK, _decode_suback), (PacketType.UNSUBSCRIBE, _decode_unsubscribe),
+                               (PacketType.UNSUBACK, _decode_packet_id), (PacketType.PINGREQ, _decode_nothing),
+                               (PacketType.PINGRESP, _decode_nothing), (PacketType.DISCONNECT, _decode_nothing)):
+    _MQTT_DECODERS[MQTT_TYPE_CODES[_packet_type]] = _decoder
+
+# packets without variable header never change, so they are encoded once
+_CONTROL_FRAMES = {protocol: {packet_type: MQTTPacket(packet_type).encode(protocol)
+                              for packet_type in (PacketType.PINGREQ, PacketType.PINGRESP, PacketType.DISCONNECT)}
+                   for protocol in (PROTOCOL_LEGACY, PROTOCOL_MQTT311)}
+
+
+def control_frame(packet_type: PacketType, protocol: str = PROTOCOL_MQTT311) -> bytes:
+    """Preencoded PINGREQ, PINGRESP or DISCONNECT frame"""
+    return _CONTROL_FRAMES[protocol][packet_type]
+
+
+def ack_frame(packet_type: PacketType, packet_id: int, protocol: str = PROTOCOL_MQTT311) -> bytes:
+    """PUBACK, PUBREC, PUBREL, PUBCOMP or UNSUBACK frame, packed without building a packet"""
+    if protocol == PROTOCOL_LEGACY:
+        return _LEGACY_ACK.pack(packet_type.value, packet_id)
+    return _ACK.pack(_MQTT_HEADERS[packet_type], 2, packet_id)
+
+
+def detect_protocol(first_byte: int) -> str:
+    """Legacy frames start with a PacketType value, MQTT frames with a type nibble >= 1"""
+    return PROTOCOL_LEGACY if first_byte < 0x10 else PROTOCOL_MQTT311
+
+
+def legacy_frame_length(data, start: int, end: int) -> Optional[int]:
+    """Return the length of the legacy frame starting at ``data[start]``.
+
+    Returns None when ``data[start:end]`` does not yet hold enough bytes to
+    know the length. Raises ValueError for an unknown packet type.
+    """
+    packet_type = data[start]
+    fields = _LEGACY_FIELDS.get(packet_type)
+    if fields is None:
+        if _LEGACY_TYPES[packet_type] is None:
+            raise ValueError(f"Unknown packet type: {packet_type}")
+        return 3 if packet_type in _LEGACY_IDENTIFIED else 1
+
+    pos = start + 3
+    for _ in range(fields):
+        if end - pos < 2:
+            return None
+        pos += 2 + ((data[pos] << 8) | data[pos + 1])
+    return pos - start
+
+
+def mqtt_frame_length(data, start: int, end: int) -> Optional[int]:
+    """Return the length of the MQTT 3.1.1 frame starting at ``data[start]``"""
+    decoded = decode_remaining_length(data, start + 1, end)
+    if decoded is None:
+        return None
+    length, used = decoded
+    return 1 + used + length
+
+
+class PacketReader:
+    """Incremental packet decoder for one connection.
+
+    Bytes are received straight into a reusable buffer; every complete
+    packet found is decoded through memoryview slices and any partial tail
+    is kept for the next read. With ``protocol=None`` the wire format is
+    detected from the first byte received.
+
+    With ``keep_raw`` each frame is copied out of the receive buffer once
+    and packets reference it (``raw_data`` and the payload) instead of
+    copying the payload, so frames can be forwarded without re-encoding.
+
+    An MQTT 3.1.1 PUBLISH longer than ``stream_threshold`` bytes is not
+    buffered: the packet is returned as soon as its header is read, with a
+    PayloadStream (spooled in ``stream_dir``) in place of the payload, and
+    the rest of the frame is written to the stream as it is received.
+    """
+
+    def __init__(self, buffer_size: int = 65536, protocol: str = None, keep_raw: bool = False,
+                 stream_threshold: int = 0, stream_dir: str = None):
+        self.keep_raw = keep_raw
+        self.stream_threshold = stream_threshold
+        self.stream_dir = stream_dir
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._needed = 1
+        # the payload being streamed, until all of it is received
+        self._stream: Optional[PayloadStream] = None
+        self._detect = protocol is None
+        self._set_protocol(protocol)
+
+    def _set_protocol(self, protocol: Optional[str]):
+        self.protocol = protocol
+        if protocol == PROTOCOL_LEGACY:
+            self._frame_length = legacy_frame_length
+        else:
+            self._frame_length = mqtt_frame_length
+
+    def feed(self, data) -> List[MQTTPacket]:
+        """Append received bytes and return the packets they complete"""
+        size = len(data)
+        self._reserve(size)
+        self._view[self._end:self._end + size] = data
+        self._end += size
+        return self._drain()
+
+    def read_from(self, sock) -> Optional[List[MQTTPacket]]:
+        """Receive once from ``sock`` into the buffer.
+
+        Returns the decoded packets (possibly none), or None when the peer
+        closed the connection.
+        """
+        self._reserve(self._needed)
+        received = sock.recv_into(self._view[self._end:])
+        if not received:
+            return None
+        self._end += received
+        return self._drain()
+
+    def reset(self):
+        """Drop buffered bytes; a payload still streaming is cut off"""
+        self._start = self._end = 0
+        self._needed = 1
+        if self._stream is not None:
+            self._stream.fail()
+            self._stream = None
+        if self._detect:
+            self._set_protocol(None)
+
+    def _reserve(self, size: int):
+        """Make room for ``size`` more bytes after the buffered data"""
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start, self._end = 0, pending
+        if len(self._buffer) - pending < size:
+            capacity = len(self._buffer)
+            while capacity - pending < size:
+                capacity *= 2
+            self._view.release()
+            self._buffer.extend(bytes(capacity - len(self._buffer)))
+            self._view = memoryview(self._buffer)
+
+    def _drain(self) -> List[MQTTPacket]:
+        packets = []
+        view, start, end = self._view, self._start, self._end
+        if self._stream is not None:
+            start += self._feed_stream(view[start:end])
+        if self.protocol is None and start < end:
+            self._set_protocol(detect_protocol(view[start]))
+        frame_length, protocol, keep_raw = self._frame_length, self.protocol, self.keep_raw
+        streams = self.stream_threshold and protocol == PROTOCOL_MQTT311
+        while start < end:
+            length = frame_length(view, start, end)
+            if length is None:
+                break
+            if streams and length > self.stream_threshold and view[start] >> 4 == 3:
+                packet, body = self._open_stream(view, start, end, length)
+                if packet is None:
+                    break
+                packets.append(packet)
+                start = body + self._feed_stream(view[body:end])
+                continue
+            if start + length > end:
+                break
+            frame = view[start:start + length]
+            if keep_raw:
+                frame = memoryview(bytes(frame))
+            packets.append(MQTTPacket.decode(frame, protocol, keep_raw))
+            start += length
+
+        if start == end:
+            self._start = self._end = 0
+            self._needed = 1
+        else:
+            self._start = start
+            # ask for at least the rest of a frame whose length is known,
+            # a frame to be streamed only needs its header
+            length = frame_length(view, start, end) or 0
+            if streams and length > self.stream_threshold:
+                length = 0
+            self._needed = max(1, length - (end - start))
+        return packets
+
+    def _open_stream(self, view, start: int, end: int, length: int):
+        """The header-only packet of a PUBLISH to stream and where its payload starts.
+
+        Returns (None, None) until the whole header has been received.
+        """
+        pos = start + 1 + decode_remaining_length(view, start + 1, end)[1]
+        if end - pos < 2:
+            return None, None
+        body = pos + 2 + _U16.unpack_from(view, pos)[0] + (2 if view[start] & 0x06 else 0)
+        if body > end:
+            return None, None
+        header = bytes([view[start]]) + encode_remaining_length(body - pos) + bytes(view[pos:body])
+        packet = MQTTPacket.decode(header, PROTOCOL_MQTT311)
+        packet.payload = None
+        packet.stream = self._stream = PayloadStream(start + length - body, self.stream_dir)
+        return packet, body
+
+    def _feed_stream(self, data) -> int:
+        """Hand received bytes to the streaming payload, returns how many it took"""
+        stream = self._stream
+        taken = stream.write(data)
+        if stream.complete:
+            self._stream = None
+        return taken
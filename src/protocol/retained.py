@@ -0,0 +1,167 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from .packet import MQTTPacket, PacketType, PROTOCOL_MQTT311
+from .topic import SINGLE_LEVEL, MULTI_LEVEL
+
+
+class RetainedMessage:
+    __slots__ = ('topic', 'frame', 'payload_offset', 'referenced')
+
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        # set when the message is delivered, gives it a second chance on eviction
+        self.referenced = False
+        # the MQTT 3.1.1 frame is built once, a snapshot only queues it; the
+        # payload is only kept in it, so size() counts every retained byte
+        self.frame = MQTTPacket(PacketType.PUBLISH, topic=topic, payload=payload, retain=True).encode()
+        self.payload_offset = len(self.frame) - len(payload)
+
+    @property
+    def payload(self) -> bytes:
+        return self.frame[self.payload_offset:]
+
+    @property
+    def size(self) -> int:
+        return len(self.frame) + len(self.topic)
+
+    def encode(self, protocol: str = PROTOCOL_MQTT311) -> bytes:
+        if protocol == PROTOCOL_MQTT311:
+            return self.frame
+        return MQTTPacket(PacketType.PUBLISH, topic=self.topic, payload=self.payload,
+                          retain=True).encode(protocol)
+
+
+class _Node:
+    __slots__ = ('children', 'message')
+
+    def __init__(self):
+        self.children: Dict[str, '_Node'] = {}
+        self.message: Optional[RetainedMessage] = None
+
+
+class RetainedStore:
+    """Last retained message per topic.
+
+    Topics are indexed in a trie segmented by level, so the messages a
+    subscription filter matches are found by walking only the branches the
+    filter selects instead of scanning every topic. The store is capped at
+    ``max_bytes``; when it grows past the cap the least recently set or
+    delivered messages are evicted. Recency is tracked CLOCK style: a
+    delivery only marks the message, and eviction skips marked messages
+    once, so a large snapshot does not reorder the whole store.
+
+    The store is not thread-safe; callers serialize access.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evicted = 0
+        self._root = _Node()
+        self._lru: 'OrderedDict[str, RetainedMessage]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self._lru
+
+    def get(self, topic: str) -> Optional[RetainedMessage]:
+        return self._lru.get(topic)
+
+    def set(self, topic: str, payload: bytes):
+        """Retain ``payload`` for ``topic``, an empty payload clears it"""
+        if not payload:
+            self.clear(topic)
+            return
+        message = RetainedMessage(topic, bytes(payload))
+        if message.size > self.max_bytes:
+            self.clear(topic)
+            self.evicted += 1
+            return
+        node = self._root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _Node()
+            node = child
+        if node.message is not None:
+            self.size -= node.message.size
+        node.message = message
+        self.size += message.size
+        lru = self._lru
+        lru[topic] = message
+        lru.move_to_end(topic)
+        while self.size > self.max_bytes:
+            oldest = next(iter(lru.values()))
+            if oldest.referenced:
+                oldest.referenced = False
+                lru.move_to_end(oldest.topic)
+                continue
+            self.clear(oldest.topic)
+            self.evicted += 1
+
+    def clear(self, topic: str) -> bool:
+        """Drop the retained message of ``topic`` and prune empty nodes"""
+        if self._lru.pop(topic, None) is None:
+            return False
+        levels = topic.split('/')
+        path = [self._root]
+        for level in levels:
+            path.append(path[-1].children[level])
+        self.size -= path[-1].message.size
+        path[-1].message = None
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.message is not None or node.children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+        return True
+
+    def match(self, topic_filter: str) -> List[RetainedMessage]:
+        """Retained messages whose topic matches ``topic_filter``"""
+        result = []
+        levels = topic_filter.split('/')
+        nodes = [self._root]
+        for depth, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                if level == MULTI_LEVEL:
+                    # "a/#" also matches "a" itself
+                    if depth and node.message is not None:
+                        result.append(node.message)
+                    self._collect(node, result, skip_system=depth == 0)
+                elif level == SINGLE_LEVEL:
+                    for name, child in node.children.items():
+                        # wildcards at the first level never match $-prefixed topics
+                        if depth == 0 and name.startswith('$'):
+                            continue
+                        next_nodes.append(child)
+                else:
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            if node.message is not None:
+                result.append(node.message)
+
+        for message in result:
+            message.referenced = True
+        return result
+
+    @staticmethod
+    def _collect(node: _Node, result: list, skip_system: bool = False):
+        """Every message below ``node``"""
+        append = result.append
+        stack = [child for name, child in node.children.items()
+                 if not (skip_system and name.startswith('$'))]
+        pop, extend = stack.pop, stack.extend
+        while stack:
+            node = pop()
+            if node.message is not None:
+                append(node.message)
+            if node.children:
+                extend(node.children.values())
@@ -0,0 +1,166 @@
+import os
+import tempfile
+import threading
+from typing import BinaryIO, Callable, Iterator, List, Tuple, Union
+
+# bytes read or relayed per call while a payload streams
+STREAM_CHUNK = 256 * 1024
+
+PayloadSource = Union[str, os.PathLike, BinaryIO, bytes, bytearray, memoryview]
+
+
+class PayloadStream:
+    """A PUBLISH payload that is still arriving, spooled to an unlinked temp file.
+
+    The connection's reader appends to it with write(). Any number of
+    consumers read it concurrently, each from its own offset and at its own
+    pace: as chunks, whole with read(), copied to a file with spill(), or
+    relayed to a socket with send_to(), which uses os.sendfile. Consumers
+    waiting for more data than has arrived block; if the sender goes away
+    first they raise ConnectionError. The payload is never held in memory
+    as a whole.
+    """
+
+    def __init__(self, length: int, directory: str = None):
+        self.length = length
+        self.received = 0
+        self.complete = False
+        self.failed = False
+        # bytes every consumer but send_to skips, such as a compression method byte
+        self.start = 0
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._fd = self._file.fileno()
+        self._cond = threading.Condition()
+        self._callbacks: List[Callable[['PayloadStream'], None]] = []
+
+    def __len__(self) -> int:
+        return self.length - self.start
+
+    @property
+    def done(self) -> bool:
+        return self.complete or self.failed
+
+    def write(self, data) -> int:
+        """Append received payload bytes, returns how many belonged to the payload"""
+        view = memoryview(data)[:self.length - self.received]
+        taken = len(view)
+        while view:
+            view = view[os.write(self._fd, view):]
+        with self._cond:
+            self.received += taken
+            if self.received == self.length:
+                self.complete = True
+            self._cond.notify_all()
+        if self.complete:
+            self._finish()
+        return taken
+
+    def fail(self):
+        """The sender went away before the whole payload arrived"""
+        with self._cond:
+            if self.done:
+                return
+            self.failed = True
+            self._cond.notify_all()
+        self._finish()
+
+    def add_done_callback(self, fn: Callable[['PayloadStream'], None]):
+        """Call ``fn(stream)`` once the stream completed or failed, right away if it has"""
+        with self._cond:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def wait(self, offset: int, timeout: float = None) -> int:
+        """Wait for bytes past ``offset``, returns how many have arrived"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.received > offset or self.done, timeout)
+            if self.received <= offset and self.failed:
+                raise ConnectionError("Payload stream was cut off")
+            return self.received
+
+    def chunks(self, chunk_size: int = STREAM_CHUNK) -> Iterator[bytes]:
+        """Iterate the payload as it arrives"""
+        offset = self.start
+        while offset < self.length:
+            available = self.wait(offset)
+            chunk = os.pread(self._fd, min(chunk_size, available - offset), offset)
+            offset += len(chunk)
+            yield chunk
+
+    def read(self, size: int = -1) -> bytes:
+        """The first ``size`` bytes of the payload, all of it by default"""
+        if size < 0:
+            return b''.join(self.chunks())
+        end = min(self.length, self.start + size)
+        self.wait(end - 1)
+        return os.pread(self._fd, end - self.start, self.start)
+
+    def spill(self, path: str) -> str:
+        """Copy the payload to ``path`` as it arrives, returns the path"""
+        with open(path, 'wb') as f:
+            for chunk in self.chunks():
+                f.write(chunk)
+        return path
+
+    def send_to(self, sock, offset: int = 0) -> Tuple[int, int]:
+        """Write the payload from ``offset`` on to ``sock`` as it arrives.
+
+        Returns the number of send calls made and the bytes written.
+        """
+        calls = size = 0
+        sendfile = getattr(os, 'sendfile', None)
+        while offset < self.length:
+            count = min(STREAM_CHUNK, self.wait(offset) - offset)
+            try:
+                if sendfile is None:
+                    raise BlockingIOError
+                sent = sendfile(sock.fileno(), self._fd, offset, count)
+            except BlockingIOError:
+                # a socket with a timeout, or no sendfile on this platform
+                chunk = os.pread(self._fd, count, offset)
+                sock.sendall(chunk)
+                sent = len(chunk)
+            if not sent:
+                raise ConnectionError("Socket closed while relaying a stream")
+            offset += sent
+            calls += 1
+            size += sent
+        return calls, size
+
+    def close(self):
+        self._file.close()
+
+    def _finish(self):
+        with self._cond:
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+def open_payload(source: PayloadSource) -> Tuple[Union[BinaryIO, memoryview], int, bool]:
+    """The body, size and whether it was opened here, for a file path, file object or buffer.
+
+    A file object is sent from its current position to its end.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source).cast('B')
+        return view, len(view), False
+    opened = isinstance(source, (str, os.PathLike))
+    body = open(source, 'rb') if opened else source
+    try:
+        size = os.fstat(body.fileno()).st_size - body.tell()
+    except BaseException:
+        if opened:
+            body.close()
+        raise
+    return body, size, opened
+
+
+def send_payload(sock, body: Union[BinaryIO, memoryview], size: int):
+    """Write a body from open_payload to ``sock``; files go with sendfile, buffers uncopied"""
+    if isinstance(body, memoryview):
+        sock.sendall(body)
+        return
+    sock.sendfile(body, offset=body.tell(), count=size)
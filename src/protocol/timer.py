@@ -0,0 +1,125 @@
+import logging
+import math
+import threading
+import time
+from typing import Callable, List, Optional, Set
+
+
+class Timer:
+    __slots__ = ('callback', 'args', 'rounds', 'bucket', 'wheel')
+
+    def __init__(self, wheel: 'TimerWheel', callback: Callable, args: tuple):
+        self.wheel = wheel
+        self.callback = callback
+        self.args = args
+        self.rounds = 0
+        self.bucket: Optional[Set['Timer']] = None
+
+    @property
+    def pending(self) -> bool:
+        return self.bucket is not None
+
+    def cancel(self) -> bool:
+        """Stop the timer from firing, returns False if it already fired or was cancelled"""
+        return self.wheel.cancel(self)
+
+
+class TimerWheel:
+    """Hashed timer wheel driven by a single thread.
+
+    Time is divided into ``tick`` second steps and timers are hashed into
+    ``slots`` buckets by their expiry tick; a timer further away than one
+    revolution also counts the rounds left. Scheduling and cancelling are
+    O(1), and each tick only visits one bucket. Timers fire with ``tick``
+    resolution, on the wheel thread, so callbacks must be short.
+    """
+
+    def __init__(self, tick: float = 0.1, slots: int = 512):
+        self.tick = tick
+        self.slots = slots
+        self._buckets: List[Set[Timer]] = [set() for _ in range(slots)]
+        self._cursor = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.logger = logging.getLogger('TimerWheel')
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='TimerWheel')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """Call ``callback(*args)`` on the wheel thread after ``delay`` seconds"""
+        ticks = max(1, math.ceil(delay / self.tick))
+        timer = Timer(self, callback, args)
+        with self._lock:
+            timer.rounds = (ticks - 1) // self.slots
+            timer.bucket = self._buckets[(self._cursor + ticks) % self.slots]
+            timer.bucket.add(timer)
+            self._count += 1
+        return timer
+
+    def cancel(self, timer: Timer) -> bool:
+        with self._lock:
+            if timer.bucket is None:
+                return False
+            timer.bucket.discard(timer)
+            timer.bucket = None
+            self._count -= 1
+            return True
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self._stopped.wait(max(0.0, next_tick - time.monotonic())):
+            self._advance()
+            next_tick += self.tick
+
+    def _advance(self):
+        due = []
+        with self._lock:
+            self._cursor = (self._cursor + 1) % self.slots
+            bucket = self._buckets[self._cursor]
+            for timer in list(bucket):
+                if timer.rounds:
+                    timer.rounds -= 1
+                    continue
+                bucket.discard(timer)
+                timer.bucket = None
+                due.append(timer)
+            self._count -= len(due)
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                self.logger.exception("Timer callback failed")
+
+
+_default_wheel: Optional[TimerWheel] = None
+_default_lock = threading.Lock()
+
+
+def default_wheel() -> TimerWheel:
+    """The process-wide wheel shared by every connection, started on first use"""
+    global _default_wheel
+    with _default_lock:
+        if _default_wheel is None:
+            _default_wheel = TimerWheel()
+        _default_wheel.start()
+        return _default_wheel
@@ -0,0 +1,328 @@
+import threading
+from typing import Dict, FrozenSet, Hashable, Iterator, List, Optional, Tuple
+
+SINGLE_LEVEL = '+'
+MULTI_LEVEL = '#'
+SHARED_PREFIX = '$share/'
+CONFLATE_PREFIX = '$conflate/'
+
+
+def validate_filter(topic_filter: str) -> bool:
+    """Check wildcard placement in a subscription topic filter"""
+    if not topic_filter:
+        return False
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+        if level == MULTI_LEVEL:
+            if i != len(levels) - 1:
+                return False
+        elif level != SINGLE_LEVEL and (SINGLE_LEVEL in level or MULTI_LEVEL in level):
+            return False
+    return True
+
+
+def parse_shared(topic_filter: str) -> Optional[Tuple[str, str]]:
+    """Split ``$share/<group>/<filter>`` into (group, filter), None for other filters.
+
+    Raises ValueError for a malformed shared subscription.
+    """
+    if not topic_filter.startswith(SHARED_PREFIX):
+        return None
+    group, _, inner = topic_filter[len(SHARED_PREFIX):].partition('/')
+    if not group or SINGLE_LEVEL in group or MULTI_LEVEL in group or not validate_filter(inner):
+        raise ValueError(f"Invalid shared subscription: {topic_filter}")
+    return group, inner
+
+
+def parse_conflated(topic_filter: str) -> Optional[Tuple[float, str]]:
+    """Split ``$conflate/<interval ms>/<filter>`` into (interval seconds, filter), None for other filters.
+
+    Raises ValueError for a malformed conflated subscription.
+    """
+    if not topic_filter.startswith(CONFLATE_PREFIX):
+        return None
+    interval, _, inner = topic_filter[len(CONFLATE_PREFIX):].partition('/')
+    if not interval.isdigit() or inner.startswith(SHARED_PREFIX) or not validate_filter(inner):
+        raise ValueError(f"Invalid conflated subscription: {topic_filter}")
+    return int(interval) / 1000, inner
+
+
+def match_filter(topic_filter: str) -> str:
+    """The filter a subscription matches topics with, without a $share/<group>/ or $conflate/<ms>/ prefix"""
+    if topic_filter.startswith(CONFLATE_PREFIX):
+        return topic_filter[len(CONFLATE_PREFIX):].partition('/')[2]
+    if topic_filter.startswith(SHARED_PREFIX):
+        return topic_filter[len(SHARED_PREFIX):].partition('/')[2]
+    return topic_filter
+
+
+def validate_topic(topic: str) -> bool:
+    """A publish topic must be non-empty and free of wildcards"""
+    return bool(topic) and SINGLE_LEVEL not in topic and MULTI_LEVEL not in topic
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Match one concrete topic against one filter"""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    if topic.startswith('$') and filter_levels[0] in (SINGLE_LEVEL, MULTI_LEVEL):
+        return False
+    for i, level in enumerate(filter_levels):
+        if level == MULTI_LEVEL:
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != SINGLE_LEVEL and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Node:
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children: Dict[str, '_Node'] = {}
+        # replaced, never mutated, so a reader always sees a whole set
+        self.subscribers: FrozenSet = frozenset()
+
+
+# misses per cache entry the cache stays off for after it did not pay off
+CACHE_BACKOFF = 8
+
+
+class TopicTrie:
+    """Subscription table segmented by topic level.
+
+    Filters may use the ``+`` and ``#`` wildcards. Matching walks one trie
+    level per topic level, so its cost depends on the topic depth rather
+    than on the number of subscriptions. Resolved subscriber sets for
+    concrete topics are kept in a bounded cache that starts over when full.
+    Filling it costs more than it saves when topics rarely repeat, so a
+    cache that was hit less than once per entry before it filled up is not
+    filled again until ``cache_size * CACHE_BACKOFF`` more misses.
+
+    match() takes no lock. Subscriber sets are copied on write and a change
+    swaps in a new cache once the trie is updated, so a result resolved
+    while the trie changed can only land in the discarded cache. Writers
+    serialize on an internal lock.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        self._root = _Node()
+        self._count = 0
+        self.cache_size = cache_size
+        self._cache: Dict[str, FrozenSet] = {}
+        # hits of the current cache, and misses left to go uncached; updated
+        # without a lock, a lost increment only skews the estimate
+        self._hits = 0
+        self._skip = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def subscribe(self, topic_filter: str, subscriber: Hashable) -> bool:
+        """Add a subscription, returns False if it already existed"""
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split('/'):
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _Node()
+                node = child
+            if subscriber in node.subscribers:
+                return False
+            node.subscribers = node.subscribers | {subscriber}
+            self._count += 1
+            self._invalidate(topic_filter)
+            return True
+
+    def unsubscribe(self, topic_filter: str, subscriber: Hashable) -> bool:
+        """Remove a subscription and prune nodes left empty"""
+        with self._lock:
+            levels = topic_filter.split('/')
+            path = [self._root]
+            for level in levels:
+                node = path[-1].children.get(level)
+                if node is None:
+                    return False
+                path.append(node)
+            if subscriber not in path[-1].subscribers:
+                return False
+            path[-1].subscribers = path[-1].subscribers - {subscriber}
+            self._count -= 1
+            for i in range(len(levels), 0, -1):
+                node = path[i]
+                if node.subscribers or node.children:
+                    break
+                del path[i - 1].children[levels[i - 1]]
+            self._invalidate(topic_filter)
+            return True
+
+    def subscriber_count(self, topic_filter: str) -> int:
+        """Number of subscribers registered with exactly this filter"""
+        return len(self.subscribers(topic_filter))
+
+    def subscribers(self, topic_filter: str) -> FrozenSet:
+        """Subscribers registered with exactly this filter"""
+        node = self._root
+        for level in topic_filter.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return frozenset()
+        return node.subscribers
+
+    def match(self, topic: str) -> FrozenSet:
+        """Resolve every subscriber whose filter matches ``topic``"""
+        # read once: a writer replaces the cache after changing the trie
+        cache = self._cache
+        result = cache.get(topic)
+        if result is not None:
+            self._hits += 1
+            return result
+
+        result = frozenset(self._match(topic))
+        if self._skip:
+            # the last cache did not pay off, try again once this runs out
+            self._skip -= 1
+        elif len(cache) < self.cache_size:
+            cache[topic] = result
+        elif self.cache_size > 0 and cache is self._cache:
+            # full, start over; an empty cache is never stale
+            self._cache = {}
+            if self._hits < len(cache):
+                self._skip = self.cache_size * CACHE_BACKOFF
+            self._hits = 0
+        return result
+
+    def covering(self, topic_filter: str) -> set:
+        """Subscribers whose filter matches every topic ``topic_filter`` matches"""
+        result = set()
+        nodes = [self._root]
+        for i, level in enumerate(topic_filter.split('/')):
+            # wildcards at the first level never match $-prefixed topics
+            wildcards = i > 0 or not level.startswith('$')
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if wildcards:
+                    rest = children.get(MULTI_LEVEL)
+                    if rest is not None:
+                        result.update(rest.subscribers)
+                single = children.get(SINGLE_LEVEL) if wildcards else None
+                if level == MULTI_LEVEL:
+                    # only a "#" covers a "#", or "+/#" at the first level
+                    rest = single.children.get(MULTI_LEVEL) if single is not None and i == 0 else None
+                    if rest is not None:
+                        result.update(rest.subscribers)
+                    continue
+                if single is not None:
+                    next_nodes.append(single)
+                if level != SINGLE_LEVEL:
+                    child = children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+            nodes = next_nodes
+
+        for node in nodes:
+            result.update(node.subscribers)
+            rest = node.children.get(MULTI_LEVEL)
+            if rest is not None:
+                result.update(rest.subscribers)
+        return result
+
+    def overlapping(self, topic_filter: str) -> set:
+        """Subscribers whose filter matches at least one topic ``topic_filter`` matches"""
+        result = set()
+        nodes = [self._root]
+        for i, level in enumerate(topic_filter.split('/')):
+            dollar = i == 0 and level.startswith('$')
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if level == MULTI_LEVEL:
+                    # "a/#" also matches its parent level "a"
+                    result.update(node.subscribers)
+                    stack = [child for name, child in children.items() if i > 0 or not name.startswith('$')]
+                    while stack:
+                        child = stack.pop()
+                        result.update(child.subscribers)
+                        stack.extend(child.children.values())
+                    continue
+                if not dollar:
+                    rest = children.get(MULTI_LEVEL)
+                    if rest is not None:
+                        result.update(rest.subscribers)
+                    single = children.get(SINGLE_LEVEL)
+                    if single is not None:
+                        next_nodes.append(single)
+                if level == SINGLE_LEVEL:
+                    next_nodes.extend(child for name, child in children.items()
+                                      if name not in (SINGLE_LEVEL, MULTI_LEVEL)
+                                      and (i > 0 or not name.startswith('$')))
+                else:
+                    child = children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+            nodes = next_nodes
+
+        for node in nodes:
+            result.update(node.subscribers)
+            rest = node.children.get(MULTI_LEVEL)
+            if rest is not None:
+                result.update(rest.subscribers)
+        return result
+
+    def filters(self) -> Iterator[str]:
+        """Iterate the filters that have at least one subscriber"""
+        stack: List = [(self._root, [])]
+        while stack:
+            node, levels = stack.pop()
+            if node.subscribers and levels:
+                yield '/'.join(levels)
+            for level, child in list(node.children.items()):
+                stack.append((child, levels + [level]))
+
+    def clear_cache(self):
+        """Drop cached results, and start caching again if it was backed off"""
+        self._cache = {}
+        self._hits = 0
+        self._skip = 0
+
+    def _invalidate(self, topic_filter: str):
+        # swapped rather than copied without the one stale topic, which
+        # would cost a pass over the whole cache under the writer lock
+        self._cache = {}
+
+    def _match(self, topic: str) -> set:
+        result = set()
+        levels = topic.split('/')
+        # wildcards at the first level never match $-prefixed topics
+        wildcards = not topic.startswith('$')
+        nodes = [self._root]
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if wildcards:
+                    rest = children.get(MULTI_LEVEL)
+                    if rest is not None:
+                        result.update(rest.subscribers)
+                    single = children.get(SINGLE_LEVEL)
+                    if single is not None:
+                        next_nodes.append(single)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            if not next_nodes:
+                return result
+            nodes = next_nodes
+            wildcards = True
+
+        for node in nodes:
+            result.update(node.subscribers)
+            # "a/#" also matches its parent level "a"
+            rest = node.children.get(MULTI_LEVEL)
+            if rest is not None:
+                result.update(rest.subscribers)
+        return result